@@ -0,0 +1,216 @@
+import os
+import json
+import array
+import shutil
+import hashlib
+import argparse
+import warnings
+from itertools import zip_longest
+
+import numpy as np
+
+# Columnar annotation store : one folder per split (e.g. YeastCellDataset/train/TRAIN_annotations)
+#   paths.npy / path_offsets.npy : utf-8 bytes of all the image paths, path i is paths[path_offsets[i]:path_offsets[i + 1]]
+#   boxes.npy : (n_boxes, 4) float32 xmin, ymin, xmax, ymax , labels.npy : int64 as annotated
+#   offsets.npy / label_offsets.npy : (n_images + 1) boxes of image i are boxes[offsets[i]:offsets[i + 1]], same for 
+#   the labels (annotations can have more labels than boxes, like the sample TRAIN_objects.json, they are kept as is)
+# key.json holds the source, a digest of the arrays (for the cache keys) and the number of dropped boxes.
+# The converter streams its source, the store is memory-mapped by every DataLoader worker.
+
+
+def iter_json_array(path, chunk_size=1 << 20):
+    """Elements of the top level JSON array of path, decoded one at a time from chunks of the file"""
+    decoder = json.JSONDecoder()
+    with open(path, 'r') as f:
+        buffer = f.read(chunk_size)
+        eof = len(buffer) == 0
+        pos = len(buffer) - len(buffer.lstrip())
+        if buffer[pos:pos + 1] != '[':
+            raise ValueError("{} is not a JSON array".format(path))
+        pos += 1
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buffer) and buffer[pos] == ']':
+                return
+            try:
+                element, end = decoder.raw_decode(buffer, pos)
+                # a value cut at the end of the chunk (a number ...) can still decode
+                complete = end < len(buffer) or eof
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                complete = False
+            if not complete or pos == len(buffer):
+                more = f.read(chunk_size)
+                eof = len(more) == 0
+                if eof and pos == len(buffer):
+                    raise ValueError("{} : truncated JSON array".format(path))
+                buffer, pos = buffer[pos:] + more, 0
+                continue
+            yield element
+            pos = end
+            if pos > chunk_size:
+                buffer, pos = buffer[pos:], 0
+
+
+def bbbc041_records(path, directory, label_map):
+    # (image path, boxes, labels) of the BBBC041 training.json / test.json format
+    for e in iter_json_array(path):
+        boxes, labels = [], []
+        for element in e["objects"]:
+            bounding_box = element["bounding_box"]
+            boxes.append([bounding_box['minimum']['c'], bounding_box['minimum']['r'],
+                          bounding_box['maximum']['c'], bounding_box['maximum']['r']])
+            labels.append(label_map[element["category"]])
+        yield directory + e["image"]["pathname"], boxes, labels
+
+
+def json_records(data_folder, split):
+    # (image path, boxes, labels) of the <split>_images.json / <split>_objects.json pair read by Dataset
+    images = iter_json_array(os.path.join(data_folder, split + '_images.json'))
+    objects = iter_json_array(os.path.join(data_folder, split + '_objects.json'))
+    for image, obj in zip_longest(images, objects):
+        if image is None or obj is None:
+            raise ValueError("{} : {}_images.json and {}_objects.json differ in length".format(data_folder, split, split))
+        yield image, obj['boxes'], obj['labels']
+
+
+def write_annotations(records, path, source='', on_degenerate='drop'):
+    """Stream (image path, boxes, labels) records into the store at path
+
+    Boxes with xmin >= xmax, ymin >= ymax or non finite coordinates (utils.iou scores them 0) are
+    dropped with a warning ('drop'), raise a ValueError ('raise') or are stored anyway ('keep').
+    Returns:
+        path
+    """
+    from dataset import write_cache_entry # dataset imports this module
+    assert on_degenerate in {'drop', 'raise', 'keep'}
+    paths = bytearray()
+    path_offsets = array.array('q', [0])
+    boxes = array.array('f')
+    labels = array.array('q')
+    offsets = array.array('q', [0])
+    label_offsets = array.array('q', [0])
+    dropped, dropped_images, mismatched = 0, 0, 0
+
+    for image, bxs, lbls in records:
+        bxs = np.asarray(bxs, dtype=np.float64).reshape(-1, 4)
+        lbls = np.asarray(lbls, dtype=np.int64).reshape(-1)
+        mismatched += int(bxs.shape[0] != lbls.shape[0])
+        valid = np.isfinite(bxs).all(1) & (bxs[:, 0] < bxs[:, 2]) & (bxs[:, 1] < bxs[:, 3])
+        if not valid.all() and on_degenerate != 'keep':
+            if on_degenerate == 'raise':
+                raise ValueError("{} : degenerate box {}".format(image, bxs[~valid][0].tolist()))
+            dropped += int((~valid).sum())
+            dropped_images += 1
+            # label j goes with box j
+            keep_labels = np.ones(lbls.shape[0], dtype=bool)
+            keep_labels[:min(lbls.shape[0], bxs.shape[0])] = valid[:lbls.shape[0]]
+            bxs, lbls = bxs[valid], lbls[keep_labels]
+
+        paths += image.encode('utf-8')
+        path_offsets.append(len(paths))
+        boxes.frombytes(bxs.astype(np.float32).tobytes())
+        labels.frombytes(lbls.tobytes())
+        offsets.append(offsets[-1] + bxs.shape[0])
+        label_offsets.append(label_offsets[-1] + lbls.shape[0])
+
+    if mismatched > 0:
+        warnings.warn("{} : {} images with a different number of boxes and labels".format(source or path, mismatched))
+    if dropped > 0:
+        warnings.warn("{} : dropped {} degenerate boxes in {} images".format(source or path, dropped, dropped_images))
+
+    arrays = {
+        'paths': np.frombuffer(bytes(paths), dtype=np.uint8),
+        'path_offsets': np.frombuffer(path_offsets, dtype=np.int64),
+        'boxes': np.frombuffer(boxes, dtype=np.float32).reshape(-1, 4),
+        'labels': np.frombuffer(labels, dtype=np.int64),
+        'offsets': np.frombuffer(offsets, dtype=np.int64),
+        'label_offsets': np.frombuffer(label_offsets, dtype=np.int64),
+    }
+    h = hashlib.sha1()
+    for name in sorted(arrays):
+        h.update(arrays[name].tobytes())
+    key = {'source': source, 'digest': h.hexdigest(), 'dropped': dropped}
+    if os.path.isdir(path):
+        # a new conversion replaces the store
+        shutil.rmtree(path)
+    return write_cache_entry(path, key, arrays)
+
+
+class AnnotationStore(object):
+    """Read side of write_annotations, arrays are memory-mapped and only the path is sent to the workers"""
+    def __init__(self, path):
+        super(AnnotationStore, self).__init__()
+        self.path = path
+        with open(os.path.join(path, "key.json"), 'r') as j:
+            self.key = json.load(j)
+        self.paths = np.load(os.path.join(path, "paths.npy"), mmap_mode='r')
+        self.path_offsets = np.load(os.path.join(path, "path_offsets.npy"), mmap_mode='r')
+        self.boxes = np.load(os.path.join(path, "boxes.npy"), mmap_mode='r')
+        self.labels = np.load(os.path.join(path, "labels.npy"), mmap_mode='r')
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode='r')
+        self.label_offsets = np.load(os.path.join(path, "label_offsets.npy"), mmap_mode='r')
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def __len__(self):
+        return self.offsets.shape[0] - 1
+
+    @property
+    def digest(self):
+        return self.key['digest']
+
+    def image(self, i):
+        return bytes(self.paths[self.path_offsets[i]:self.path_offsets[i + 1]]).decode('utf-8')
+
+    def objects(self, i):
+        # same dict as an entry of <split>_objects.json
+        boxes = self.boxes[self.offsets[i]:self.offsets[i + 1]].tolist()
+        labels = self.labels[self.label_offsets[i]:self.label_offsets[i + 1]].tolist()
+        return {'boxes': boxes, 'labels': labels}
+
+    def column(self, name):
+        return Column(self, name)
+
+
+class Column(object):
+    # read-only list view of the store, stands for the json lists of the Dataset (images, objects)
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return getattr(self.store, self.name)(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def store_path(data_folder, split):
+    return os.path.join(data_folder, split + '_annotations')
+
+
+if __name__ == '__main__':
+    # converts the json pair of a Dataset folder, see transform.py for BBBC041
+    parser = argparse.ArgumentParser(description='columnar annotation store of a <split>_images.json / <split>_objects.json pair')
+    parser.add_argument('data_folder', type=str, help="folder with the json files, the store is written next to them")
+    parser.add_argument('--split', type=str, default='TRAIN', choices=['TRAIN', 'TEST'])
+    parser.add_argument('--on-degenerate', type=str, default='drop', choices=['drop', 'raise', 'keep'])
+    args = parser.parse_args()
+    path = write_annotations(json_records(args.data_folder, args.split), store_path(args.data_folder, args.split),
+                             source=os.path.join(args.data_folder, args.split + '_*.json'), on_degenerate=args.on_degenerate)
+    print("{} : {} images".format(path, len(AnnotationStore(path))))
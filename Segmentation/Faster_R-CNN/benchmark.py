@@ -0,0 +1,1625 @@
+"""Equivalence checks and timings for the data / training pipeline.
+
+Run one section at a time, from this folder :
+    python benchmark.py calc_rpn
+"""
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import pickle
+import random
+import shutil
+import tempfile
+import time
+import warnings
+
+import numpy as np
+
+import tools
+from tools import base_size_calculator, valid_anchors, valid_anchor_arrays, get_anchors, RPM
+
+
+HEIGHT = 512
+WIDTH = 512
+ANCHOR_SIZES = [8, 16, 32, 64, 128]
+ANCHOR_RATIOS = [0.5, 1, 2]
+REV_LABEL_MAP = {0: 'yeast_cell', 1: 'bg'}
+DATA_FOLDER = "YeastCellDataset/train"
+
+
+def load_objects(data_folder=DATA_FOLDER, split='TRAIN'):
+    with open(os.path.join(data_folder, split + '_images.json'), 'r') as j:
+        images = json.load(j)
+    with open(os.path.join(data_folder, split + '_objects.json'), 'r') as j:
+        objects = json.load(j)
+    # the sample set is annotated 'bg_first'
+    for o in objects:
+        o['labels'] = [l - 1 for l in o['labels']]
+    return images, objects
+
+
+def make_rpm(height=HEIGHT, width=WIDTH, num_regions=500):
+    out_h, out_w = base_size_calculator(height, width)
+    downscale = max(math.ceil(height / out_h), math.ceil(width / out_w))
+    anchors = valid_anchors(ANCHOR_SIZES, ANCHOR_RATIOS, downscale, output_width=out_w, resized_width=width,
+                            output_height=out_h, resized_height=height)
+    return RPM(ANCHOR_SIZES, ANCHOR_RATIOS, anchors, REV_LABEL_MAP, rpn_max_overlap=0.7, rpn_min_overlap=0.2,
+               num_regions=num_regions)
+
+
+def timeit(fn, repeat=3):
+    best = math.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, out
+
+
+########################################################################################################################
+# tools.RPM : vectorized calc_rpn_targets vs the python loop
+########################################################################################################################
+def bench_calc_rpn(args):
+    rpm = make_rpm()
+    _, objects = load_objects()
+    # the loop version takes ~20s per image
+    objects = objects[:args.num_images]
+    size = (HEIGHT, WIDTH)
+
+    t_loop, t_vec = [], []
+    for i, o in enumerate(objects):
+        boxes, labels = o['boxes'], o['labels']
+        # horizontally flipped copy as well, like Transform does
+        flipped = [[WIDTH - b[2] - 1, b[1], WIDTH - b[0] - 1, b[3]] for b in boxes]
+        for bxs in (boxes, flipped):
+            t1, (label_loop, regr_loop) = timeit(lambda: rpm.calc_rpn_targets_loop(bxs, labels, size), repeat=1)
+            t2, (label_vec, regr_vec) = timeit(lambda: rpm.calc_rpn_targets(bxs, labels, size))
+            assert np.array_equal(label_loop, label_vec), "labels differ for image {}".format(i)
+            assert np.allclose(regr_loop, regr_vec, rtol=0, atol=1e-12), "regression differs for image {}".format(i)
+            t_loop.append(t1)
+            t_vec.append(t2)
+
+            # subsampling only switches labels off, and keeps as many negatives as positives
+            sampled = label_vec.copy()
+            num_pos = rpm.sample_rpn_targets(sampled)
+            assert np.all((sampled == label_vec) | (sampled == 0))
+            assert num_pos == (sampled == 1).sum() <= rpm.num_regions // 2
+            assert (sampled == -1).sum() <= max(num_pos, rpm.num_regions - num_pos)
+
+    print("calc_rpn targets identical on {} images (x2 flips)".format(len(objects)))
+    print("loop       : {:8.2f} ms / image".format(1000 * np.mean(t_loop)))
+    print("vectorized : {:8.2f} ms / image".format(1000 * np.mean(t_vec)))
+    print("speedup    : {:8.1f}x".format(np.mean(t_loop) / np.mean(t_vec)))
+
+
+########################################################################################################################
+# tools.get_anchors : registry entry vs valid_anchors() / default_anchors()
+########################################################################################################################
+def bench_anchors(args):
+    cache_dir = tempfile.mkdtemp()
+    try:
+        for height, width in [(HEIGHT, WIDTH), (300, 400), (3024, 4032)]:
+            out_h, out_w = base_size_calculator(height, width)
+            downscale = max(math.ceil(height / out_h), math.ceil(width / out_w))
+
+            t_dict, legacy = timeit(lambda: valid_anchors(ANCHOR_SIZES, ANCHOR_RATIOS, downscale, output_width=out_w,
+                                                          resized_width=width, output_height=out_h,
+                                                          resized_height=height), repeat=1)
+            t_flat, (boxes, locs) = timeit(lambda: valid_anchor_arrays(legacy, len(ANCHOR_RATIOS)), repeat=1)
+            tools.ANCHOR_REGISTRY.clear()
+            t_build, anchors = timeit(lambda: get_anchors(height, width, ANCHOR_SIZES, ANCHOR_RATIOS, downscale,
+                                                          cache_dir=cache_dir), repeat=1)
+            tools.ANCHOR_REGISTRY.clear()
+            t_load, anchors = timeit(lambda: get_anchors(height, width, ANCHOR_SIZES, ANCHOR_RATIOS, downscale,
+                                                         cache_dir=cache_dir), repeat=1)
+
+            # same anchors, same order as the nested dict
+            assert np.array_equal(anchors.valid_boxes, boxes) and np.array_equal(anchors.valid_locs, locs)
+            assert anchors.as_dict() == legacy
+            # the dense grid holds the same boxes (x, y, w, h on the feature map)
+            jy, ix, a = locs.T
+            g = np.asarray(anchors.grid)[:, jy, ix, a].T.astype(np.float64) * downscale
+            assert np.allclose(np.stack([g[:, 0], g[:, 1], g[:, 0] + g[:, 2], g[:, 1] + g[:, 3]], 1), boxes, atol=1e-3)
+
+            rpm = RPM(ANCHOR_SIZES, ANCHOR_RATIOS, anchors, REV_LABEL_MAP)
+            rpm_legacy = RPM(ANCHOR_SIZES, ANCHOR_RATIOS, legacy, REV_LABEL_MAP)
+            print("{}x{} : {} valid anchors, grid {}".format(height, width, len(boxes), tuple(anchors.grid.shape)))
+            print("    valid_anchors() + flatten : {:8.2f} ms".format(1000 * (t_dict + t_flat)))
+            print("    registry build + save    : {:8.2f} ms".format(1000 * t_build))
+            print("    registry load (mmap)     : {:8.2f} ms".format(1000 * t_load))
+            print("    RPM pickled to a worker  : {:8d} bytes (dict: {} bytes)".format(
+                len(pickle.dumps(rpm)), len(pickle.dumps(rpm_legacy))))
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def make_dataset(split='TRAIN', rpm=None, folder=None, **kwargs):
+    from dataset import Dataset
+    folder = folder or "YeastCellDataset/" + split.lower()
+    return Dataset(data_folder=folder, rpm=rpm or make_rpm(), split=split, image_resize_size=(HEIGHT, WIDTH),
+                   data_format='bg_first', **kwargs)
+
+
+def quiet(fn):
+    # the data pipeline still prints on every call
+    def wrapped(*a, **kw):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return fn(*a, **kw)
+    return wrapped
+
+
+########################################################################################################################
+# dataset.build_rpn_cache : cached unsampled targets vs calc_rpn every epoch
+########################################################################################################################
+def bench_rpn_cache(args):
+    from PIL import Image
+    from dataset import flip_boxes
+    cache_dir = tempfile.mkdtemp()
+    try:
+        plain = make_dataset()
+        t_build, cached = timeit(lambda: make_dataset(rpm=plain.rpm, rpn_cache=cache_dir), repeat=1)
+        cache = cached.rpn_cache
+        n = len(plain) if args.num_images is None else args.num_images
+
+        t_calc, t_lookup = [], []
+        for i in range(n):
+            boxes, labels = plain.read_objects(i)
+            with Image.open(plain.images[i]) as image:
+                boxes = plain.transform.resize_boxes(boxes, image.size)
+            for flipped, bxs in enumerate([boxes, flip_boxes(boxes, WIDTH)]):
+                t1, (label, regr) = timeit(lambda: plain.rpm.calc_rpn_targets(bxs, labels, (HEIGHT, WIDTH)))
+                t2, (label_c, regr_c) = timeit(lambda: cache.targets(i, bool(flipped)))
+                assert np.array_equal(label, label_c), "labels differ for image {}".format(i)
+                assert np.allclose(regr, regr_c, atol=1e-6), "regression differs for image {}".format(i)
+                t1_s, _ = timeit(lambda: plain.rpm.sample_rpn_targets(label.copy()))
+                t_calc.append(t1 + t1_s)
+                t_lookup.append(t2 + t1_s)
+
+        # whole samples, image decoding included
+        t_item_plain, _ = timeit(quiet(lambda: [plain[i] for i in range(n)]))
+        t_item_cached, _ = timeit(quiet(lambda: [cached[i] for i in range(n)]))
+        size = sum(os.path.getsize(os.path.join(cache.path, f)) for f in os.listdir(cache.path))
+
+        print("cached targets identical on {} images (x2 flips), cache {:.1f} KB built in {:.2f} s".format(
+            n, size / 1024, t_build))
+        print("targets per sample  : calc_rpn {:8.2f} ms | cache {:8.2f} ms".format(
+            1000 * np.mean(t_calc), 1000 * np.mean(t_lookup)))
+        print("__getitem__         : calc_rpn {:8.2f} ms | cache {:8.2f} ms".format(
+            1000 * t_item_plain / n, 1000 * t_item_cached / n))
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def dense_rpn_losses(targets, cls_k, reg_k):
+    # the former dense losses (tile'd (b, h, w, A) label maps), as a reference for the sparse ones
+    import torch
+    b, h, w, num_anchors = cls_k.shape
+    label = torch.zeros(b, h * w * num_anchors)
+    regr = torch.zeros(b, h * w * num_anchors, 4)
+    for i in range(b):
+        pos = targets['pos'][targets['pos_offsets'][i]:targets['pos_offsets'][i + 1]].long()
+        neg = targets['neg'][targets['neg_offsets'][i]:targets['neg_offsets'][i + 1]].long()
+        label[i, pos] = 1
+        label[i, neg] = -1
+        regr[i, pos] = targets['regr'][targets['pos_offsets'][i]:targets['pos_offsets'][i + 1]]
+    label = label.view(b, h, w, num_anchors)
+    regr = regr.view(b, h, w, 4 * num_anchors)
+
+    x_abs = torch.abs(regr - reg_k)
+    x_abs = torch.where(x_abs <= 1, x_abs ** 2 / 2, x_abs - 0.5)
+    label4 = label.repeat_interleave(4, dim=-1).clamp(min=0)
+    l1 = ((label4 * x_abs).view(b, -1).sum(1) / (1e-6 + label4.view(b, -1).sum(1))).mean()
+
+    ce = torch.nn.functional.binary_cross_entropy(cls_k, label.clamp(min=0), reduction='none')
+    l2 = ((label.abs() * ce).view(b, -1).sum(1) / (1e-6 + label.abs().view(b, -1).sum(1))).mean()
+    return l1, l2, label, regr
+
+
+########################################################################################################################
+# sparse RPN targets : loss equivalence with the dense maps, bytes per batch
+########################################################################################################################
+def bench_sparse_targets(args):
+    import torch
+    from dataset import collate_fn
+    from loss import rpn_loss_regr, rpn_loss_cls_fixed_num
+
+    dataset = make_dataset()
+    samples = quiet(lambda: [dataset[i] for i in range(len(dataset))])()
+    out_h, out_w = base_size_calculator(HEIGHT, WIDTH)
+    num_anchors = len(ANCHOR_SIZES) * len(ANCHOR_RATIOS)
+
+    for batch_size in (2, 8):
+        batch = collate_fn(samples[:batch_size])
+        targets = batch[3]
+        cls_k = torch.rand(batch_size, out_h, out_w, num_anchors, requires_grad=True)
+        reg_k = torch.randn(batch_size, out_h, out_w, 4 * num_anchors, requires_grad=True)
+
+        t_sparse, (l1, l2) = timeit(lambda: (rpn_loss_regr(targets, reg_k), rpn_loss_cls_fixed_num(cls_k, targets)))
+        g_sparse = torch.autograd.grad(l1 + l2, [cls_k, reg_k])
+        t_dense, (d1, d2, label, regr) = timeit(lambda: dense_rpn_losses(targets, cls_k, reg_k))
+        g_dense = torch.autograd.grad(d1 + d2, [cls_k, reg_k])
+        assert torch.allclose(l1, d1, atol=1e-5) and torch.allclose(l2, d2, atol=1e-5)
+        assert all(torch.allclose(a, b, atol=1e-7) for a, b in zip(g_sparse, g_dense))
+
+        sparse_bytes = sum(t.numel() * t.element_size() for t in targets.values())
+        dense_bytes = label.numel() * 4 + regr.numel() * 4
+        print("batch {:2d} : losses match ({:.5f}, {:.5f})".format(batch_size, l1.item(), l2.item()))
+        print("    target bytes / batch  : dense {:10d} | sparse {:8d} ({:.0f}x less)".format(
+            dense_bytes, sparse_bytes, dense_bytes / sparse_bytes))
+        print("    pickled batch targets : dense {:10d} | sparse {:8d}".format(
+            len(pickle.dumps([label, regr])), len(pickle.dumps(targets))))
+        print("    rpn losses            : dense {:8.2f} ms | sparse {:8.2f} ms".format(1000 * t_dense, 1000 * t_sparse))
+
+
+def random_proposals(num_boxes, batch_size=1, size=32, seed=0):
+    # rounded boxes on a (size x size) feature map, like rpn_to_roi decodes them
+    import torch
+    g = torch.Generator().manual_seed(seed)
+    centers = torch.rand(batch_size, num_boxes, 2, generator=g) * size
+    wh = torch.rand(batch_size, num_boxes, 2, generator=g) * 8 + 0.5
+    boxes = torch.cat([centers - wh / 2, centers + wh / 2], 2).round().clamp(0, size)
+    # distinct scores, float32 ties would make the kept order depend on the sort
+    probs = torch.stack([torch.randperm(num_boxes, generator=g) for _ in range(batch_size)]).float() / num_boxes
+    return boxes, probs
+
+
+########################################################################################################################
+# tools.batched_nms : tiled NMS vs non_max_suppression_fast
+########################################################################################################################
+def bench_nms(args):
+    import torch
+    from tools import non_max_suppression_fast, non_max_suppression_tiled
+    torch.set_num_threads(max(1, os.cpu_count() or 1))
+    for overlap_thresh in (0.9, 0.7):
+        print("overlap_thresh {} , max_boxes 300".format(overlap_thresh))
+        for num_boxes in (1000, 5000, 15360, 50000):
+            boxes, probs = random_proposals(num_boxes, batch_size=4)
+            t_old, (b_old, p_old) = timeit(quiet(lambda: non_max_suppression_fast(boxes[0], probs[0], overlap_thresh, 300)))
+            t_new, (b_new, p_new) = timeit(lambda: non_max_suppression_tiled(boxes[0], probs[0], overlap_thresh, 300))
+            assert torch.equal(b_old, b_new) and torch.equal(p_old, p_new), "selection differs at {} boxes".format(num_boxes)
+            t_topk, _ = timeit(lambda: non_max_suppression_tiled(boxes[0], probs[0], overlap_thresh, 300, pre_nms_top_n=6000))
+            t_batch, (bb, pb, nk) = timeit(lambda: non_max_suppression_tiled(boxes, probs, overlap_thresh, 300, pre_nms_top_n=6000))
+            print("    {:6d} boxes : loop {:8.2f} ms | tiled {:7.2f} ms | tiled top-6000 {:7.2f} ms | batch of 4 {:7.2f} ms".format(
+                num_boxes, 1000 * t_old, 1000 * t_new, 1000 * t_topk, 1000 * t_batch))
+
+
+########################################################################################################################
+# tools.rpn_to_roi_batch : batched proposal decoding vs the per image / per anchor loop
+########################################################################################################################
+def bench_rpn_to_roi(args):
+    import torch
+    from tools import get_anchors, rpn_to_roi_loop, rpn_to_roi_batch
+    torch.set_num_threads(max(1, os.cpu_count() or 1))
+    anchors = get_anchors(HEIGHT, WIDTH, ANCHOR_SIZES, ANCHOR_RATIOS)
+    grid = anchors.grid_tensor()
+    _ , h , w , num_anchors = grid.shape
+    g = torch.Generator().manual_seed(args.seed)
+    for batch_size in (1, 4, 16):
+        cls_k = torch.rand(batch_size, h, w, num_anchors, generator=g)
+        reg_k = torch.randn(batch_size, h, w, 4 * num_anchors, generator=g)
+
+        def loop():
+            return [rpn_to_roi_loop(cls_k[b], reg_k[b], no_anchors=num_anchors, all_possible_anchor_boxes=grid.clone()) for b in range(batch_size)]
+
+        t_old, old = timeit(quiet(loop))
+        t_new, (rois, num_rois) = timeit(lambda: rpn_to_roi_batch(cls_k, reg_k, grid))
+        for b in range(batch_size):
+            assert torch.equal(old[b], rois[b, :num_rois[b]]), "proposals differ for image {}".format(b)
+        print("batch {:3d} : loop {:8.2f} ms | batched {:8.2f} ms".format(batch_size, 1000 * t_old, 1000 * t_new))
+
+
+########################################################################################################################
+# tools.calc_iou_batch : IoU matrix matching vs the per proposal calc_iou_loop
+########################################################################################################################
+def random_matching_problem(batch_size, num_rois, num_gt, size=32, seed=0):
+    # gt boxes on the feature map and rounded proposals, half of them jittered around a gt box 
+    import torch
+    g = torch.Generator().manual_seed(seed)
+    centers = torch.rand(batch_size, num_gt, 2, generator=g) * size
+    wh = torch.rand(batch_size, num_gt, 2, generator=g) * 6 + 1
+    gt = torch.cat([centers - wh / 2, centers + wh / 2], 2).clamp(0, size)
+    rois, _ = random_proposals(num_rois, batch_size, size=size, seed=seed + 1)
+    pick = torch.randint(num_gt, (batch_size, num_rois // 2), generator=g)
+    jitter = torch.randint(-1, 2, (batch_size, num_rois // 2, 4), generator=g).float()
+    rois[:, :num_rois // 2] = (torch.gather(gt, 1, pick[:, :, None].expand(-1, -1, 4)).round() + jitter).clamp(0, size)
+    # keep the proposals valid like rpn_to_roi would 
+    rois[:, :, 2:] = torch.maximum(rois[:, :, 2:], rois[:, :, :2] + 1)
+    labels = [[0] * num_gt for _ in range(batch_size)]
+    return rois, [gt[b] for b in range(batch_size)], labels
+
+
+def bench_calc_iou(args):
+    import torch
+    from tools import calc_iou_loop, calc_iou_batch, pad_gt
+    from utils import iou_matrix
+    label_map = {v: k for k, v in REV_LABEL_MAP.items()}
+    std = torch.tensor([8.0, 8.0, 4.0, 4.0])
+    for batch_size, num_rois, num_gt in ((1, 300, 50), (4, 300, 100), (16, 300, 100)):
+        rois, gt, labels = random_matching_problem(batch_size, num_rois, num_gt, seed=args.seed)
+        num_rois_b = torch.full((batch_size,), num_rois)
+
+        def loop():
+            return [calc_iou_loop(rois[b], {'boxes': gt[b], 'labels': labels[b]}, class_mapping=label_map) for b in range(batch_size)]
+
+        def batched():
+            gt_boxes, gt_labels, gt_valid = pad_gt(gt, labels)
+            return calc_iou_batch(rois, num_rois_b, gt_boxes, gt_labels, gt_valid, class_mapping=label_map)
+
+        t_old, old = timeit(quiet(loop), repeat=1)
+        t_new, (X, Y1, Y2, roi_index, _) = timeit(batched)
+        n = Y2.size(1) // 2
+        for b in range(batch_size):
+            X_old, Y1_old, Y2_old, _ = old[b]
+            rows = roi_index == b
+            assert torch.equal(X_old, X[rows]) and torch.equal(Y1_old, Y1[rows]), "matching differs for image {}".format(b)
+            # the loop picks among equal IoUs through an unstable sort, only tied rows may pick another gt box 
+            differ = (Y2_old[:, :n + 2] != Y2[rows][:, :n + 2]).any(1)
+            if differ.any():
+                xywh = X_old[differ]
+                ious = torch.from_numpy(iou_matrix(torch.cat([xywh[:, :2], xywh[:, :2] + xywh[:, 2:]], 1), gt[b].int()))
+                assert bool(((ious.max(1, keepdim=True)[0] - ious).abs() < 1e-6).sum(1).ge(2).all()), "tx / ty differ for image {}".format(b)
+            # the loop encodes tw = log(gw) / w , the batched version log(gw / w) 
+            fg = (Y2_old[:, 0] == 1) & ~differ
+            wh = X_old[fg][:, 2:]
+            gwh = torch.exp(Y2_old[fg][:, n + 2:n + 4] * wh / std[2:])
+            assert torch.allclose(torch.log(gwh / wh) * std[2:], Y2[rows][fg][:, n + 2:n + 4], atol=1e-4), "tw / th differ for image {}".format(b)
+        print("batch {:3d} , {} rois , {} gt : loop {:8.2f} ms | batched {:7.2f} ms | {} rois kept , {} positives".format(
+            batch_size, num_rois, num_gt, 1000 * t_old, 1000 * t_new, X.size(0), int(Y2[:, 0].sum())))
+
+
+########################################################################################################################
+# model.roi_pool : batched ROI pooling in Classifier vs one adaptive_avg_pool2d per roi
+########################################################################################################################
+def classifier_loop(model, base_x, rois):
+    # the original Classifier.forward (one crop per roi, pool then reduce), with the crop as [y1:y2, x1:x2]
+    import torch
+    import torch.nn.functional as F
+    outputs = []
+    for bi, x1, y1, x2, y2 in rois.long().tolist():
+        cropped = base_x[bi:bi + 1, :, y1:y2, x1:x2]
+        outputs.append(F.adaptive_avg_pool2d(cropped, (model.pooling_regions, model.pooling_regions)))
+    out = model.red_conv_roi(torch.cat(outputs, 0)).view(rois.size(0), -1)
+    out = model.drop_d1(model.relu_d1(model.d1(out)))
+    out = model.drop_d2(model.relu_d2(model.d2(out)))
+    return model.softmax_d3(model.d3(out)), model.d4(out)
+
+
+def bench_roi_pool(args):
+    import torch
+    import torch.nn.functional as F
+    from model import Classifier, roi_pool
+    torch.manual_seed(args.seed)
+    model = Classifier(num_classes=len(REV_LABEL_MAP)).eval()
+    batch_size, size = 4, 32
+    base_x = torch.relu(torch.randn(batch_size, model.feat_dim, size, size))
+    for num_rois in (64, 128, 256, 512):
+        rois, _ = random_proposals(num_rois, batch_size, size=size, seed=args.seed)
+        rois[:, :, :2] = rois[:, :, :2].clamp(max=size - 1)
+        rois[:, :, 2:] = torch.maximum(rois[:, :, 2:], rois[:, :, :2] + 1)
+        rois = torch.cat([torch.arange(batch_size).float()[:, None, None].expand(-1, num_rois, 1), rois], 2).reshape(-1, 5)
+        rois = rois[torch.randperm(rois.size(0))[:num_rois]]
+
+        def step(fn):
+            x = base_x.clone().requires_grad_(True)
+            out_class, out_regr = fn(x)
+            (out_class.sum() + out_regr.sum()).backward()
+            return out_class.detach(), out_regr.detach(), x.grad
+
+        t_old, _ = timeit(lambda: step(lambda x: classifier_loop(model, x, rois)))
+        t_new, _ = timeit(lambda: step(lambda x: model(x, rois)))
+        # compared in double, in float32 a few ReLUs of d1 / d2 flip and move the gradients 
+        model.double()
+        base_x = base_x.double()
+        old = step(lambda x: classifier_loop(model, x, rois))
+        new = step(lambda x: model(x, rois))
+        model.float()
+        base_x = base_x.float()
+        for a, b in zip(old, new):
+            assert torch.allclose(a, b, rtol=1e-6, atol=1e-9), "avg pooling differs at {} rois".format(num_rois)
+        model.pooling = 'align'
+        t_align, _ = timeit(lambda: step(lambda x: model(x, rois)))
+        model.pooling = 'avg'
+
+        # the pooling alone, on the reduced (128 channels) features 
+        features = torch.relu(torch.randn(batch_size, model.feat_dim // 4, size, size))
+
+        def pool_loop(x):
+            return torch.cat([F.adaptive_avg_pool2d(x[bi:bi + 1, :, y1:y2, x1:x2], model.pooling_regions)
+                              for bi, x1, y1, x2, y2 in rois.long().tolist()], 0)
+
+        t_pool_old, _ = timeit(lambda: pool_step(pool_loop, features))
+        t_pool_new, _ = timeit(lambda: pool_step(lambda x: roi_pool(x, rois, model.pooling_regions), features))
+        print("{:4d} rois , forward + backward : Classifier loop {:8.2f} ms | batched avg {:7.2f} ms | batched align {:7.2f} ms"
+              " || pooling only : loop {:7.2f} ms | batched {:6.2f} ms".format(
+            num_rois, 1000 * t_old, 1000 * t_new, 1000 * t_align, 1000 * t_pool_old, 1000 * t_pool_new))
+
+
+def pool_step(fn, features):
+    x = features.clone().requires_grad_(True)
+    fn(x).sum().backward()
+    return x.grad
+
+
+########################################################################################################################
+# dataset.BalancedRoiSampler : in-process roi minibatches vs a DataLoader per image
+########################################################################################################################
+class RoiPairs(object):
+    # the old dataset.Dataset_roi (pos / neg pairs, the smaller set cycled)
+    def __init__(self, pos, neg):
+        self.pos, self.neg, self.curr = pos, neg, -1
+
+    def __getitem__(self, i):
+        if self.pos.size(0) == 0:
+            return [], self.neg[i]
+        if self.neg.size(0) == 0:
+            return self.pos[i], []
+        self.curr += 1
+        if self.pos.size(0) <= self.neg.size(0):
+            return self.pos[self.curr % self.pos.size(0)], self.neg[i]
+        return self.pos[i], self.neg[self.curr % self.neg.size(0)]
+
+    def __len__(self):
+        return max(self.pos.size(0), self.neg.size(0))
+
+
+def bench_roi_sampler(args):
+    import torch
+    from torch.utils.data import DataLoader
+    from dataset import BalancedRoiSampler
+    n_roi, batch_size, num_rois = 100, 4, 250
+    g = torch.Generator().manual_seed(args.seed)
+    is_pos = torch.rand(batch_size * num_rois, generator=g) < 0.25
+    roi_index = torch.arange(batch_size).repeat_interleave(num_rois)
+    sampler = BalancedRoiSampler(n_roi, seed=args.seed)
+
+    # same schedule as the old loader : every roi of the larger set once, balanced minibatches 
+    batches = sampler(is_pos, ~is_pos, roi_index, batch_size)
+    for b in range(batch_size):
+        rows = torch.cat([ind[roi_index[ind] == b] for ind in batches])
+        pos, neg = rows[is_pos[rows]], rows[~is_pos[rows]]
+        larger = neg if int((~is_pos & (roi_index == b)).sum()) >= int((is_pos & (roi_index == b)).sum()) else pos
+        assert pos.size(0) == neg.size(0) and larger.unique().size(0) == larger.size(0), "unbalanced minibatches"
+    assert all(torch.equal(a, b) for a, b in zip(batches, BalancedRoiSampler(n_roi, seed=args.seed)(is_pos, ~is_pos, roi_index, batch_size))), \
+        "seeded sampler is not deterministic"
+
+    def loader(num_workers):
+        out = []
+        for b in range(batch_size):
+            rows = torch.nonzero(roi_index == b, as_tuple=True)[0]
+            db = RoiPairs(rows[is_pos[rows]], rows[~is_pos[rows]])
+            out += list(DataLoader(db, shuffle=True, batch_size=n_roi // 2, num_workers=num_workers))
+        return out
+
+    t_sampler, _ = timeit(lambda: sampler(is_pos, ~is_pos, roi_index, batch_size))
+    t_loader0, _ = timeit(lambda: loader(0))
+    t_loader2, _ = timeit(lambda: loader(2), repeat=1)
+    print("batch of {} images , {} rois each : BalancedRoiSampler {:7.2f} ms | DataLoader per image, 0 workers {:8.2f} ms | 2 workers {:8.2f} ms".format(
+        batch_size, num_rois, 1000 * t_sampler, 1000 * t_loader0, 1000 * t_loader2))
+
+
+########################################################################################################################
+# trainer.joint_step : one rpn forward + one optimizer step vs the alternating rpn / classifier steps
+########################################################################################################################
+def bench_train_step(args):
+    import torch
+    from types import SimpleNamespace
+    from dataset import collate_fn, BalancedRoiSampler
+    from model import Model_RPN, Classifier
+    from trainer import alternating_step, joint_step
+    torch.manual_seed(args.seed)
+    train_args = SimpleNamespace(lambda_rpn_regr=1.0, lambda_rpn_class=1.0, lambda_cls_regr=1.0, lambda_cls_class=1.0)
+    label_map = {v: k for k, v in REV_LABEL_MAP.items()}
+    dataset = make_dataset()
+    batch_size, num_steps = 2, args.num_images or 3
+    image, boxes, labels, targets, _ = quiet(collate_fn)([quiet(dataset.__getitem__)(i) for i in range(batch_size)])
+    anchors = get_anchors(HEIGHT, WIDTH, ANCHOR_SIZES, ANCHOR_RATIOS)
+    grid = anchors.grid_tensor()
+
+    for name, step, kwargs in (('alternating', alternating_step, {}),
+                               ('joint', joint_step, {}),
+                               ('joint + backbone grad', joint_step, {'shared_backbone_grad': True})):
+        # untrained weights, no download : only the cost of a step matters here 
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UserWarning)
+            model_rpn = Model_RPN(num_anchors=len(ANCHOR_SIZES) * len(ANCHOR_RATIOS), pretrained=False)
+        model_classifier = Classifier(num_classes=len(REV_LABEL_MAP))
+        optimizer_model_rpn = torch.optim.Adam(model_rpn.parameters())
+        optimizer_classifier = torch.optim.Adam(model_classifier.parameters())
+        sampler = BalancedRoiSampler(n_roi=100, seed=args.seed)
+
+        def run():
+            return step(model_rpn, model_classifier, optimizer_model_rpn, optimizer_classifier, sampler,
+                        image, boxes, labels, targets, grid, anchors.downscale, label_map, train_args, **kwargs)
+
+        run() # warm up
+        start = time.perf_counter()
+        class_steps = 0
+        for _ in range(num_steps):
+            class_steps += run()['class_steps']
+        elapsed = time.perf_counter() - start
+        print("{:22s} : {:6.3f} steps/sec ({:7.1f} ms / batch of {} , {:.1f} classifier minibatches / step)".format(
+            name, num_steps / elapsed, 1000 * elapsed / num_steps, batch_size, class_steps / num_steps))
+
+
+########################################################################################################################
+# dataset.build_image_store : memory-mapped pre-resized images vs decoding the JPEG frames every epoch
+########################################################################################################################
+def make_jpeg_folder(folder, split='TRAIN', size=(4032, 3024), num_images=None, quality=90):
+    # the sample frames upscaled to the microscope resolution (w x h) and saved as JPEG, boxes rescaled 
+    from PIL import Image
+    images, objects = load_objects("YeastCellDataset/" + split.lower(), split)
+    raw = json.load(open(os.path.join("YeastCellDataset/" + split.lower(), split + '_objects.json')))
+    n = len(images) if num_images is None else num_images
+    paths = []
+    for i in range(n):
+        path = os.path.join(folder, "frame_{:03d}.jpg".format(i))
+        with Image.open(images[i]) as image:
+            sx, sy = size[0] / image.size[0], size[1] / image.size[1]
+            image.convert('RGB').resize(size).save(path, quality=quality)
+        raw[i]['boxes'] = [[b[0] * sx, b[1] * sy, b[2] * sx, b[3] * sy] for b in raw[i]['boxes']]
+        paths.append(path)
+    with open(os.path.join(folder, split + '_images.json'), 'w') as j:
+        json.dump(paths, j)
+    with open(os.path.join(folder, split + '_objects.json'), 'w') as j:
+        json.dump(raw[:n], j)
+    return folder
+
+
+def epoch_time(dataset, num_workers=0):
+    import torch
+    from dataset import collate_fn
+    start = time.perf_counter()
+    if num_workers == 0:
+        for i in range(len(dataset)):
+            dataset[i]
+    else:
+        loader = torch.utils.data.DataLoader(dataset, batch_size=2, num_workers=num_workers, collate_fn=collate_fn)
+        for _ in loader:
+            pass
+    return time.perf_counter() - start
+
+
+def bench_image_store(args):
+    from PIL import Image
+    tmp = tempfile.mkdtemp()
+    try:
+        folder = make_jpeg_folder(tmp, num_images=args.num_images)
+        rpm = make_rpm()
+        jpeg = make_dataset(folder=folder, rpm=rpm)
+        t_build, stored = timeit(lambda: make_dataset(folder=folder, rpm=rpm, image_store=os.path.join(tmp, "cache")), repeat=1)
+        store = stored.image_store
+
+        for i in range(len(jpeg)):
+            with Image.open(jpeg.images[i]) as image:
+                expected = np.asarray(image.convert('RGB').resize((WIDTH, HEIGHT)))
+                boxes = jpeg.transform.resize_boxes(jpeg.read_objects(i)[0], image.size)
+            assert np.array_equal(expected, store.image(i)), "stored image {} differs".format(i)
+            assert np.allclose(boxes, stored.read_objects(i)[0], atol=1e-3), "stored boxes {} differ".format(i)
+            assert jpeg.read_objects(i)[1] == stored.read_objects(i)[1], "stored labels {} differ".format(i)
+
+        n = len(jpeg)
+        size = os.path.getsize(os.path.join(store.path, "images.npy"))
+        print("{} frames 4032x3024 JPEG ingested in {:.2f} s , store {:.1f} MB , identical images / boxes".format(n, t_build, size / 2 ** 20))
+        for num_workers in (0, 2):
+            t_jpeg = quiet(epoch_time)(jpeg, num_workers)
+            t_store = quiet(epoch_time)(stored, num_workers)
+            print("epoch data time , {} workers : JPEG {:8.2f} ms / image | image store {:7.2f} ms / image".format(
+                num_workers, 1000 * t_jpeg / n, 1000 * t_store / n))
+    finally:
+        shutil.rmtree(tmp)
+
+
+########################################################################################################################
+# dataset.Transform.open : JPEG draft (reduced DCT scale) decoding vs full decode + resize
+########################################################################################################################
+def decode_stats(paths, transform, queue):
+    # runs in a fresh process : time per image and peak RSS growth over the baseline
+    import resource
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    for path in paths:
+        image, _ = transform.open(path)
+        if image.size != transform.resize_size:
+            image = image.resize(transform.resize_size)
+    elapsed = (time.perf_counter() - start) / len(paths)
+    queue.put((elapsed, (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base) / 1024))
+
+
+def bench_decode(args):
+    import multiprocessing
+    from PIL import Image
+    from dataset import Transform
+    tmp = tempfile.mkdtemp()
+    try:
+        folder = make_jpeg_folder(tmp, num_images=args.num_images)
+        paths = json.load(open(os.path.join(folder, 'TRAIN_images.json')))
+        full = Transform(train=False, resize_size=(HEIGHT, WIDTH))
+        draft = Transform(train=False, resize_size=(HEIGHT, WIDTH), decode='draft')
+
+        diffs = []
+        for path in paths:
+            image_full, size_full = full.open(path)
+            image_full = image_full.resize(full.resize_size)
+            image_draft, size_draft = draft.open(path)
+            assert image_draft.size == (WIDTH, HEIGHT) and size_draft == size_full == (4032, 3024)
+            diffs.append(np.abs(np.asarray(image_full, dtype=np.float32) - np.asarray(image_draft, dtype=np.float32)).mean())
+        # non JPEG inputs fall back to the full decode 
+        tif = "YeastCellDataset/train/red_01.tif"
+        assert np.array_equal(np.asarray(full.open(tif)[0]), np.asarray(draft.open(tif)[0]))
+
+        ctx = multiprocessing.get_context('fork')
+        for name, transform in (('Image.open().convert().resize()', full), ('draft + exact resize', draft)):
+            queue = ctx.Queue()
+            p = ctx.Process(target=decode_stats, args=(paths, transform, queue))
+            p.start()
+            elapsed, rss = queue.get()
+            p.join()
+            print("{:32s} : {:8.2f} ms / image , peak RSS +{:7.1f} MB".format(name, 1000 * elapsed, rss))
+        print("mean abs pixel difference draft vs full : {:.2f} (0-255) over {} 4032x3024 frames".format(np.mean(diffs), len(paths)))
+    finally:
+        shutil.rmtree(tmp)
+
+
+########################################################################################################################
+# dataset.BatchAugment : augmentation of the collated batch vs ImageEnhance on every PIL image
+########################################################################################################################
+def bench_batch_augment(args):
+    import torch
+    from PIL import Image, ImageEnhance
+    from dataset import Transform, BatchAugment, adjust_sharpness, blend, grayscale
+    images, objects = load_objects()
+    n = len(images) if args.num_images is None else args.num_images
+    rpm = make_rpm()
+    grid = get_anchors(HEIGHT, WIDTH, ANCHOR_SIZES, ANCHOR_RATIOS).grid_tensor()
+    augment = BatchAugment(feature_size=grid.shape[1:3], num_anchors=grid.shape[3], downscale=WIDTH // grid.shape[2], seed=args.seed)
+
+    # an anchor grid that is not symmetric (width != downscale * feature_w) is refused
+    odd = torch.zeros(1, 3, HEIGHT, WIDTH - 12, dtype=torch.uint8)
+    try:
+        augment(odd, [torch.zeros(0, 4)], {}, feature_size=grid.shape[1:3])
+        raise AssertionError("BatchAugment accepted a {} wide image on a {} wide feature map".format(WIDTH - 12, grid.shape[2]))
+    except ValueError:
+        pass
+
+    # mirrored sparse targets vs the targets of the mirrored boxes (all anchors, before subsampling)
+    # the anchor grid is symmetric, the differences are ties of the best anchor of a box (first one wins)
+    same_pos, same_neg, total_pos = 0, 0, 0
+    for i in range(n):
+        boxes = np.asarray(objects[i]['boxes'], dtype=np.float64)
+        labels = objects[i]['labels']
+        mirrored = np.stack([WIDTH - boxes[:, 2], boxes[:, 1], WIDTH - boxes[:, 0], boxes[:, 3]], 1)
+        label, regr = rpm.calc_rpn_targets(boxes.tolist(), labels, (HEIGHT, WIDTH))
+        label_m, regr_m = rpm.calc_rpn_targets(mirrored.tolist(), labels, (HEIGHT, WIDTH))
+        pos, neg = np.flatnonzero(label.reshape(-1) == 1), np.flatnonzero(label.reshape(-1) == -1)
+        targets = {'pos': torch.from_numpy(pos), 'neg': torch.from_numpy(neg),
+                   'regr': torch.from_numpy(regr.reshape(-1, 4)[pos]),
+                   'pos_offsets': torch.tensor([0, pos.size]), 'neg_offsets': torch.tensor([0, neg.size])}
+        flipped = augment.flip_targets(targets, torch.tensor([True]))
+        pos_m = np.flatnonzero(label_m.reshape(-1) == 1)
+        common, a, b = np.intersect1d(flipped['pos'].numpy(), pos_m, return_indices=True)
+        assert np.allclose(flipped['regr'].numpy()[a], regr_m.reshape(-1, 4)[pos_m][b], atol=1e-5), "mirrored regression differs"
+        same_pos += common.size
+        total_pos += max(pos.size, pos_m.size)
+        same_neg += np.intersect1d(flipped['neg'].numpy(), np.flatnonzero(label_m.reshape(-1) == -1)).size / max(1, neg.size)
+    print("mirrored targets : {:.2f} % positives shared with the targets of the mirrored boxes , {:.2f} % negatives , regression equal".format(
+        100 * same_pos / total_pos, 100 * same_neg / n))
+
+    # the tensor ops vs ImageEnhance, fixed factors
+    pil = [Image.open(images[i]).convert('RGB') for i in range(n)]
+    batch = torch.stack([torch.from_numpy(np.array(im)).permute(2, 0, 1) for im in pil]).float() / 255
+    ones = torch.ones(n)
+    ops = {
+        'Sharpness(1/8)': (lambda im: ImageEnhance.Sharpness(im).enhance(1 / 8), lambda x: adjust_sharpness(x, ones / 8)),
+        'Brightness(0.7)': (lambda im: ImageEnhance.Brightness(im).enhance(0.7), lambda x: blend(torch.zeros_like(x), x, ones * 0.7)),
+        'Contrast(0.7)': (lambda im: ImageEnhance.Contrast(im).enhance(0.7),
+                          lambda x: blend(grayscale(x).mean((1, 2, 3), keepdim=True).expand_as(x), x, ones * 0.7)),
+        'Color(0.7)': (lambda im: ImageEnhance.Color(im).enhance(0.7), lambda x: blend(grayscale(x).expand_as(x), x, ones * 0.7)),
+    }
+    for name, (pil_op, tensor_op) in ops.items():
+        expected = torch.stack([torch.from_numpy(np.asarray(pil_op(im))).permute(2, 0, 1) for im in pil]).float()
+        diff = (tensor_op(batch) * 255 - expected).abs()
+        print("{:16s} : mean abs difference to ImageEnhance {:.3f} , max {:.1f} (0-255)".format(name, diff.mean().item(), diff.max().item()))
+
+    # whole stage on a batch
+    transform = Transform(train=True, resize_size=(HEIGHT, WIDTH))
+    boxes = [objects[i]['boxes'] for i in range(n)]
+
+    def per_image():
+        out = []
+        for im, bx in zip(pil, boxes):
+            image, _ = transform.apply_transform(im, bx)
+            out.append(transform.normalize(transform.to_tensor(image)))
+        return torch.stack(out)
+
+    empty = {'pos': torch.zeros(0, dtype=torch.int32), 'neg': torch.zeros(0, dtype=torch.int32), 'regr': torch.zeros(0, 4),
+             'pos_offsets': torch.zeros(n + 1, dtype=torch.long), 'neg_offsets': torch.zeros(n + 1, dtype=torch.long)}
+    uint8 = (batch * 255).round().to(torch.uint8)
+    t_pil, _ = timeit(per_image)
+    t_batch, _ = timeit(lambda: augment(uint8, [torch.tensor(b) for b in boxes], empty))
+    print("batch of {} : PIL per image (flip + ImageEnhance + to_tensor + normalize) {:8.2f} ms | BatchAugment {:7.2f} ms".format(
+        n, 1000 * t_pil, 1000 * t_batch))
+
+    # what leaves the DataLoader workers : one __getitem__ with and without the PIL augmentation
+    for augment in ('pil', 'batch'):
+        dataset = make_dataset('TRAIN', rpm, augment=augment)
+        t, _ = timeit(quiet(lambda: [dataset[i] for i in range(n)]))
+        print("Dataset(augment={!r:7s}) : {:7.2f} ms per sample in the worker".format(augment, 1000 * t / n))
+
+
+########################################################################################################################
+# diag : cost of the disabled / rate limited diagnostics vs print, counters summed over DataLoader workers
+########################################################################################################################
+def bench_diag(args):
+    import torch
+    import diag
+    from torch.utils.data import DataLoader
+    from dataset import collate_fn
+    n_calls = 100000
+    X = np.zeros((4, 32, 32))
+
+    def per_call(fn):
+        t, _ = timeit(lambda: [fn() for _ in range(n_calls)])
+        return 1e9 * t / n_calls
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        t_print = per_call(lambda: print("Tools.py -> apply_regr_np", X.shape, X.shape))
+        diag.configure(log_level='off')
+        t_off = per_call(lambda: diag.log(diag.DEBUG, "tools.apply_regr_np", "{} {}", X.shape, X.shape))
+        t_count_off = per_call(lambda: diag.count('nms.boxes_in', 10))
+        diag.configure(log_level='debug', log_interval=1.0)
+        t_limited = per_call(lambda: diag.log(diag.DEBUG, "tools.apply_regr_np", "{} {}", X.shape, X.shape))
+        diag.configure(log_level='off')
+    diag.enable_stats(num_workers=0)
+    t_count_on = per_call(lambda: diag.count('nms.boxes_in', 10))
+    diag._stats = None
+    print("per call : print {:6.0f} ns | log disabled {:4.0f} ns | log rate limited {:5.0f} ns | count disabled {:4.0f} ns , enabled {:5.0f} ns".format(
+        t_print, t_off, t_limited, t_count_off, t_count_on))
+
+    # every worker writes its own row, flush sums them 
+    # (spawned workers like main.py, the table only reaches them through diag.worker_init)
+    workers = 2
+    dataset = make_dataset('TRAIN')
+    n = len(dataset) if args.num_images is None else min(args.num_images, len(dataset))
+    diag.enable_stats(num_workers=workers)
+    loader = DataLoader(torch.utils.data.Subset(dataset, range(n)), batch_size=2, num_workers=workers, collate_fn=collate_fn,
+                        worker_init_fn=diag.worker_init(), multiprocessing_context='spawn')
+    pos = 0
+    for _, _, _, _, num_pos in loader:
+        pos += sum(num_pos) if isinstance(num_pos, (list, tuple)) else int(num_pos.sum())
+    counters, _ = diag.flush(1, 1)
+    rows = (diag._stats.values[:, diag._stats.counter_slot['rpn.images']] > 0).sum()
+    diag._stats = None
+    assert counters['rpn.images'] == n, counters
+    print("{} images over {} workers : rpn.images={} from {} rows , sampled positives {} <= rpn.pos_anchors {}".format(
+        n, workers, counters['rpn.images'], rows, pos, counters['rpn.pos_anchors']))
+
+
+########################################################################################################################
+# annotations : streaming converter and memory-mapped annotation store vs the json lists
+########################################################################################################################
+def make_bbbc041_json(path, num_images, boxes_per_image=20, num_degenerate=0, seed=0):
+    # BBBC041 layout (one line, like training.json), num_degenerate boxes have xmin == xmax 
+    rng = np.random.RandomState(seed)
+    categories = ['red blood cell', 'trophozoite', 'ring', 'difficult']
+    bad = set(rng.choice(num_images * boxes_per_image, num_degenerate, replace=False).tolist())
+    with open(path, 'w') as f:
+        f.write('[')
+        for i in range(num_images):
+            objects = []
+            for j in range(boxes_per_image):
+                r, c = rng.randint(0, 1000, 2).tolist()
+                h, w = rng.randint(20, 100, 2).tolist()
+                w = 0 if i * boxes_per_image + j in bad else w
+                objects.append({"bounding_box": {"minimum": {"r": r, "c": c}, "maximum": {"r": r + h, "c": c + w}},
+                                "category": categories[j % len(categories)]})
+            element = {"image": {"checksum": "0" * 32, "pathname": "/images/{:06d}.png".format(i), "shape": {"r": 1200, "c": 1600, "channels": 3}},
+                       "objects": objects}
+            f.write((', ' if i > 0 else '') + json.dumps(element))
+        f.write(']')
+    return path
+
+
+def bench_annotations(args):
+    import tracemalloc
+    from annotations import bbbc041_records, json_records, write_annotations, AnnotationStore, store_path
+    folder = tempfile.mkdtemp()
+    try:
+        # round trip of the sample set, then the Dataset on both backends 
+        for split in ('TRAIN', 'TEST'):
+            source = "YeastCellDataset/" + split.lower()
+            for name in ('_images.json', '_objects.json'):
+                shutil.copy(os.path.join(source, split + name), folder)
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                store = AnnotationStore(write_annotations(json_records(folder, split), store_path(folder, split)))
+            images = json.load(open(os.path.join(folder, split + '_images.json')))
+            objects = json.load(open(os.path.join(folder, split + '_objects.json')))
+            assert list(store.column('image')) == images
+            assert all(store.objects(i)['labels'] == objects[i]['labels'] and
+                       np.array_equal(np.float32(store.objects(i)['boxes']), np.float32(objects[i]['boxes'])) for i in range(len(store)))
+
+            rpm = make_rpm()
+            t_json, json_dataset = timeit(lambda: make_dataset(split, rpm, folder=folder, annotations='json'))
+            t_store, store_dataset = timeit(lambda: make_dataset(split, rpm, folder=folder, annotations='store'))
+            assert all(json_dataset.read_objects(i) == store_dataset.read_objects(i) for i in range(len(json_dataset)))
+            print("{:5s} : {} images equal after the round trip | Dataset() json {:6.2f} ms , store {:6.2f} ms | annotations pickled for a worker : json {:6d} B , store {:4d} B".format(
+                split, len(store), 1000 * t_json, 1000 * t_store, 
+                len(pickle.dumps((json_dataset.images, json_dataset.objects))), len(pickle.dumps((store_dataset.images, store_dataset.objects)))))
+
+        # BBBC041 sized source : streaming vs json.load of the whole file 
+        num_images = 1328 if args.num_images is None else args.num_images
+        source = make_bbbc041_json(os.path.join(folder, "training.json"), num_images, num_degenerate=7)
+        label_map = {k: v for v, k in enumerate(('schizont', 'gametocyte', 'trophozoite', 'red blood cell', 'difficult', 'ring', 'leukocyte', 'bg'))}
+
+        def load_all():
+            data = json.load(open(source))
+            return [(e["image"]["pathname"], [[o["bounding_box"]["minimum"]["c"], o["bounding_box"]["minimum"]["r"],
+                                                o["bounding_box"]["maximum"]["c"], o["bounding_box"]["maximum"]["r"]] for o in e["objects"]],
+                     [label_map[o["category"]] for o in e["objects"]]) for e in data]
+
+        def peak(fn):
+            tracemalloc.start()
+            start = time.perf_counter()
+            out = fn()
+            elapsed = time.perf_counter() - start
+            peak_bytes = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            return elapsed, peak_bytes, out
+
+        t_load, m_load, _ = peak(load_all)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            t_stream, m_stream, path = peak(lambda: write_annotations(bbbc041_records(source, "", label_map), os.path.join(folder, "bbbc041")))
+        store = AnnotationStore(path)
+        assert store.key['dropped'] == 7, store.key
+        print("{} images , {:.1f} MB of json : json.load + lists {:7.2f} s , peak {:7.1f} MB | streamed to the store {:7.2f} s , peak {:6.1f} MB , {} degenerate boxes dropped ({})".format(
+            num_images, os.path.getsize(source) / 2 ** 20, t_load, m_load / 2 ** 20, t_stream, m_stream / 2 ** 20, store.key['dropped'],
+            "; ".join(str(w.message) for w in caught)))
+    finally:
+        shutil.rmtree(folder)
+
+
+########################################################################################################################
+# shards : packed sequential shards + streaming reader vs random access to the image files
+########################################################################################################################
+def bench_shards(args):
+    import torch
+    from torch.utils.data import DataLoader
+    from dataset import collate_fn
+    from shards import build_shards, ShardDataset
+    folder = tempfile.mkdtemp()
+    try:
+        rpm = make_rpm()
+        # TEST : no augmentation, the samples can be compared 
+        test = make_dataset('TEST', rpm)
+        path = build_shards(test, folder, shard_bytes=1 << 20)
+        stream = ShardDataset(test, path, shuffle=False)
+        for i, sample in enumerate(stream):
+            random.seed(i)
+            a = quiet(test.__getitem__)(i)
+            random.seed(i)
+            b = quiet(stream.load)(*next(r for r in stream.records(int(stream.index['shard'][i])) if r[0] == i))
+            assert torch.equal(sample[0], a[0]) and torch.equal(sample[1], a[1]) and sample[2] == a[2]
+            assert all(torch.equal(a[3][k], b[3][k]) for k in a[3])
+        print("TEST : {} samples from {} shards equal to Dataset.__getitem__".format(len(stream), stream.num_shards))
+
+        # every record once per epoch, over the workers, in a new order each epoch 
+        train = make_dataset('TRAIN', rpm)
+        shard_bytes = 2 << 20
+        path = build_shards(train, folder, shard_bytes=shard_bytes)
+        stream = ShardDataset(train, path, buffer_size=4, seed=args.seed)
+        orders = []
+        for epoch in range(2):
+            stream.set_epoch(epoch)
+            loader = DataLoader(stream, batch_size=1, num_workers=2, collate_fn=collate_fn)
+            orders.append([len(boxes[0]) for _, boxes, _, _, _ in quiet(list)(loader)])
+        expected = sorted(len(train.objects[i]['boxes']) for i in range(len(train)))
+        assert sorted(orders[0]) == expected and sorted(orders[1]) == expected
+        print("TRAIN : {} shards of <= {} MB , 2 workers : every record once per epoch , order changed between epochs {}".format(
+            stream.num_shards, shard_bytes >> 20, orders[0] != orders[1]))
+
+        # file system work of one epoch : one open per image vs per shard 
+        def random_access():
+            for i in np.random.permutation(len(train)).tolist():
+                with open(train.images[i], 'rb') as f:
+                    f.read()
+        def sequential():
+            for shard in range(stream.num_shards):
+                for _ in stream.records(shard):
+                    pass
+        t_random, _ = timeit(random_access)
+        t_sequential, _ = timeit(sequential)
+        print("read of an epoch (page cache warm) : random Image files {:6.2f} ms , {} opens | shards {:6.2f} ms , {} opens".format(
+            1000 * t_random, len(train), 1000 * t_sequential, stream.num_shards))
+        t_dataset, _ = timeit(quiet(lambda: [train[i] for i in np.random.permutation(len(train)).tolist()]), repeat=1)
+        stream.set_epoch(0)
+        t_stream, _ = timeit(quiet(lambda: list(stream)), repeat=1)
+        print("epoch in process : Dataset {:6.2f} s | ShardDataset {:6.2f} s".format(t_dataset, t_stream))
+    finally:
+        shutil.rmtree(folder)
+
+
+########################################################################################################################
+# aspect ratio buckets : bucketed batches with per bucket anchors vs squashing every frame to HEIGHT x WIDTH
+########################################################################################################################
+def bench_buckets(args):
+    import torch
+    from torch.utils.data import DataLoader
+    from dataset import collate_fn, AspectRatioBatchSampler
+    from model import Model_RPN
+    from tools import bucket_sizes, rpn_to_roi_batch
+    num_images = args.num_images or 6
+    folder = tempfile.mkdtemp()
+    try:
+        # 4:3 microscope frames and square crops in one set 
+        paths, objects = [], []
+        for name, size in (('wide', (1024, 768)), ('square', (512, 512))):
+            sub = os.path.join(folder, name)
+            os.makedirs(sub)
+            make_jpeg_folder(sub, size=size, num_images=num_images)
+            paths += json.load(open(os.path.join(sub, 'TRAIN_images.json')))
+            objects += json.load(open(os.path.join(sub, 'TRAIN_objects.json')))
+        json.dump(paths, open(os.path.join(folder, 'TRAIN_images.json'), 'w'))
+        json.dump(objects, open(os.path.join(folder, 'TRAIN_objects.json'), 'w'))
+
+        # registry anchors, RPM.anchors_for builds the ones of the other buckets 
+        rpm = RPM(ANCHOR_SIZES, ANCHOR_RATIOS, get_anchors(HEIGHT, WIDTH, ANCHOR_SIZES, ANCHOR_RATIOS), REV_LABEL_MAP, 
+                  rpn_max_overlap=0.7, rpn_min_overlap=0.2, num_regions=500)
+        buckets = bucket_sizes(HEIGHT, WIDTH, (1.0, 4 / 3))
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UserWarning)
+            model_rpn = Model_RPN(num_anchors=len(ANCHOR_SIZES) * len(ANCHOR_RATIOS), pretrained=False)
+
+        for name, kwargs in (('squashed to {}x{}'.format(HEIGHT, WIDTH), {}), ('buckets {}'.format(buckets), {'buckets': buckets})):
+            dataset = make_dataset('TRAIN', rpm, folder=folder, augment='batch', **kwargs)
+            if dataset.bucket is not None:
+                sampler = AspectRatioBatchSampler(dataset.bucket, batch_size=2, seed=args.seed)
+                loader = DataLoader(dataset, batch_sampler=sampler, collate_fn=collate_fn)
+            else:
+                loader = DataLoader(dataset, batch_size=2, shuffle=True, collate_fn=collate_fn, drop_last=True)
+
+            pixels, distortion, seen, t_step = 0, [], 0, 0.0
+            for image, boxes, labels, targets, _ in quiet(list)(loader):
+                h, w = image.shape[2:]
+                grid = rpm.anchors_for((h, w)).grid_tensor()
+                assert int(targets['pos'].max()) < grid[0].numel() and int(targets['neg'].max()) < grid[0].numel()
+                pixels += image.size(0) * h * w
+                seen += image.size(0)
+                start = time.perf_counter()
+                base_x, cls_k, reg_k = model_rpn(image)
+                (cls_k.mean() + reg_k.mean()).backward()
+                rpn_to_roi_batch(cls_k.detach(), reg_k.detach(), grid)
+                t_step += time.perf_counter() - start
+                assert cls_k.shape[1:3] == grid.shape[1:3]
+            for i in range(len(dataset)):
+                orig = (1024, 768) if i < num_images else (512, 512)
+                h, w = dataset.resize_size_for(i)
+                distortion.append(abs(math.log((w / h) / (orig[0] / orig[1]))))
+            print("{:38s} : {} images , {:5.2f} Mpixels , mean aspect distortion {:5.1f} % , rpn fwd / bwd + proposals {:6.0f} ms / image".format(
+                name, seen, pixels / 1e6, 100 * (math.exp(np.mean(distortion)) - 1), 1000 * t_step / seen))
+
+        # the targets of a bucket come from the anchors of its size 
+        dataset = make_dataset('TRAIN', rpm, folder=folder, buckets=buckets)
+        i = int(np.flatnonzero(dataset.bucket == 1)[0])
+        boxes, labels = dataset.read_objects(i)
+        boxes = dataset.transform_for(i).resize_boxes(boxes, (1024, 768))
+        label, _ = rpm.calc_rpn_targets(boxes, labels, image_resize_size=buckets[1])
+        anchors = get_anchors(buckets[1][0], buckets[1][1], ANCHOR_SIZES, ANCHOR_RATIOS)
+        assert label.shape == anchors.grid.shape[1:]
+        print("bucket {} : targets on a {} feature map , {} valid anchors (vs {} at {}x{})".format(
+            buckets[1], label.shape[:2], anchors.valid_boxes.shape[0], rpm.anchor_boxes.shape[0], HEIGHT, WIDTH))
+    finally:
+        shutil.rmtree(folder)
+
+
+########################################################################################################################
+# prefetch.DevicePrefetcher : next batches loaded in a background thread while the step runs
+########################################################################################################################
+def bench_prefetch(args):
+    import torch
+    from torch.utils.data import DataLoader
+    from dataset import collate_fn
+    from prefetch import DevicePrefetcher
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    dataset = make_dataset('TRAIN')
+    n = len(dataset) if args.num_images is None else min(args.num_images, len(dataset))
+    subset = torch.utils.data.Subset(dataset, range(n))
+    batch_size = 2
+    loader = DataLoader(subset, batch_size=batch_size, num_workers=0, collate_fn=collate_fn)
+
+    # load time of a batch in this process, the step below lasts about as long 
+    t_load, _ = timeit(quiet(lambda: list(loader)), repeat=1)
+    step_time = t_load / len(loader)
+
+    def epoch(batches):
+        # the step stands in for the gpu work of a training step (the cpu is free meanwhile) 
+        start = time.perf_counter()
+        for image, boxes, labels, targets, num_pos in batches:
+            image = image.to(device)
+            targets = {k: v.to(device) for k, v in targets.items()}
+            time.sleep(step_time)
+        return time.perf_counter() - start
+
+    t_plain = quiet(epoch)(loader)
+    print("{} batches of {} , load {:6.1f} ms / batch , step {:6.1f} ms / batch".format(len(loader), batch_size, 1000 * step_time, 1000 * step_time))
+    print("no prefetch        : epoch {:6.2f} s".format(t_plain))
+    for depth in (1, 2, 4):
+        prefetcher = DevicePrefetcher(loader, device, depth=depth)
+        t = quiet(epoch)(prefetcher)
+        stats = prefetcher.stats()
+        print("prefetch depth {}   : epoch {:6.2f} s , waited on data {:6.1f} ms / batch (max {:6.1f} ms)".format(
+            depth, t, 1000 * stats['wait_per_batch'], 1000 * stats['max_wait']))
+
+    # same batches, and breaking out of an epoch stops the thread 
+    # (train augmentation is random, same seed for both)
+    random.seed(0)
+    plain = quiet(list)(loader)
+    random.seed(0)
+    for a, b in zip(plain, quiet(list)(DevicePrefetcher(loader, device))):
+        assert torch.equal(a[0], b[0].cpu()) and all(torch.equal(x, y.cpu()) for x, y in zip(a[1], b[1]))
+    prefetcher = DevicePrefetcher(loader, device, depth=2)
+    for _ in quiet(iter)(prefetcher):
+        break
+    print("batches equal to the DataLoader's , early break ok ({} threads alive)".format(
+        sum(1 for t in __import__('threading').enumerate() if t.daemon)))
+
+
+########################################################################################################################
+# slabs.SlabCollate : batches written into preallocated shared memory slabs vs collate_fn
+########################################################################################################################
+class CachedSamples(object):
+    # the samples of a dataset decoded once, cycled : the benchmark measures the collate and the transfer only
+    def __init__(self, samples, length):
+        self.samples = samples
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        return self.samples[i % len(self.samples)]
+
+
+def bench_slabs(args):
+    import torch
+    from multiprocessing.reduction import ForkingPickler
+    from torch.utils.data import DataLoader
+    from dataset import collate_fn
+    from prefetch import map_tensors
+    from slabs import SlabPool , SlabCollate , SlabLoader , num_slots
+    dataset = make_dataset('TEST')
+    n = len(dataset) if args.num_images is None else min(args.num_images, len(dataset))
+    samples = [quiet(dataset.__getitem__)(i) for i in range(n)]
+    num_batches, num_workers, prefetch_factor = 8, 1, 2
+
+    def leaves(batch):
+        tensors = []
+        map_tensors(batch, lambda t, path: tensors.append(t))
+        return tensors
+
+    def equal(a, b):
+        return all(torch.equal(x, y) for x, y in zip(leaves(a), leaves(b))) and a[2] == b[2] and a[4] == b[4]
+
+    print("{} workers , {} batches per run".format(num_workers, num_batches))
+    print("batch | sent by the worker : collate_fn pickle, copied to shm, segments | slabs pickle | ms / batch : collate_fn   slabs")
+    for batch_size in (2, 8, 32):
+        batch = [samples[i % n] for i in range(batch_size)]
+        plain = collate_fn(batch)
+        # tensors of the batch, the labels (python lists in collate_fn) as int64 and the alignment
+        slab_bytes = sum(t.numel() * t.element_size() for t in leaves(plain)) + 8 * sum(len(l) for l in plain[2]) + 64 * 8
+        pool = SlabPool(num_slots(num_workers, prefetch_factor), slab_bytes)
+
+        # what goes through the worker ==> main process queue (the tensors of a plain batch move to shared memory on pickling)
+        tensors = leaves(plain)
+        plain_pickle = len(ForkingPickler.dumps(plain))
+        copied = sum(t.numel() * t.element_size() for t in tensors)
+        handle = SlabCollate(pool)(batch)
+        assert equal(pool.unpack(handle), plain)
+        slab_pickle = len(ForkingPickler.dumps(handle))
+        pool.release(handle.slot)
+
+        data = CachedSamples(samples, num_batches * batch_size)
+        def run(loader):
+            start = time.perf_counter()
+            for b in loader:
+                pass
+            return (time.perf_counter() - start) / num_batches
+        t_plain = run(DataLoader(data, batch_size=batch_size, collate_fn=collate_fn, num_workers=num_workers, prefetch_factor=prefetch_factor))
+        loader = DataLoader(data, batch_size=batch_size, collate_fn=SlabCollate(pool), num_workers=num_workers, prefetch_factor=prefetch_factor)
+        t_slab = run(SlabLoader(loader, pool))
+        for a, b in zip(SlabLoader(loader, pool), DataLoader(data, batch_size=batch_size, collate_fn=collate_fn)):
+            assert equal(a, b)
+        assert int(pool.free.sum()) == len(pool)
+        print("{:5d} | {:10d} B {:10.1f} MB {:4d} | {:6d} B | {:8.1f}   {:8.1f}".format(
+            batch_size, plain_pickle, copied / 2 ** 20, len(tensors), slab_pickle, 1000 * t_plain, 1000 * t_slab))
+    print("batches equal to collate_fn's , all the slabs released")
+
+
+########################################################################################################################
+# dataset.Dataset.__getitems__ : batch fetch (thread pool decode, batched RPN targets) vs __getitem__ + collate_fn
+########################################################################################################################
+def bench_getitems(args):
+    import torch
+    from torch.utils.data import DataLoader
+    from dataset import collate_fn , image_sizes
+    from slabs import SlabPool , SlabCollate , SlabLoader
+    batch_size = 4
+
+    # without augmentation the samples are the same (same subsampling draws, in the same order)
+    per_sample = make_dataset('TEST')
+    batched = make_dataset('TEST', fetch_threads=2)
+    n = len(per_sample) if args.num_images is None else min(args.num_images, len(per_sample))
+    indices = list(range(min(n, batch_size)))
+    random.seed(0)
+    a = quiet(collate_fn)([per_sample[i] for i in indices])
+    random.seed(0)
+    b = quiet(collate_fn)(batched.__getitems__(indices))
+    assert torch.equal(a[0], b[0]) and a[2] == b[2] and a[4] == b[4]
+    assert all(torch.equal(x, y) for x, y in zip(a[1], b[1]))
+    assert all(torch.equal(a[3][k], b[3][k]) for k in a[3])
+    # and through the shared memory slabs
+    pool = SlabPool(2, 64 << 20)
+    random.seed(0)
+    c = next(iter(SlabLoader(DataLoader(torch.utils.data.Subset(batched, indices), batch_size=len(indices), collate_fn=SlabCollate(pool)), pool)))
+    assert torch.equal(a[0], c[0]) and all(torch.equal(a[3][k], c[3][k]) for k in a[3])
+    print("__getitems__ batch equal to __getitem__ + collate_fn (TEST, no augmentation) , also through SlabCollate")
+
+    # the IoU blocks of calc_rpn_targets_batch, from one image per block to the whole batch in one
+    import tools
+    rpm = per_sample.rpm
+    sizes = image_sizes(per_sample)
+    boxes = [per_sample.transform.resize_boxes(per_sample.objects[i]['boxes'], tuple(sizes[i])) for i in range(n)]
+    labels = [per_sample.read_objects(i)[1] for i in range(n)]
+    single = [rpm.calc_rpn_targets(bx, lb, image_resize_size=(HEIGHT, WIDTH)) for bx, lb in zip(boxes, labels)]
+    default = tools.IOU_BLOCK
+    for block in (1, default, 1 << 20):
+        tools.IOU_BLOCK = block
+        t, batch = timeit(lambda: rpm.calc_rpn_targets_batch(boxes, labels, image_resize_size=(HEIGHT, WIDTH)), repeat=1)
+        assert all(np.array_equal(x[0], y[0]) and np.array_equal(x[1], y[1]) for x, y in zip(single, batch))
+        print("calc_rpn_targets_batch IOU_BLOCK {:8d} : {:6.1f} ms / image , same targets as calc_rpn_targets".format(block, 1000 * t / n))
+    tools.IOU_BLOCK = default
+
+    # train epochs, ms per image
+    for workers in (0, 1, 2):
+        row = []
+        for threads in (0, 2, 4):
+            dataset = make_dataset('TRAIN', fetch_threads=threads)
+            data = torch.utils.data.Subset(dataset, range(n))
+            loader = DataLoader(data, batch_size=batch_size, collate_fn=collate_fn, num_workers=workers, drop_last=True)
+            t, _ = timeit(quiet(lambda: list(loader)), repeat=2)
+            row.append("fetch_threads {} {:7.1f}".format(threads, 1000 * t / (len(loader) * batch_size)))
+        print("workers {} : ".format(workers) + " | ".join(row) + " ms / image")
+    print("({} cpus)".format(os.cpu_count()))
+
+
+########################################################################################################################
+# infer.py : batched inference of a checkpoint (untrained models here)
+########################################################################################################################
+def bench_infer(args):
+    import torch
+    from model import Model_RPN , Classifier
+    from utils import save_checkpoint
+    import infer
+    torch.manual_seed(args.seed)
+    folder = tempfile.mkdtemp()
+    try:
+        model_rpn = Model_RPN(num_anchors=len(ANCHOR_SIZES) * len(ANCHOR_RATIOS), pretrained=False)
+        model_classifier = Classifier(num_classes=len(REV_LABEL_MAP))
+        quiet(save_checkpoint)(0, model_rpn, model_classifier, None, None, 0.0, save_dir=folder + "/")
+        images = infer.list_images(["YeastCellDataset/test"])
+        if args.num_images is not None:
+            images = images[:args.num_images]
+        with open(os.path.join(folder, "images.txt"), 'w') as f:
+            f.write("\n".join(images))
+
+        # untrained classifier : every roi scores about 0.5, no score threshold to keep the NMS busy
+        outputs = {}
+        for batch_size, workers in ((1, 0), (4, 0), (4, 1)):
+            output = os.path.join(folder, "detections_{}_{}.jsonl".format(batch_size, workers))
+            cli = infer.parse_args([os.path.join(folder, "images.txt"), "-s", folder, "-o", output, "--batch-size", str(batch_size),
+                                    "--workers", str(workers), "--device", "cpu", "--score-thresh", "0"])
+            with contextlib.redirect_stderr(io.StringIO()):
+                stats = infer.run(cli)
+            with open(output, 'r') as f:
+                outputs[batch_size, workers] = [json.loads(line) for line in f]
+            num = sum(len(d['boxes']) for d in outputs[batch_size, workers])
+            print("batch {} , workers {} : {:5.2f} images / s ({} images timed) , {} detections".format(
+                batch_size, workers, stats['images_per_sec'], stats['timed_images'], num))
+
+        # same detections whatever the batching (up to float noise of the batched convolutions)
+        ref = outputs[1, 0]
+        for key, out in outputs.items():
+            assert [d['image'] for d in out] == [d['image'] for d in ref]
+            for a, b in zip(out, ref):
+                assert len(a['boxes']) == len(b['boxes']) and a['labels'] == b['labels']
+                assert np.allclose(np.array(a['boxes']).reshape(-1, 4), np.array(b['boxes']).reshape(-1, 4), atol=0.5)
+        print("detections of {} images agree across batch sizes / workers".format(len(ref)))
+    finally:
+        shutil.rmtree(folder)
+
+
+########################################################################################################################
+# infer.py --tile : full resolution frames cut in overlapping tiles, merged across the seams
+########################################################################################################################
+def peak_rss_reset():
+    # resets the peak resident set size of this process (VmHWM), False if the kernel does not allow it
+    try:
+        with open("/proc/self/clear_refs", 'w') as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss():
+    with open("/proc/self/status", 'r') as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def bench_tiles(args):
+    import torch
+    from PIL import Image
+    from model import Model_RPN , Classifier
+    from utils import save_checkpoint
+    import infer
+
+    # cores split an axis into consecutive ranges, each inside its tile
+    for length in (100, 512, 513, 1000, 3024, 4032):
+        starts, cores = infer.tile_origins(length, 512, 64)
+        assert cores[0][0] == -math.inf and cores[-1][1] == math.inf
+        assert all(a[1] == b[0] for a, b in zip(cores, cores[1:]))
+        assert all(s <= c0 and c1 <= s + 512 for s, (c0, c1) in zip(starts, cores) if math.isfinite(c0) and math.isfinite(c1))
+    print("tile cores partition the frame")
+
+    torch.manual_seed(args.seed)
+    folder = tempfile.mkdtemp()
+    try:
+        model_rpn = Model_RPN(num_anchors=len(ANCHOR_SIZES) * len(ANCHOR_RATIOS), pretrained=False)
+        model_classifier = Classifier(num_classes=len(REV_LABEL_MAP))
+        quiet(save_checkpoint)(0, model_rpn, model_classifier, None, None, 0.0, save_dir=folder + "/")
+        images = infer.list_images(["YeastCellDataset/test"])[:args.num_images or 2]
+
+        def run(inputs, output, *extra):
+            cli = infer.parse_args(inputs + ["-s", folder, "-o", output, "--workers", "0", "--device", "cpu", "--score-thresh", "0"] + list(extra))
+            with contextlib.redirect_stderr(io.StringIO()):
+                stats = infer.run(cli)
+            with open(output, 'r') as f:
+                return stats, [json.loads(line) for line in f]
+
+        # a frame that fits in one tile : same detections as the plain inference
+        _, plain = run(images, os.path.join(folder, "plain.jsonl"))
+        _, tiled = run(images, os.path.join(folder, "tiled.jsonl"), "--tile")
+        def rows(d):
+            # detections with equal scores may come in any order
+            return sorted(zip(d['scores'], d['labels'], [tuple(np.round(b, 1)) for b in np.array(d['boxes']).reshape(-1, 4)]))
+        assert [rows(a) for a in plain] == [rows(b) for b in tiled]
+        print("one tile frames : same detections as without --tile")
+
+        # a 2048 x 1536 mosaic of the test images (the BBBC041 frames are 1600 x 1200 , the yeast ones 4032 x 3024)
+        mosaic = Image.new('RGB', (2048, 1536))
+        for k in range(12):
+            with Image.open(images[k % len(images)]) as image:
+                tile = Image.fromarray((np.asarray(image, dtype=np.float64) / max(1, np.asarray(image).max()) * 255).astype(np.uint8)).convert('RGB')
+            mosaic.paste(tile, ((k % 4) * 512, (k // 4) * 512))
+        mosaic_path = os.path.join(folder, "mosaic.png")
+        mosaic.save(mosaic_path)
+        starts_x, _ = infer.tile_origins(2048, 512, 64)
+        starts_y, _ = infer.tile_origins(1536, 512, 64)
+        num_tiles = len(starts_x) * len(starts_y)
+        print("2048 x 1536 frame , {} tiles of 512 x 512 (overlap 64) , whole frame as float tiles {:.0f} MB".format(
+            num_tiles, num_tiles * 3 * 512 * 512 * 4 / 2 ** 20))
+        for tile_batch in (1, 4, 8):
+            reset = peak_rss_reset()
+            before = peak_rss()
+            stats, out = run([mosaic_path] * 2, os.path.join(folder, "mosaic.jsonl"), "--tile", "--tile-batch", str(tile_batch))
+            peak = "peak rss +{:6.0f} MB".format((peak_rss() - before) / 2 ** 20) if reset else "peak rss n/a"
+            print("tile batch {:2d} : {:5.2f} tiles / s , {} , {} detections".format(tile_batch, stats['tiles_per_sec'], peak, len(out[0]['boxes'])))
+        _, fused = run([mosaic_path], os.path.join(folder, "fusion.jsonl"), "--tile", "--tile-merge", "fusion")
+        print("fusion merge : {} detections".format(len(fused[0]['boxes'])))
+    finally:
+        shutil.rmtree(folder)
+
+
+########################################################################################################################
+# detector.py / runtime.py : the whole detection as one TorchScript graph, started without the training code
+########################################################################################################################
+COLD_EAGER = """
+import time, sys
+start = time.perf_counter()
+import torch
+import infer
+from tools import get_anchors
+imported = time.perf_counter() - start
+model_rpn, model_classifier = infer.load_models(sys.argv[1])
+grid = get_anchors({height}, {width}, {sizes}, {ratios}).grid_tensor()
+image = infer.ImageList([sys.argv[2]], ({height}, {width}))[0][0]
+loaded = time.perf_counter() - start
+infer.detect(model_rpn, model_classifier, image[None], grid, bg_class=1)
+print(imported, loaded, time.perf_counter() - start, 'torchvision' in sys.modules, 'matplotlib' in sys.modules)
+"""
+
+COLD_SCRIPTED = """
+import time, sys
+start = time.perf_counter()
+import torch
+import runtime
+imported = time.perf_counter() - start
+detector, config = runtime.load_detector(sys.argv[1])
+image = runtime.read_image(sys.argv[2], config['height'], config['width'])[0]
+loaded = time.perf_counter() - start
+with torch.no_grad():
+    detector(image[None])
+print(imported, loaded, time.perf_counter() - start, 'torchvision' in sys.modules, 'matplotlib' in sys.modules)
+"""
+
+
+def cold_start(script, *argv, repeat=3):
+    # median (import, load, first detection) seconds of a fresh interpreter, and the modules it pulled in
+    import subprocess
+    import sys
+    runs = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, "-c", script] + list(argv), capture_output=True, text=True, check=True).stdout.split()
+        runs.append(out)
+    times = np.median(np.array([[float(v) for v in r[:3]] for r in runs]), 0)
+    return times, runs[0][3] == 'True', runs[0][4] == 'True'
+
+
+def bench_detector(args):
+    import torch
+    from model import Model_RPN , Classifier
+    from utils import save_checkpoint
+    import infer
+    import detector
+    import runtime
+    torch.manual_seed(args.seed)
+    folder = tempfile.mkdtemp()
+    try:
+        model_rpn = Model_RPN(num_anchors=len(ANCHOR_SIZES) * len(ANCHOR_RATIOS), pretrained=False)
+        model_classifier = Classifier(num_classes=len(REV_LABEL_MAP))
+        quiet(save_checkpoint)(0, model_rpn, model_classifier, None, None, 0.0, save_dir=folder + "/")
+        images = infer.list_images(["YeastCellDataset/test"])[:args.num_images or 4]
+
+        # untrained classifier : no score threshold to keep the NMS busy
+        eager = detector.build_detector(folder + "/", HEIGHT, WIDTH, anchor_sizes=ANCHOR_SIZES, anchor_ratios=ANCHOR_RATIOS, score_thresh=0.0)
+        paths = {}
+        for freeze in (False, True):
+            paths[freeze] = os.path.join(folder, "detector_{}.pt".format('frozen' if freeze else 'scripted'))
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                detector.export_detector(eager, paths[freeze], freeze=freeze)
+        scripted, config = runtime.load_detector(paths[False])
+        frozen, _ = runtime.load_detector(paths[True])
+        assert (config['height'], config['width'], config['labels']) == (HEIGHT, WIDTH, ['yeast_cell', 'bg'])
+
+        # the graph runs the code of infer.detect : same detections, up to the float noise of freezing (folded weights)
+        floats = torch.stack([infer.ImageList([p], (HEIGHT, WIDTH))[0][0] for p in images])
+        uint8 = torch.stack([runtime.read_image(p, HEIGHT, WIDTH)[0] for p in images])
+        grid = eager.grid
+        model_rpn, model_classifier = infer.load_models(folder + "/")
+        with torch.no_grad():
+            ref = infer.detect(model_rpn, model_classifier, floats, grid, bg_class=1, score_thresh=0.0)
+            for name, module, tol in (('eager Detector', eager, 0.0), ('scripted', scripted, 0.0), ('frozen', frozen, 0.05)):
+                out = module(floats)
+                assert torch.equal(out[3], ref[3]) and torch.equal(out[2], ref[2])
+                assert torch.allclose(out[0], ref[0], atol=tol) and torch.allclose(out[1], ref[1], atol=tol)
+                print("{:15s}: same detections as infer.detect on {} images (atol {})".format(name, len(images), tol))
+            # uint8 input normalized in the graph : ToTensor + Normalize up to rounding
+            out = scripted(uint8)
+            assert torch.equal(out[3], ref[3]) and torch.allclose(out[0], ref[0], atol=0.5)
+            print("uint8 input    : same detections as the normalized float input")
+
+        print("cold start (fresh interpreter, median of 3) :       import |   + load | + 1st image | torchvision | matplotlib")
+        for name, script, path in (('eager', COLD_EAGER, folder + "/"), ('scripted', COLD_SCRIPTED, paths[False]), ('frozen', COLD_SCRIPTED, paths[True])):
+            script = script.format(height=HEIGHT, width=WIDTH, sizes=ANCHOR_SIZES, ratios=ANCHOR_RATIOS)
+            (imported, loaded, first), torchvision, matplotlib = cold_start(script, path, images[0])
+            print("    {:10s} {:37.2f} s | {:6.2f} s | {:9.2f} s | {!s:11s} | {!s}".format(name, imported, loaded, first, torchvision, matplotlib))
+
+        print("steady state latency (median of 10 calls after 3 warm up calls) :")
+        with torch.no_grad():
+            for batch_size in (1, 4):
+                x = floats[:batch_size].repeat(max(1, batch_size // len(floats)), 1, 1, 1)[:batch_size]
+                line = []
+                for name, fn in (('eager', lambda: infer.detect(model_rpn, model_classifier, x, grid, bg_class=1, score_thresh=0.0)),
+                                 ('scripted', lambda: scripted(x)), ('frozen', lambda: frozen(x))):
+                    for _ in range(3):
+                        fn()
+                    times = []
+                    for _ in range(10):
+                        start = time.perf_counter()
+                        fn()
+                        times.append(time.perf_counter() - start)
+                    line.append("{} {:7.1f} ms".format(name, 1000 * np.median(times)))
+                print("    batch {} : {}".format(batch_size, " | ".join(line)))
+    finally:
+        shutil.rmtree(folder)
+
+
+########################################################################################################################
+# quantize.py : INT8 backbone (static, calibrated) and classifier dense layers (dynamic) for cpu inference
+########################################################################################################################
+def bench_quantize(args):
+    import torch
+    from model import Model_RPN , Classifier
+    from utils import save_checkpoint , load_checkpoint
+    import infer
+    import quantize
+    torch.manual_seed(args.seed)
+    folder = tempfile.mkdtemp()
+    try:
+        model_rpn = Model_RPN(num_anchors=len(ANCHOR_SIZES) * len(ANCHOR_RATIOS), pretrained=False)
+        model_classifier = Classifier(num_classes=len(REV_LABEL_MAP))
+        quiet(save_checkpoint)(0, model_rpn, model_classifier, None, None, 0.0, save_dir=folder + "/fp32/")
+        model_rpn, model_classifier = infer.load_models(folder + "/fp32/")
+        calibration = infer.list_images([DATA_FOLDER])[:8]
+        images = infer.list_images(["YeastCellDataset/test"])[:args.num_images or 4]
+        floats = torch.stack([infer.ImageList([p], (HEIGHT, WIDTH))[0][0] for p in images])
+
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            batches = [torch.stack([infer.ImageList([p], (HEIGHT, WIDTH))[0][0] for p in calibration[k:k + 4]]) for k in range(0, len(calibration), 4)]
+            int8_rpn = quantize.quantize_rpn(model_rpn, batches)
+            int8_classifier = quantize.quantize_classifier(model_classifier)
+            quiet(quantize.save_int8)(folder + "/int8/", load_checkpoint(folder + "/fp32/"), int8_rpn, int8_classifier, 'x86')
+            loaded_rpn, loaded_classifier = infer.load_models(folder + "/int8/")
+
+        with torch.no_grad():
+            # the checkpoint gives back the same int8 models
+            assert all(torch.equal(a, b) for a, b in zip(int8_rpn(floats), loaded_rpn(floats)))
+            print("int8 checkpoint : same outputs after save / load")
+
+            # error against fp32, calibrated on train images
+            ref, out = model_rpn(floats), int8_rpn(floats)
+            for name, a, b in (('features', ref[0], out[0]), ('objectness', ref[1], out[1]), ('rpn regression', ref[2], out[2])):
+                print("    {:15s}: relative error {:.4f} , max abs error {:.4f}".format(name, float((a - b).norm() / a.norm()), float((a - b).abs().max())))
+            rois = torch.cat([torch.zeros(64, 1), torch.randint(0, 16, (64, 2)).float(), torch.randint(16, 32, (64, 2)).float()], 1)
+            ref, out = model_classifier(ref[0], rois), int8_classifier(ref[0], rois)
+            print("    {:15s}: max abs error {:.4f} (class probabilities of 64 rois)".format('classifier', float((ref[0] - out[0]).abs().max())))
+
+            grid = get_anchors(HEIGHT, WIDTH, ANCHOR_SIZES, ANCHOR_RATIOS).grid_tensor()
+            print("latency (median of 5 after a warm up) and peak rss of one detect call :")
+            for batch_size in (1, 4):
+                x = floats[:batch_size].repeat(batch_size, 1, 1, 1)[:batch_size]
+                line = []
+                for name, (rpn, classifier) in (('fp32', (model_rpn, model_classifier)), ('int8', (loaded_rpn, loaded_classifier))):
+                    infer.detect(rpn, classifier, x, grid, bg_class=1, score_thresh=0.0)
+                    reset = peak_rss_reset()
+                    times = []
+                    for _ in range(5):
+                        start = time.perf_counter()
+                        infer.detect(rpn, classifier, x, grid, bg_class=1, score_thresh=0.0)
+                        times.append(time.perf_counter() - start)
+                    memory = " , peak rss {:5.0f} MB".format(peak_rss() / 2 ** 20) if reset else ""
+                    line.append("{} {:7.1f} ms{}".format(name, 1000 * np.median(times), memory))
+                print("    batch {} : {}".format(batch_size, " | ".join(line)))
+
+        # the report of quantize.py (untrained models : the detection agreement only shows the pipeline runs)
+        cli = quantize.parse_args(["-s", folder + "/fp32/", "-o", folder + "/int8_cli/", "--calibration", DATA_FOLDER,
+                                   "--eval"] + images + ["--score-thresh", "0"])
+        output = io.StringIO()
+        with contextlib.redirect_stderr(io.StringIO()), contextlib.redirect_stdout(output), warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            quantize.run(cli)
+        print("quantize.py report :")
+        for line in output.getvalue().splitlines():
+            if not line.startswith("Saving the model"):
+                print("    " + line)
+    finally:
+        shutil.rmtree(folder)
+
+
+########################################################################################################################
+# server.py / loadgen.py : frames posted one at a time, run in micro batches
+########################################################################################################################
+def bench_server(args):
+    import asyncio
+    import threading
+    import torch
+    from model import Model_RPN , Classifier
+    from utils import save_checkpoint
+    import detector
+    import runtime
+    import server
+    import loadgen
+    torch.manual_seed(args.seed)
+    folder = tempfile.mkdtemp()
+    try:
+        model_rpn = Model_RPN(num_anchors=len(ANCHOR_SIZES) * len(ANCHOR_RATIOS), pretrained=False)
+        model_classifier = Classifier(num_classes=len(REV_LABEL_MAP))
+        quiet(save_checkpoint)(0, model_rpn, model_classifier, None, None, 0.0, save_dir=folder + "/")
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            detector.export_detector(detector.build_detector(folder + "/", HEIGHT, WIDTH, score_thresh=0.0), folder + "/detector.pt")
+        images = runtime.list_images(["YeastCellDataset/test"])[:args.num_images or 6]
+        socket = os.path.join(folder, "server.sock")
+        num_requests = 4 * len(images)
+
+        def run(*options, concurrency=4):
+            # in process server on a unix socket (its own event loop thread), loadgen in closed loop
+            batcher = server.make_batcher(server.parse_args(["--detector", folder + "/detector.pt", "--unix", socket] + list(options)))
+            front = server.Server(batcher, unix=socket)
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, daemon=True)
+            thread.start()
+            asyncio.run_coroutine_threadsafe(front.start(), loop).result()
+            try:
+                out = asyncio.run(loadgen.generate(loadgen.parse_args(images + ["--unix", socket, "--concurrency", str(concurrency),
+                                                                                 "--requests", str(num_requests)])))
+                answers = asyncio.run(post_each(loadgen.Connection(unix=socket), images))
+            finally:
+                asyncio.run_coroutine_threadsafe(front.stop(), loop).result()
+                loop.call_soon_threadsafe(loop.stop)
+                thread.join()
+            return out, answers
+
+        async def post_each(connection, paths):
+            answers = []
+            for path in paths:
+                with open(path, 'rb') as f:
+                    answers.append((await connection.request('POST', '/detect', f.read()))[1])
+            await connection.close()
+            return answers
+
+        scripted, config = runtime.load_detector(folder + "/detector.pt")
+        ref = list(runtime.predict(scripted, config, images, batch_size=1))
+        print("{} requests of {} frames , 4 clients with one frame in flight each :".format(num_requests, len(images)))
+        for name, options in (('batch 1', ["--max-batch", "1"]), ('batch <= 4 , wait 20 ms', ["--max-batch", "4", "--max-wait-ms", "20"]),
+                              ('batch <= 4 , 2 workers', ["--max-batch", "4", "--max-wait-ms", "20", "--workers", "2"])):
+            out, answers = run(*options)
+            assert out['errors'] == 0 and out['requests'] == num_requests
+            # same detections as runtime.predict at batch 1 (up to the float noise of the batched convolutions)
+            for answer, (_, boxes, scores, labels) in zip(answers, ref):
+                assert answer['labels'] == labels and np.allclose(np.array(answer['boxes']).reshape(-1, 4), boxes.numpy(), atol=0.5)
+            server_stats = out['server']
+            print("    {:24s}: {:5.2f} frames / s | client p50 {:6.0f} ms p99 {:6.0f} ms | server p50 {:6.0f} ms p99 {:6.0f} ms | batches {}".format(
+                name, out['frames_per_sec'], out['latency_ms']['p50'], out['latency_ms']['p99'], server_stats['latency_ms']['p50'],
+                server_stats['latency_ms']['p99'], server_stats['batch_size_histogram']))
+        print("server detections match runtime.predict")
+    finally:
+        shutil.rmtree(folder)
+
+
+BENCHMARKS = {
+    'anchors': bench_anchors,
+    'annotations': bench_annotations,
+    'batch_augment': bench_batch_augment,
+    'buckets': bench_buckets,
+    'calc_iou': bench_calc_iou,
+    'calc_rpn': bench_calc_rpn,
+    'decode': bench_decode,
+    'detector': bench_detector,
+    'diag': bench_diag,
+    'getitems': bench_getitems,
+    'image_store': bench_image_store,
+    'infer': bench_infer,
+    'nms': bench_nms,
+    'prefetch': bench_prefetch,
+    'quantize': bench_quantize,
+    'roi_pool': bench_roi_pool,
+    'roi_sampler': bench_roi_sampler,
+    'rpn_cache': bench_rpn_cache,
+    'rpn_to_roi': bench_rpn_to_roi,
+    'server': bench_server,
+    'shards': bench_shards,
+    'slabs': bench_slabs,
+    'sparse_targets': bench_sparse_targets,
+    'tiles': bench_tiles,
+    'train_step': bench_train_step,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Faster RCNN pipeline benchmarks')
+    parser.add_argument('name', choices=sorted(BENCHMARKS.keys()))
+    parser.add_argument('--seed', default=1, type=int)
+    parser.add_argument('--num-images', default=None, type=int, help="only use the first n images")
+    args = parser.parse_args()
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    BENCHMARKS[args.name](args)
@@ -7,28 +7,41 @@ import torchvision.transforms as transforms
 from plot import verify
 
 import random 
+from concurrent.futures import ThreadPoolExecutor
+import hashlib 
+import numpy as np 
 from tools import RPM 
+import diag
+from annotations import AnnotationStore , store_path
 
 class Dataset(Dataset):
     
-    def __init__(self, data_folder , rpm, split, std_scaling=4.0, image_resize_size=None , debug=False , data_format= 'bg_first' , save_evaluations= False):
+    def __init__(self, data_folder , rpm, split, std_scaling=4.0, image_resize_size=None , debug=False , data_format= 'bg_first' , save_evaluations= False , rpn_cache=None , image_store=None , decode='full' , augment='pil' , annotations='json' , buckets=None , fetch_threads=0):
         self.split = split.upper()
         assert self.split in {'TRAIN', 'TEST'}
         self.data_folder = data_folder
         
-        # Read data files
-        with open(os.path.join(data_folder, self.split + '_images.json'), 'r') as j:
-            self.images = json.load(j)
-        with open(os.path.join(data_folder, self.split + '_objects.json'), 'r') as j:
-            self.objects = json.load(j)
+        # Read data files, 'store' maps <split>_annotations (see annotations.py) instead of loading the json lists
+        assert annotations in {'json', 'store'}
+        self.annotations = None 
+        if annotations == 'store':
+            self.annotations = AnnotationStore(store_path(data_folder, self.split))
+            self.images = self.annotations.column('image')
+            self.objects = self.annotations.column('objects')
+        else:
+            with open(os.path.join(data_folder, self.split + '_images.json'), 'r') as j:
+                self.images = json.load(j)
+            with open(os.path.join(data_folder, self.split + '_objects.json'), 'r') as j:
+                self.objects = json.load(j)
 
         assert len(self.images) == len(self.objects)
         # self.labels = labels
 
-        if self.split == 'TRAIN':
-            self.transform = Transform(train=True , resize_size=image_resize_size)
-        else:
-            self.transform = Transform(train=False , resize_size=image_resize_size)
+        # 'batch' leaves the augmentation (and normalization) to BatchAugment after collate_fn
+        assert augment in {'pil', 'batch'}
+        self.augment = augment
+        train = self.split == 'TRAIN' and augment == 'pil'
+        self.transform = Transform(train=train , resize_size=image_resize_size , decode=decode)
 
         self.rpm = rpm
 
@@ -38,82 +51,499 @@ class Dataset(Dataset):
         self.data_format = data_format
         self.save_evaluations = save_evaluations
 
-    def __getitem__(self, i, verify_image=False ):
-        # Read image
-        print("----", self.images[i], "----")
-        image = Image.open(self.images[i], mode='r')
-        image = image.convert('RGB')
-
-        # Read objects in this image (bounding boxes, labels)
-        objects = self.objects[i]
-        boxes = objects['boxes']
-        labels = objects['labels']
+        # decoded and resized images, see build_image_store
+        self.image_store = None 
+        if image_store:
+            key = image_store_key(self)
+            self.image_store = ImageStore(build_image_store(self, image_store, key=key), key=key)
+
+        # precomputed (unsampled) RPN targets, see build_rpn_cache
+        self.rpn_cache = None 
+        if rpn_cache:
+            key = rpn_cache_key(self)
+            self.rpn_cache = RPNTargetCache(build_rpn_cache(self, rpn_cache, key=key), key=key)
+
+        # aspect ratio buckets : image i is resized to buckets[self.bucket[i]] (h, w) instead of image_resize_size
+        self.buckets = buckets
+        self.bucket = None 
+        if buckets:
+            if self.image_store is not None or self.rpn_cache is not None:
+                raise ValueError("aspect ratio buckets resize every image to its own bucket, not available with an image store / RPN cache")
+            if rpm.anchors.key is None:
+                raise ValueError("aspect ratio buckets need the anchors of the registry (tools.get_anchors), not a valid_anchors() dict")
+            self.bucket = assign_buckets(image_sizes(self), buckets)
+            self.bucket_transforms = [Transform(train=train , resize_size=size , decode=decode) for size in buckets]
+
+        # > 0 : the DataLoader fetches whole batches (__getitems__), decoded by that many threads
+        self.fetch_threads = fetch_threads
+        self._pool = None 
+
+    def __getstate__(self):
+        # the threads of __getitems__ are started again in every process 
+        state = dict(self.__dict__)
+        state['_pool'] = None 
+        return state
+
+    def thread_pool(self):
+        # a forked worker inherits the pool object, not its threads
+        if self._pool is None or self._pool[0] != os.getpid():
+            self._pool = (os.getpid(), ThreadPoolExecutor(max_workers=self.fetch_threads))
+        return self._pool[1]
+
+    def transform_for(self, i):
+        return self.transform if self.bucket is None else self.bucket_transforms[self.bucket[i]]
+
+    def resize_size_for(self, i):
+        # (h, w) image i is resized to 
+        return self.image_resize_size if self.bucket is None else tuple(self.buckets[self.bucket[i]])
+
+    def read_objects(self, i):
+        # Read objects in this image (bounding boxes, labels), already resized with an image store 
+        if self.image_store is not None:
+            boxes, labels = self.image_store.objects(i)
+        else:
+            objects = self.objects[i]
+            boxes = objects['boxes']
+            labels = objects['labels']
+        return boxes, self.format_labels(labels)
+
+    def format_labels(self, labels):
+        # labels as annotated ==> training labels 
         if self.data_format ==  'bg_first':
             labels = [l-1 for l in labels ]
+        return labels
+
+    def read_image(self, i, resize=False):
+        # decoded image i and the size its boxes are annotated on, resize : already at the size of apply_transform
+        diag.log(diag.DEBUG, "dataset.getitem", "---- {} ----", self.images[i])
+        if self.image_store is not None:
+            # already decoded and resized, nothing left for apply_transform to resize 
+            image = Image.fromarray(self.image_store.image(i))
+            return image, image.size
+        transform = self.transform_for(i)
+        image, orig_size = transform.open(self.images[i])
+        if resize and transform.resize_size and image.size != transform.resize_size:
+            image = image.resize(transform.resize_size)
+        return image, orig_size
 
+    def __getitem__(self, i, verify_image=False ):
+        image, orig_size = self.read_image(i)
+        boxes, labels = self.read_objects(i)
+        return self.make_sample(i, image, orig_size, boxes, labels, verify_image=verify_image)
+
+    def augment_sample(self, i, image, orig_size, boxes):
+        # transformations of image i, returns image, boxes, flipped (which cached targets, with an RPN cache) and the (h, w) of the targets
+        transform = self.transform_for(i)
+        flipped = None 
+        if self.rpn_cache is not None:
+            # the flip decides which of the two cached target sets is used, only the subsampling runs here 
+            flipped = transform.train and random.random() < 0.5
+            image, boxes = transform.apply_transform(image, boxes, hflip=flipped, orig_size=orig_size)
+            image_resize_size = self.resize_size_for(i)
+        else:
+            # Apply transformations
+            image, boxes = transform.apply_transform(image, boxes, orig_size=orig_size)
+            image_resize_size = self.resize_size_for(i) or (image.size[1], image.size[0])
+        return image, boxes, flipped, image_resize_size
+
+    def make_targets(self, pos, neg, regr):
+        # sampled anchors as flat (h, w, num_anchors) indices, regression targets of the positive ones 
+        return {
+            'pos': torch.from_numpy(pos.astype(np.int32)), 
+            'neg': torch.from_numpy(neg.astype(np.int32)),
+            'regr': torch.from_numpy((regr * self.std_scaling).astype(np.float32)).view(-1, 4),
+        }
+
+    def make_sample(self, i, image, orig_size, boxes, labels, verify_image=False):
+        # everything after the read of image i : augmentation, RPN targets, tensors (also used by shards.ShardDataset)
+        transform = self.transform_for(i)
         if verify_image:
             verify(image, boxes, labels)
 
-        # Apply transformations
-        image, boxes = self.transform.apply_transform(image, boxes)
+        image, boxes, flipped, image_resize_size = self.augment_sample(i, image, orig_size, boxes)
 
-        if self.image_resize_size: 
-            y_is_box_label, y_rpn_regr, num_pos  = self.rpm.calc_rpn(boxes , labels,  image_resize_size=self.image_resize_size)
+        if self.debug:
+            # dense (1, h, w, num_anchors) targets, see debug.py
+            y_is_box_label, y_rpn_regr, num_pos  = self.rpm.calc_rpn(boxes , labels,  image_resize_size=image_resize_size)
+            targets = [y_is_box_label, y_rpn_regr * self.std_scaling]
+            image = transform.to_tensor(image) 
+            return image, boxes, labels , targets, num_pos
+
+        if self.rpn_cache is not None:
+            pos, neg, regr = self.rpm.sample_sparse(*self.rpn_cache.sparse_targets(i, flipped))
         else:
-            y_is_box_label, y_rpn_regr, num_pos = self.rpm.calc_rpn(boxes , labels,  image_resize_size=(image.size[1], image.size[0] ))
-
-        y_rpn_regr = y_rpn_regr * self.std_scaling
+            pos, neg, regr = self.rpm.calc_rpn_sparse(boxes , labels,  image_resize_size=image_resize_size)
+        num_pos = len(pos)
 
-        if not self.debug:
-            boxes = torch.FloatTensor(boxes)  # (n_objects, 4)
-            # labels = torch.LongTensor(labels)  # (n_objects)
-            y_is_box_label = torch.FloatTensor(y_is_box_label)
-            y_rpn_regr = torch.FloatTensor(y_rpn_regr)
+        boxes = torch.FloatTensor(boxes)  # (n_objects, 4)
+        # labels = torch.LongTensor(labels)  # (n_objects)
+        targets = self.make_targets(pos, neg, regr)
 
-        if self.debug:
-            image = self.transform.to_tensor(image) 
-        else:
-            image = self.transform.normalize( self.transform.to_tensor(image) )
+        image = transform.to_tensor(image)
+        if self.augment == 'pil':
+            image = transform.normalize(image)
         
-        return image, boxes, labels , [y_is_box_label, y_rpn_regr], num_pos
+        return image, boxes, labels , targets, num_pos
+
+    def __getitems__(self, indices):
+        """Batch fetch of the DataLoader (torch >= 2.0), per sample (__getitem__) unless fetch_threads > 0
+
+        The images are decoded and resized by the thread pool (PIL releases the GIL while decoding), 
+        the random augmentations then run in index order in this thread. The RPN targets of the images 
+        of a size are computed at once (RPM.calc_rpn_sparse_batch) and the tensors are written by the pool 
+        straight into the batch. Returns the output of collate_fn, as a Collated that collate_fn passes through.
+        Same samples as __getitem__ without augmentation, with it the draws are made in another order.
+        """
+        if self.fetch_threads <= 0 or self.debug:
+            return [self[i] for i in indices]
+        indices = list(indices)
+        pool = self.thread_pool()
+        decoded = list(pool.map(lambda i: self.read_image(i, resize=True), indices))
+
+        images, boxes, labels, flips, sizes = [], [], [], [], []
+        for i, (image, orig_size) in zip(indices, decoded):
+            bxs, lbls = self.read_objects(i)
+            image, bxs, flipped, size = self.augment_sample(i, image, orig_size, bxs)
+            images.append(image)
+            boxes.append(bxs)
+            labels.append(lbls)
+            flips.append(flipped)
+            sizes.append(size)
+
+        # one batch of targets per image size (a single one without buckets) 
+        sparse = [None] * len(indices)
+        if self.rpn_cache is not None:
+            for j, i in enumerate(indices):
+                sparse[j] = self.rpm.sample_sparse(*self.rpn_cache.sparse_targets(i, flips[j]))
+        else:
+            by_size = {}
+            for j, size in enumerate(sizes):
+                by_size.setdefault(size, []).append(j)
+            for size, js in by_size.items():
+                batch = self.rpm.calc_rpn_sparse_batch([boxes[j] for j in js], [labels[j] for j in js], image_resize_size=size)
+                for j, t in zip(js, batch):
+                    sparse[j] = t
+        targets = [self.make_targets(*t) for t in sparse]
+
+        tensors = torch.empty((len(images), len(images[0].getbands()), images[0].size[1], images[0].size[0]))
+        def to_tensor(j):
+            tensors[j] = self.transform_for(indices[j]).to_tensor(images[j])
+        list(pool.map(to_tensor, range(len(images))))
+        if self.augment == 'pil':
+            # same mean / std for every transform 
+            tensors = self.transform.normalize(tensors)
+
+        return Collated((tensors, [torch.FloatTensor(b) for b in boxes], labels, collate_targets(targets), [len(t['pos']) for t in targets]))
 
     def __len__(self):
         return len(self.images)
 
 
+def image_sizes(dataset):
+    # (w, h) of every image, from the headers only
+    sizes = []
+    for i in range(len(dataset)):
+        with Image.open(dataset.images[i], mode='r') as image:
+            sizes.append(image.size)
+    return np.array(sizes, dtype=np.int64).reshape(-1, 2)
+
+
+def assign_buckets(sizes, buckets):
+    """Bucket of every image, the one with the closest aspect ratio (in log scale)
+
+    Args:
+        sizes: shape=(n, 2) w, h of the images
+        buckets: list of (h, w)
+    """
+    image_ratio = np.log(sizes[:, 0] / sizes[:, 1])
+    bucket_ratio = np.log(np.array([w / h for h, w in buckets]))
+    return np.abs(image_ratio[:, None] - bucket_ratio[None, :]).argmin(1)
+
+
+def annotations_digest(dataset):
+    # identifies the annotations in the cache keys, an annotation store has its own digest
+    if dataset.annotations is not None:
+        return dataset.annotations.digest
+    h = hashlib.sha1()
+    for name in ('images', 'objects'):
+        h.update(json.dumps(getattr(dataset, name), sort_keys=True).encode())
+    return h.hexdigest()
+
+
+# Offline RPN targets 
+# build_rpn_cache runs RPM.calc_rpn_targets once per image and flip state, and stores the unsampled targets : 
+#   labels.npy : (n_images, 2, h, w, num_anchors) int8, [:, 1] is the horizontally flipped image
+#   pos_index.npy / pos_regr.npy : flat (h, w, num_anchors) index and tx, ty, tw, th of the positive anchors 
+#   offsets.npy : (2 * n_images + 1) start of every (image, flip) in pos_index / pos_regr
+# key.json holds everything the targets depend on, entries with another key are never used
+def rpn_cache_key(dataset):
+    if dataset.image_resize_size is None:
+        raise ValueError("the RPN target cache needs a fixed image_resize_size")
+    rpm = dataset.rpm
+    anchors = hashlib.sha1(np.ascontiguousarray(rpm.anchor_boxes).tobytes() + np.ascontiguousarray(rpm.anchor_locs).tobytes())
+    return {
+        'split': dataset.split,
+        'image_resize_size': list(dataset.image_resize_size),
+        'anchor_sizes': [float(s) for s in rpm.anchor_sizes],
+        'anchor_ratios': [float(r) for r in rpm.anchor_ratios],
+        'anchors': anchors.hexdigest(),
+        'rpn_max_overlap': rpm.rpn_max_overlap,
+        'rpn_min_overlap': rpm.rpn_min_overlap,
+        'rev_label_map': {str(k): v for k, v in rpm.rev_label_map.items()},
+        'data_format': dataset.data_format,
+        'annotations': annotations_digest(dataset),
+    }
+
+
+def build_rpn_cache(dataset, cache_dir, key=None):
+    """Preprocessing stage of the RPN target cache, returns the path of the entry for this dataset
+
+    Only the image headers are read (for the original size), nothing is decoded. 
+    key is rpn_cache_key(dataset), computed here if not given (it hashes all the annotations).
+    """
+    if key is None:
+        key = rpn_cache_key(dataset)
+    name = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+    path = os.path.join(cache_dir, "rpn_{}_{}".format(dataset.split, name))
+    if os.path.isdir(path):
+        return path
+
+    height, width = dataset.image_resize_size
+    labels_all = None 
+    pos_index = []
+    pos_regr = []
+    offsets = [0]
+    for i in range(len(dataset)):
+        boxes, labels = dataset.read_objects(i)
+        if dataset.image_store is None:
+            with Image.open(dataset.images[i], mode='r') as image:
+                boxes = dataset.transform.resize_boxes(boxes, image.size)
+        for f, bxs in enumerate([boxes, flip_boxes(boxes, width)]):
+            y_is_box_label, y_rpn_regr = dataset.rpm.calc_rpn_targets(bxs, labels, image_resize_size=(height, width))
+            if labels_all is None:
+                labels_all = np.zeros((len(dataset), 2) + y_is_box_label.shape, dtype=np.int8)
+            labels_all[i, f] = y_is_box_label
+            pos = np.flatnonzero(y_is_box_label == 1)
+            pos_index.append(pos.astype(np.int32))
+            pos_regr.append(y_rpn_regr.reshape(-1, 4)[pos].astype(np.float32))
+            offsets.append(offsets[-1] + pos.size)
+
+    arrays = {
+        'labels': labels_all,
+        'pos_index': np.concatenate(pos_index),
+        'pos_regr': np.concatenate(pos_regr).reshape(-1, 4),
+        'offsets': np.array(offsets, dtype=np.int64),
+    }
+    return write_cache_entry(path, key, arrays)
+
+
+def write_cache_entry(path, key, arrays, fill=None):
+    """Write the .npy arrays and key.json of a cache entry in a temporary folder, then move it to path
+
+    fill(tmp) can write more (large) files in the temporary folder. 
+    """
+    tmp = "{}.tmp{}".format(path, os.getpid())
+    os.makedirs(tmp, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp, name + ".npy"), array)
+    if fill is not None:
+        fill(tmp)
+    with open(os.path.join(tmp, "key.json"), 'w') as j:
+        json.dump(key, j)
+    try:
+        os.replace(tmp, path)
+    except OSError:
+        # built by another process in the meantime 
+        for f in os.listdir(tmp):
+            os.remove(os.path.join(tmp, f))
+        os.rmdir(tmp)
+    return path
+
+
+class RPNTargetCache(object):
+    """Read side of build_rpn_cache, arrays are memory-mapped and only the path is sent to the workers"""
+    def __init__(self, path, key=None):
+        super(RPNTargetCache, self).__init__()
+        self.path = path
+        with open(os.path.join(path, "key.json"), 'r') as j:
+            self.key = json.load(j)
+        if key is not None and key != self.key:
+            raise ValueError("stale RPN target cache {}".format(path))
+        self.labels = np.load(os.path.join(path, "labels.npy"), mmap_mode='r')
+        self.pos_index = np.load(os.path.join(path, "pos_index.npy"), mmap_mode='r')
+        self.pos_regr = np.load(os.path.join(path, "pos_regr.npy"), mmap_mode='r')
+        self.offsets = np.load(os.path.join(path, "offsets.npy"))
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def __len__(self):
+        return self.labels.shape[0]
+
+    def sparse_targets(self, i, flipped):
+        """Unsampled targets of image i as RPM.sample_sparse takes them"""
+        f = 2 * i + int(flipped)
+        start, end = self.offsets[f], self.offsets[f + 1]
+        neg_locs = np.flatnonzero(self.labels[i, int(flipped)].reshape(-1) == -1)
+        return np.asarray(self.pos_index[start:end], dtype=np.int64), neg_locs, np.asarray(self.pos_regr[start:end])
+
+    def targets(self, i, flipped):
+        """Same as RPM.calc_rpn_targets on image i (resized, flipped or not)"""
+        f = 2 * i + int(flipped)
+        y_is_box_label = self.labels[i, int(flipped)].astype(np.float64)
+        y_rpn_regr = np.zeros(y_is_box_label.shape + (4,))
+        start, end = self.offsets[f], self.offsets[f + 1]
+        y_rpn_regr.reshape(-1, 4)[self.pos_index[start:end]] = self.pos_regr[start:end]
+        return y_is_box_label, y_rpn_regr.reshape(y_is_box_label.shape[:-1] + (-1,))
+
+
+def image_store_key(dataset):
+    if dataset.image_resize_size is None:
+        raise ValueError("the image store needs a fixed image_resize_size")
+    return {
+        'split': dataset.split,
+        'image_resize_size': list(dataset.image_resize_size),
+        'annotations': annotations_digest(dataset),
+    }
+
+
+def build_image_store(dataset, cache_dir, key=None):
+    """Ingest stage of the image store, returns the path of the entry for this dataset
+
+    Every image is decoded once, converted to RGB and resized to image_resize_size, its boxes rescaled. 
+    images.npy is one (N, h, w, 3) uint8 array, boxes of image i are boxes[offsets[i]:offsets[i + 1]] 
+    """
+    if key is None:
+        key = image_store_key(dataset)
+    name = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+    path = os.path.join(cache_dir, "images_{}_{}".format(dataset.split, name))
+    if os.path.isdir(path):
+        return path
+
+    height, width = dataset.image_resize_size
+    boxes_all = []
+    labels_all = []
+    sizes = []
+    offsets = [0]
+    for i in range(len(dataset)):
+        objects = dataset.objects[i]
+        with Image.open(dataset.images[i], mode='r') as image:
+            sizes.append(image.size)
+            boxes_all.append(np.asarray(dataset.transform.resize_boxes(objects['boxes'], image.size), dtype=np.float32).reshape(-1, 4))
+        # labels as annotated, read_objects applies data_format 
+        labels_all.append(np.asarray(objects['labels'], dtype=np.int64))
+        offsets.append(offsets[-1] + boxes_all[-1].shape[0])
+
+    def fill(tmp):
+        # written image by image, never all in memory 
+        images = np.lib.format.open_memmap(os.path.join(tmp, "images.npy"), mode='w+', dtype=np.uint8, shape=(len(dataset), height, width, 3))
+        for i in range(len(dataset)):
+            with Image.open(dataset.images[i], mode='r') as image:
+                images[i] = np.asarray(image.convert('RGB').resize((width, height)))
+        images.flush()
+        del images
+
+    arrays = {
+        'boxes': np.concatenate(boxes_all, 0),
+        'labels': np.concatenate(labels_all, 0),
+        'label_offsets': np.cumsum([0] + [len(l) for l in labels_all]).astype(np.int64),
+        'offsets': np.array(offsets, dtype=np.int64),
+        'sizes': np.array(sizes, dtype=np.int64),
+    }
+    return write_cache_entry(path, key, arrays, fill=fill)
+
+
+class ImageStore(object):
+    """Read side of build_image_store, arrays are memory-mapped (the workers share the page cache) and only 
+    the path is sent to the workers"""
+    def __init__(self, path, key=None):
+        super(ImageStore, self).__init__()
+        self.path = path
+        with open(os.path.join(path, "key.json"), 'r') as j:
+            self.key = json.load(j)
+        if key is not None and key != self.key:
+            raise ValueError("stale image store {}".format(path))
+        self.images = np.load(os.path.join(path, "images.npy"), mmap_mode='r')
+        self.boxes = np.load(os.path.join(path, "boxes.npy"), mmap_mode='r')
+        self.labels = np.load(os.path.join(path, "labels.npy"), mmap_mode='r')
+        self.label_offsets = np.load(os.path.join(path, "label_offsets.npy"))
+        self.offsets = np.load(os.path.join(path, "offsets.npy"))
+        self.sizes = np.load(os.path.join(path, "sizes.npy"))
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def __len__(self):
+        return self.images.shape[0]
+
+    def image(self, i):
+        # (h, w, 3) uint8 view on the mapped file, no copy 
+        return self.images[i]
+
+    def objects(self, i):
+        # resized boxes (list of lists, like the json), labels as annotated 
+        boxes = self.boxes[self.offsets[i]:self.offsets[i + 1]].tolist()
+        labels = self.labels[self.label_offsets[i]:self.label_offsets[i + 1]].tolist()
+        return boxes, labels
+
+
+
+class Collated(tuple):
+    # a batch Dataset.__getitems__ already collated 
+    pass
+
 
 def collate_fn( batch):
     """
     Since each image may have a different number of objects, we need a collate function (to be passed to the DataLoader).
     This describes how to combine these tensors of different sizes. We use lists.
-    :param batch: an iterable of N sets from __getitem__()
-    :return: a tensor of images, lists of varying-size tensors of bounding boxes, labels
+    :param batch: an iterable of N sets from __getitem__(), or a Collated batch (returned as is)
+    :return: a tensor of images, lists of varying-size tensors of bounding boxes, labels, 
+        the sparse RPN targets concatenated, image b owns pos[pos_offsets[b]:pos_offsets[b+1]] (same for neg)
     """
+    if isinstance(batch, Collated):
+        return tuple(batch)
 
     images = list()
     boxes = list()
     labels = list()
-    y_is_box_label = list()
     num_pos =  list()
-    y_rpn_regr = list()
-
+    targets = list()
 
     for b in batch:
         images.append(b[0])
         boxes.append(b[1])
         labels.append(b[2])
-        y_is_box_label.append(b[3][0])
-        y_rpn_regr.append(b[3][1])
+        targets.append(b[3])
         num_pos.append(b[4])
         
     images = torch.stack(images, dim=0)
-    y_is_box_label = torch.cat(y_is_box_label, dim=0)
-    y_rpn_regr = torch.cat(y_rpn_regr, dim=0)
+    return images, boxes, labels , collate_targets(targets) , num_pos
 
-    return images, boxes, labels , [y_is_box_label, y_rpn_regr] , num_pos
 
+def collate_targets(targets):
+    # sparse RPN targets of the images concatenated, with the offsets of every image 
+    pos = [t['pos'] for t in targets]
+    neg = [t['neg'] for t in targets]
+    return {
+        'pos': torch.cat(pos, dim=0),
+        'neg': torch.cat(neg, dim=0),
+        'regr': torch.cat([t['regr'] for t in targets], dim=0),
+        'pos_offsets': offsets(pos),
+        'neg_offsets': offsets(neg),
+    }
 
 
+def offsets(tensors):
+    # start of each tensor once concatenated, plus the total 
+    sizes = torch.tensor([0] + [t.size(0) for t in tensors], dtype=torch.int64)
+    return torch.cumsum(sizes, 0)
 
 
 
@@ -122,18 +552,25 @@ def flip(image, boxes):
     # Flip image
     new_image = image.transpose(Image.FLIP_LEFT_RIGHT)
     # new_image = FT.hflip(image)
+    return new_image, flip_boxes(boxes, image.width)
+
+
+def flip_boxes(boxes, width):
     # Flip boxes
-    boxes = [ [image.width - cord -1 if i % 2 ==0 else cord for i,cord in enumerate(box)  ] for box in boxes]
+    boxes = [ [width - cord -1 if i % 2 ==0 else cord for i,cord in enumerate(box)  ] for box in boxes]
     boxes = [ [box[2] ,box[1] , box[0], box[3]] for box in boxes]
-    return new_image, boxes
+    return boxes
 
 
 
 class Transform(object):
     """docstring for Transform"""
-    def __init__(self,  train , resize_size=None):
+    def __init__(self,  train , resize_size=None , decode='full'):
         super(Transform, self).__init__()
         self.train = train 
+        # 'full' decodes the whole frame, 'draft' lets the JPEG decoder skip to the smallest DCT scale >= resize_size
+        assert decode in {'full', 'draft'}
+        self.decode = decode
         self.to_tensor = transforms.ToTensor()
         if resize_size:
             self.resize_size = (resize_size[1] , resize_size[0])
@@ -142,17 +579,42 @@ class Transform(object):
             
         self.normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
 
-    def apply_transform(self, image, boxes  ) :
+    def resize_boxes(self, boxes, orig_size):
+        # orig_size :: w x h of the image the boxes are annotated on 
+        return [ [cord * self.resize_size[i % 2] / orig_size[i % 2] for i,cord in enumerate(box) ] for box in boxes]
+
+    def open(self, path):
+        """Decode path to RGB, returns the image and the size (w x h) its boxes are annotated on
+
+        In 'draft' mode a JPEG is decoded at a reduced DCT scale (1/2, 1/4, 1/8, never below resize_size), 
+        then resized exactly from the region covering the full frame, so the boxes keep the full size scaling. 
+        Other formats are decoded in full.
+        """
+        image = Image.open(path, mode='r')
+        orig_size = image.size
+        if self.decode == 'draft' and self.resize_size:
+            drafted = image.draft('RGB', self.resize_size)
+            if drafted is not None:
+                image = image.convert('RGB').resize(self.resize_size, box=drafted[1])
+                return image, orig_size
+        return image.convert('RGB'), orig_size
+
+    def apply_transform(self, image, boxes , hflip=None , orig_size=None ) :
+        # hflip : None flips at random (train only), True / False forces it 
+        # orig_size : size the boxes are annotated on, image.size by default 
         if self.resize_size:
-            orig_size = image.size
+            orig_size = orig_size or image.size
             # (4032, 3024) :: w x h 
 
-            image = image.resize( self.resize_size )
+            if image.size != self.resize_size:
+                image = image.resize( self.resize_size )
             # self.resize_size :: h x w 
-            boxes= [ [cord * self.resize_size[i % 2] / orig_size[i % 2] for i,cord in enumerate(box) ] for box in boxes]
+            boxes= self.resize_boxes(boxes, orig_size)
 
         if self.train : 
-            if random.random() < 0.5:
+            if hflip is None:
+                hflip = random.random() < 0.5
+            if hflip:
                 image , boxes = flip(image, boxes)
           
             if random.random() < 0.5:
@@ -181,30 +643,220 @@ class Transform(object):
         
 
 
-class Dataset_roi(Dataset):
-    
-    def __init__(self, pos , neg):
-        self.pos = pos
-        self.neg = neg
-        self.curr = -1
-
-    def __getitem__(self, i):
-        if self.pos.size(0) == 0: 
-            return  [] , self.neg[i] 
+class BatchAugment(object):
+    """Train augmentation of Transform.apply_transform on the collated batch tensor, per sample parameters
 
-        elif self.neg.size(0) == 0 : 
-            return self.pos[i] , []
+    Same draws as the PIL path (each op with probability 0.5) : horizontal flip, Sharpness(1/8), then 
+    Brightness / Contrast / Color with a factor ~ U(0, 1) kept only if > 0.5. The ops follow ImageEnhance 
+    (blend with a degenerate image) on [0, 1] floats, so they run on the training device. 
+    A flipped sample gets its boxes and sparse RPN targets mirrored (x' = width - x, the exact mirror of the 
+    image, anchors map to column w - 1 - ix and tx changes sign). The batch is normalized at the end. 
+    The mirror is only exact on a symmetric anchor grid : width == downscale * feature_w, checked on every batch. 
+    """
+    def __init__(self, feature_size, num_anchors, downscale=16, seed=None, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)):
+        self.feature_h, self.feature_w = feature_size
+        self.num_anchors = num_anchors
+        self.downscale = downscale
+        self.mean = torch.tensor(mean).view(1, 3, 1, 1)
+        self.std = torch.tensor(std).view(1, 3, 1, 1)
+        self.generator = torch.Generator()
+        if seed is None:
+            self.generator.seed()
         else:
-            if min(self.pos.size(0) , self.neg.size(0)) == self.pos.size(0):
-                self.curr += 1
-                return self.pos[self.curr % self.pos.size(0)] , self.neg[i]
-
-            else:
-                self.curr += 1
-                return self.pos[i] , self.neg[ self.curr % self.neg.size(0) ]
+            self.generator.manual_seed(seed)
+
+    def params(self, batch_size, seed=None):
+        # per sample flip and enhancement factors, 1 is the identity 
+        if seed is not None:
+            self.generator.manual_seed(seed)
+        rand = lambda: torch.rand(batch_size, generator=self.generator)
+        flip = rand() < 0.5
+        sharpness = torch.where(rand() < 0.5, torch.full((batch_size,), 1 / 8), torch.ones(batch_size))
+        factors = []
+        for _ in range(3):
+            apply, factor = rand() < 0.5, rand()
+            factors.append(torch.where(apply & (factor > 0.5), factor, torch.ones(batch_size)))
+        return {'flip': flip, 'sharpness': sharpness, 'brightness': factors[0], 'contrast': factors[1], 'color': factors[2]}
+
+    def __call__(self, images, boxes, targets, seed=None, feature_size=None):
+        """
+        Args:
+            images: shape=(b, 3, h, w) uint8 or float in [0, 1] (not normalized)
+            boxes: list of (n_b, 4) boxes, targets: sparse RPN targets from collate_fn
+            seed: reseeds the generator for this batch
+            feature_size: (h, w) of the feature map of this batch (aspect ratio buckets), the one given at init otherwise
+        Returns:
+            normalized images, boxes, targets
+        """
+        feature_w = feature_size[1] if feature_size is not None else self.feature_w
+        if images.size(3) != self.downscale * feature_w:
+            raise ValueError("images {} wide on a feature map {} wide (downscale {}) : the anchor grid is not symmetric, "
+                             "the mirrored RPN targets would be off".format(images.size(3), feature_w, self.downscale))
+        # a new tensor, the flip below is in place 
+        images = images.float() / 255 if images.dtype == torch.uint8 else images.clone()
+        p = {k: v.to(images.device) for k, v in self.params(images.size(0), seed).items()}
+        flipped = torch.nonzero(p['flip'], as_tuple=True)[0]
+        if flipped.numel() > 0:
+            images[flipped] = images[flipped].flip(3)
+        boxes = [flip_box_tensor(bx, images.size(3)) if f else bx for bx, f in zip(boxes, p['flip'].tolist())]
+        targets = self.flip_targets(targets, p['flip'], feature_size=feature_size)
+
+        images = adjust_sharpness(images, p['sharpness'])
+        images = (images * p['brightness'].view(-1, 1, 1, 1)).clamp(0, 1) # blend with black 
+        mean = grayscale(images).mean((1, 2, 3), keepdim=True)
+        images = blend(mean.expand_as(images), images, p['contrast'])
+        images = blend(grayscale(images).expand_as(images), images, p['color'])
+        return (images - self.mean.to(images.device)) / self.std.to(images.device), boxes, targets
+
+    def mirror(self, index, feature_w=None):
+        # flat (h, w, A) anchor index ==> index of the mirrored anchor 
+        w, a = feature_w or self.feature_w, self.num_anchors
+        index = index.long()
+        jy, ix, k = index // (w * a), (index // a) % w, index % a
+        return (jy * w + (w - 1 - ix)) * a + k
+
+    def flip_targets(self, targets, flip, feature_size=None):
+        feature_w = feature_size[1] if feature_size is not None else None
+        targets = dict(targets)
+        for name, offsets in (('pos', 'pos_offsets'), ('neg', 'neg_offsets')):
+            counts = targets[offsets][1:] - targets[offsets][:-1]
+            rows = torch.repeat_interleave(flip.to(counts.device), counts)
+            targets[name] = torch.where(rows, self.mirror(targets[name], feature_w), targets[name].long()).to(targets[name].dtype)
+            if name == 'pos':
+                sign = torch.ones_like(targets['regr'])
+                sign[:, 0] = 1 - 2 * rows.to(sign.dtype)
+                targets['regr'] = targets['regr'] * sign
+        return targets
+
+
+def flip_box_tensor(boxes, width):
+    # exact mirror (x' = width - x) of (n, 4) boxes 
+    boxes = torch.as_tensor(boxes)
+    return torch.stack([width - boxes[:, 2], boxes[:, 1], width - boxes[:, 0], boxes[:, 3]], 1)
+
+
+def blend(degenerate, images, factor):
+    # ImageEnhance : degenerate + factor * (image - degenerate), clipped 
+    factor = factor.view(-1, 1, 1, 1)
+    return (degenerate + factor * (images - degenerate)).clamp(0, 1)
+
+
+def grayscale(images):
+    # PIL 'L' conversion (ITU-R 601-2 luma)
+    return images[:, 0:1] * 0.299 + images[:, 1:2] * 0.587 + images[:, 2:3] * 0.114
+
+
+def adjust_sharpness(images, factor):
+    # ImageEnhance.Sharpness : blend with the SMOOTH filtered image, the border pixels are not filtered 
+    if bool((factor == 1).all()):
+        return images
+    # SMOOTH kernel [[1, 1, 1], [1, 5, 1], [1, 1, 1]] / 13 as a separable 3x3 box sum plus 4 * center
+    rows = images[:, :, :, :-2] + images[:, :, :, 2:]
+    rows += images[:, :, :, 1:-1]
+    box = rows[:, :, :-2] + rows[:, :, 2:]
+    box += rows[:, :, 1:-1]
+    box.add_(images[:, :, 1:-1, 1:-1], alpha=4).div_(13)
+    smooth = images.clone()
+    smooth[:, :, 1:-1, 1:-1] = box
+    return blend(smooth, images, factor)
+
+
+class AspectRatioBatchSampler(object):
+    """Batches of a single aspect ratio bucket (DataLoader(batch_sampler=...)), see Dataset(buckets=...)
+
+    Every epoch the images of each bucket are shuffled and cut into batches, then the batches of all the 
+    buckets are shuffled together. Without drop_last the last batch of a bucket can be smaller. 
+    """
+    def __init__(self, bucket, batch_size, shuffle=True, drop_last=True, seed=0):
+        self.bucket = np.asarray(bucket)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def batches(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        batches = []
+        for b in np.unique(self.bucket):
+            images = np.flatnonzero(self.bucket == b)
+            if self.shuffle:
+                images = rng.permutation(images)
+            for start in range(0, len(images), self.batch_size):
+                batch = images[start:start + self.batch_size].tolist()
+                if len(batch) == self.batch_size or not self.drop_last:
+                    batches.append(batch)
+        if self.shuffle:
+            batches = [batches[k] for k in rng.permutation(len(batches))]
+        return batches
+
+    def __iter__(self):
+        # the next epoch gets another order unless set_epoch is called 
+        batches = self.batches()
+        self.epoch += 1
+        return iter(batches)
 
     def __len__(self):
-        return max(self.pos.size(0), self.neg.size(0))
+        counts = np.bincount(self.bucket) if self.bucket.size > 0 else np.zeros(0, dtype=np.int64)
+        if self.drop_last:
+            return int((counts // self.batch_size).sum())
+        return int(((counts + self.batch_size - 1) // self.batch_size).sum())
+
+
+class BalancedRoiSampler(object):
+    """Balanced positive / negative roi minibatches, drawn in-process with a torch generator
+
+    Same schedule as the old Dataset_roi in a shuffled DataLoader, per image : the larger of the two sets 
+    is visited once in a random order, n_roi // 2 rois per minibatch, each paired with a roi of the smaller 
+    set (cycled). An image with only one kind of roi gives minibatches of n_roi // 2 of that kind. 
+    With several images, minibatch j gathers the j-th minibatch of every image. 
+    """
+    def __init__(self, n_roi, seed=None):
+        self.half = max(1, n_roi // 2)
+        self.generator = torch.Generator()
+        if seed is None:
+            self.generator.seed()
+        else:
+            self.generator.manual_seed(seed)
+
+    def _slots(self, rows, image, num_images, length):
+        # rows of one kind, shuffled within each image, then cycled over the length[image] slots of that image
+        order = torch.randperm(rows.size(0), generator=self.generator).to(rows.device)
+        rows, image = rows[order], image[order]
+        image, sort = torch.sort(image, stable=True)
+        rows = rows[sort]
+        count = torch.bincount(image, minlength=num_images)
+        start = torch.cumsum(count, 0) - count
+
+        length = torch.where(count > 0, length, torch.zeros_like(length))
+        slot_image = torch.repeat_interleave(torch.arange(num_images, device=rows.device), length)
+        slot = torch.arange(slot_image.size(0), device=rows.device) - torch.repeat_interleave(torch.cumsum(length, 0) - length, length)
+        return rows[start[slot_image] + slot % count[slot_image]], slot // self.half
+
+    def __call__(self, is_pos, is_neg, roi_index=None, num_images=1):
+        """
+        Args:
+            is_pos, is_neg: shape=(M,) bool, kind of each roi 
+            roi_index: shape=(M,) image of each roi (None : a single image)
+        Returns:
+            list of index tensors into the M rois, positives first 
+        """
+        if roi_index is None:
+            roi_index = torch.zeros(is_pos.size(0), dtype=torch.long, device=is_pos.device)
+        pos = torch.nonzero(is_pos, as_tuple=True)[0]
+        neg = torch.nonzero(is_neg, as_tuple=True)[0]
+        num_pos = torch.bincount(roi_index[pos], minlength=num_images)
+        num_neg = torch.bincount(roi_index[neg], minlength=num_images)
+        length = torch.maximum(num_pos, num_neg)
+
+        pos_rows, pos_step = self._slots(pos, roi_index[pos], num_images, length)
+        neg_rows, neg_step = self._slots(neg, roi_index[neg], num_images, length)
+        num_steps = int(max(pos_step.max().item() + 1 if pos_step.numel() else 0, 
+                            neg_step.max().item() + 1 if neg_step.numel() else 0))
+        return [torch.cat([pos_rows[pos_step == j], neg_rows[neg_step == j]]) for j in range(num_steps)]
 
 
 
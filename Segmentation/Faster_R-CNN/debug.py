@@ -249,17 +249,21 @@ temp = torch.cat(outputs,0)
 ########################################################################################################################################################################################################################
 
 from loss import rpn_loss_regr , rpn_loss_cls_fixed_num 
+from dataset import collate_fn 
 import torch 
 
-y_rpn_regr = torch.rand(1,10,20,36)
-pred = torch.rand(1,10,20,36)
 y_is_box_label = torch.rand(1,10,20,9) 
 y_is_box_label = (y_is_box_label > 0.66).float() * 1 + (y_is_box_label < 0.33).float() * -1
+pos = torch.where(y_is_box_label.view(-1) == 1)[0]
+neg = torch.where(y_is_box_label.view(-1) == -1)[0]
+sample = (torch.rand(3, 10, 20), [], [], {'pos': pos, 'neg': neg, 'regr': torch.rand(pos.size(0), 4)}, pos.size(0))
+_, _, _, targets, _ = collate_fn([sample])
 
-l1 = rpn_loss_regr(y_true=y_rpn_regr, y_pred=pred , y_is_box_label=y_is_box_label)
+pred = torch.rand(1,10,20,36)
+l1 = rpn_loss_regr(targets, y_pred=pred)
 
 pred = torch.rand(1,10,20,9)
-l2 = rpn_loss_cls_fixed_num(y_pred = pred , y_is_box_label= y_is_box_label)
+l2 = rpn_loss_cls_fixed_num(y_pred = pred , targets= targets)
 
 
 
@@ -0,0 +1,158 @@
+import sys
+import json
+import argparse
+
+import torch
+import torch.nn as nn
+
+from tools import get_anchors , rpn_to_roi_batch
+from model import roi_pool_avg
+from infer import load_models , batch_rois , select_detections
+
+# One TorchScript graph for the whole detection of a batch : backbone, RPN head, proposal decode + NMS, roi pooling,
+# classifier, box decode, per class NMS. The graph (with its anchor grid and thresholds) is saved with torch.jit.save,
+# runtime.py loads it with torch only (no main.py, matplotlib or torchvision models) :
+#   python detector.py -s models/ -o detector.pt
+#   python runtime.py detector.pt images/ -o detections.jsonl
+# The graph is built for one input size (--height x --width, the anchor grid is a constant of it).
+# torch.export is not used : the NMS loops run until a data dependent fixed point, TorchScript keeps them as loops.
+MEAN = (0.485, 0.456, 0.406)
+STD = (0.229, 0.224, 0.225)
+
+
+class RoiPoolAvg(nn.Module):
+    def __init__(self, output_size=7):
+        super(RoiPoolAvg, self).__init__()
+        self.output_size = output_size
+
+    def forward(self, features, rois):
+        return roi_pool_avg(features, rois, self.output_size)
+
+
+class RoiAlign(nn.Module):
+    # the op of torchvision.ops.roi_align, the graph then needs torchvision (ops only) to load, see runtime.py
+    def __init__(self, output_size=7, sampling_ratio=2):
+        super(RoiAlign, self).__init__()
+        self.output_size = output_size
+        self.sampling_ratio = sampling_ratio
+
+    def forward(self, features, rois):
+        return torch.ops.torchvision.roi_align(features, rois.float(), 1.0, self.output_size, self.output_size,
+                                                self.sampling_ratio, True)
+
+
+class Detector(nn.Module):
+    """model_rpn + model_classifier + post processing, same detections as infer.detect
+
+    forward takes uint8 images (B, H, W, 3) RGB, normalized inside the graph, or float images (B, 3, H, W)
+    already normalized (like infer.ImageList). Returns boxes (B, max_detections, 4) x1, y1, x2, y2 in pixels
+    of the input, scores, classes (B, max_detections) and num (B,), padded like infer.detect.
+    """
+    def __init__(self, model_rpn, model_classifier, anchors, bg_class, score_thresh=0.5, nms_thresh=0.3, max_detections=100,
+                 rpn_max_boxes=300, rpn_overlap_thresh=0.9, classifier_regr_std=(8.0, 8.0, 4.0, 4.0)):
+        super(Detector, self).__init__()
+        self.rpn = model_rpn
+        # the layers of model_classifier, Classifier.forward also takes (R, 4) rois and any pooling mode
+        self.red_conv_roi = model_classifier.red_conv_roi
+        self.pool = RoiAlign(model_classifier.pooling_regions) if getattr(model_classifier, 'pooling', 'avg') == 'align' \
+            else RoiPoolAvg(model_classifier.pooling_regions)
+        self.d1, self.d2, self.d3, self.d4 = model_classifier.d1, model_classifier.d2, model_classifier.d3, model_classifier.d4
+
+        # Anchors.grid_tensor shares the read-only buffer of the anchor registry
+        self.register_buffer('grid', anchors.grid_tensor().clone())
+        self.register_buffer('mean', torch.tensor(MEAN).reshape(1, 3, 1, 1))
+        self.register_buffer('std', torch.tensor(STD).reshape(1, 3, 1, 1))
+        self.height, self.width = anchors.height, anchors.width
+        self.bg_class = bg_class
+        self.score_thresh = score_thresh
+        self.nms_thresh = nms_thresh
+        self.max_detections = max_detections
+        self.rpn_max_boxes = rpn_max_boxes
+        self.rpn_overlap_thresh = rpn_overlap_thresh
+        self.classifier_regr_std = [float(v) for v in classifier_regr_std]
+
+    def forward(self, images):
+        if images.dtype == torch.uint8:
+            images = (images.permute(0, 3, 1, 2).float() / 255 - self.mean) / self.std
+        if images.size(2) != self.height or images.size(3) != self.width:
+            raise ValueError("images of {} x {}, the detector was exported for {} x {}".format(
+                images.size(2), images.size(3), self.height, self.width))
+
+        base_x, cls_k, reg_k = self.rpn(images)
+        rois, num_rois = rpn_to_roi_batch(cls_k, reg_k, self.grid, max_boxes=self.rpn_max_boxes, overlap_thresh=self.rpn_overlap_thresh)
+        roi_index, roi = batch_rois(num_rois, rois.size(1))
+
+        # Classifier.forward in eval mode (no dropout)
+        features = self.pool(self.red_conv_roi(base_x), torch.cat([roi_index[:, None].to(rois.dtype), rois[roi_index, roi]], 1))
+        x = features.reshape(features.size(0), -1)
+        x = torch.relu(self.d2(torch.relu(self.d1(x))))
+        out_class = torch.softmax(self.d3(x), dim=1)
+        out_regr = self.d4(x)
+
+        return select_detections(rois, num_rois, roi_index, roi, out_class, out_regr, images.size(2), images.size(3), self.grid.size(1),
+                                 self.bg_class, self.score_thresh, self.nms_thresh, self.max_detections, self.classifier_regr_std)
+
+
+def build_detector(save_dir, height=512, width=512, labels=('yeast_cell',), anchor_sizes=(8, 16, 32, 64, 128), anchor_ratios=(0.5, 1, 2), **kwargs):
+    """Detector of the checkpoint in save_dir (eval mode, cpu), kwargs are the thresholds of Detector"""
+    model_rpn, model_classifier = load_models(save_dir, device='cpu')
+    anchors = get_anchors(height, width, list(anchor_sizes), list(anchor_ratios))
+    if anchors.num_anchors != model_rpn.num_anchors:
+        raise ValueError("{} anchors per location, the checkpoint has {}".format(anchors.num_anchors, model_rpn.num_anchors))
+    return Detector(model_rpn, model_classifier, anchors, bg_class=len(labels), **kwargs).eval()
+
+
+def export_detector(detector, path, labels=('yeast_cell',), freeze=True):
+    """Scripts detector and saves it to path with its config (input size, labels, thresholds)
+
+    freeze inlines the weights in the graph (torch.jit.freeze), the saved module is for inference only.
+    Returns:
+        the scripted module
+    """
+    scripted = torch.jit.script(detector.eval())
+    if freeze:
+        scripted = torch.jit.freeze(scripted)
+    config = {
+        'height': detector.height,
+        'width': detector.width,
+        'labels': list(labels) + ['bg'],
+        'pooling': 'align' if isinstance(detector.pool, RoiAlign) else 'avg',
+        'score_thresh': detector.score_thresh,
+        'nms_thresh': detector.nms_thresh,
+        'max_detections': detector.max_detections,
+        'rpn_max_boxes': detector.rpn_max_boxes,
+    }
+    torch.jit.save(scripted, path, _extra_files={'config.json': json.dumps(config)})
+    return scripted
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Export a checkpoint as one TorchScript detector (see runtime.py)')
+    parser.add_argument('-s', '--save-dir', type=str, default='models/', help="folder of the checkpoint (utils.save_checkpoint)")
+    parser.add_argument('-o', '--output', type=str, default='detector.pt')
+    parser.add_argument('--labels', type=str, default='yeast_cell', help="comma separated class names, in the order of training (bg is added last)")
+    parser.add_argument('--height', type=int, default=512)
+    parser.add_argument('--width', type=int, default=512)
+    parser.add_argument('--anchor-sizes', type=str, default='8,16,32,64,128')
+    parser.add_argument('--anchor-ratios', type=str, default='0.5,1,2')
+    parser.add_argument('--score-thresh', type=float, default=0.5, help="minimum class score of a detection")
+    parser.add_argument('--nms-thresh', type=float, default=0.3, help="per class NMS overlap")
+    parser.add_argument('--max-detections', type=int, default=100, help="per image")
+    parser.add_argument('--rpn-max-boxes', type=int, default=300, help="proposals per image")
+    parser.add_argument('--no-freeze', action='store_true', default=False, help="if used, keep the weights as parameters of the graph")
+    return parser.parse_args(argv)
+
+
+def run(args):
+    labels = args.labels.split(',')
+    detector = build_detector(args.save_dir, args.height, args.width, labels,
+                              anchor_sizes=[int(s) for s in args.anchor_sizes.split(',')],
+                              anchor_ratios=[float(r) for r in args.anchor_ratios.split(',')],
+                              score_thresh=args.score_thresh, nms_thresh=args.nms_thresh,
+                              max_detections=args.max_detections, rpn_max_boxes=args.rpn_max_boxes)
+    export_detector(detector, args.output, labels, freeze=not args.no_freeze)
+    print("detector for {} x {} images saved to {}".format(args.height, args.width, args.output), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    run(parse_args())
@@ -0,0 +1,145 @@
+import os
+import time
+import math
+import functools
+import torch
+
+# Diagnostics of the hot paths (tools.py, dataset.py)
+#   log()              : leveled messages, at most one per `interval` seconds per callsite, the others are counted
+#   count() / observe(): named counters and log2 histograms in a shared memory table, one row per process
+#                        (main process + DataLoader workers), summed and printed by flush() every N steps
+# Everything is disabled by default, a disabled call is a single global check. Arguments that cost something
+# (a .item() on the GPU ...) are guarded with enabled(level) / collecting().
+
+DEBUG, INFO, WARNING, OFF = 10, 20, 30, 100
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'off': OFF}
+
+COUNTERS = ('nms.calls', 'nms.boxes_in', 'nms.boxes_kept',
+            'rpn.images', 'rpn.pos_anchors', 'rpn.neg_anchors',
+            'roi.images', 'roi.proposals', 'roi.matched', 'roi.pos', 'roi.neg')
+HISTOGRAMS = ('nms.boxes_kept', 'rpn.pos_anchors', 'roi.pos')
+# bucket 0 counts 0, bucket k counts [2 ** (k - 1), 2 ** k), the last one is open
+NUM_BUCKETS = 16
+
+# the environment variable reaches the workers of any start method
+level = LEVELS[os.environ.get('FRCNN_DIAG', 'off').lower()]
+interval = 1.0
+_last = {} # callsite ==> (time of the last message, messages suppressed since)
+_stats = None
+_row = 0
+
+
+def configure(log_level=None, log_interval=None):
+    global level, interval
+    if log_level is not None:
+        level = LEVELS[log_level] if isinstance(log_level, str) else log_level
+        os.environ['FRCNN_DIAG'] = {v: k for k, v in LEVELS.items()}.get(level, 'off')
+    if log_interval is not None:
+        interval = log_interval
+
+
+def enabled(lvl):
+    return lvl >= level
+
+
+def log(lvl, site, msg, *args):
+    """print msg.format(*args) if lvl is enabled and site did not print in the last `interval` seconds"""
+    if lvl < level:
+        return
+    now = time.monotonic()
+    last, suppressed = _last.get(site, (-math.inf, 0))
+    if now - last < interval:
+        _last[site] = (last, suppressed + 1)
+        return
+    _last[site] = (now, 0)
+    text = msg.format(*args) if args else msg
+    if suppressed > 0:
+        text += " ({} more suppressed)".format(suppressed)
+    print("[{}] {}".format(site, text))
+
+
+class Stats(object):
+    """Counters and histograms of every process, shape=(num_workers + 1, num_slots) int64 in shared memory
+
+    Each row has a single writer (row 0 is the main process, row w + 1 the DataLoader worker w),
+    so the updates need no lock. flush() reads the sum of the rows.
+    """
+    def __init__(self, num_workers):
+        self.counter_slot = {name: i for i, name in enumerate(COUNTERS)}
+        self.histogram_slot = {name: len(COUNTERS) + i * NUM_BUCKETS for i, name in enumerate(HISTOGRAMS)}
+        self.table = torch.zeros(num_workers + 1, len(COUNTERS) + len(HISTOGRAMS) * NUM_BUCKETS, dtype=torch.int64).share_memory_()
+        self.values = self.table.numpy()
+        self.last = self.values.sum(0)
+
+    def __getstate__(self):
+        # spawned workers : the shared tensor pickles as a handle, the numpy view is rebuilt
+        state = dict(self.__dict__)
+        del state['values']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.values = self.table.numpy()
+
+
+def enable_stats(num_workers=0):
+    # before the DataLoaders are created, see worker_init
+    global _stats
+    _stats = Stats(num_workers)
+    return _stats
+
+
+def worker_init_fn(worker_id, stats=None):
+    # DataLoader(worker_init_fn=...) : rows are per worker, stats is only needed with the spawn start method
+    global _stats, _row
+    if stats is not None:
+        _stats = stats
+    if _stats is not None:
+        if worker_id + 1 >= _stats.values.shape[0]:
+            raise ValueError("diag.enable_stats(num_workers={}) used with worker {}".format(_stats.values.shape[0] - 1, worker_id))
+        _row = worker_id + 1
+
+
+def worker_init():
+    """DataLoader(worker_init_fn=diag.worker_init()) : worker_init_fn bound to the current table, works with any start method"""
+    return functools.partial(worker_init_fn, stats=_stats)
+
+
+def collecting():
+    return _stats is not None
+
+
+def count(name, value=1):
+    if _stats is None:
+        return
+    _stats.values[_row, _stats.counter_slot[name]] += value
+
+
+def observe(name, value):
+    if _stats is None:
+        return
+    bucket = min(NUM_BUCKETS - 1, int(value).bit_length())
+    _stats.values[_row, _stats.histogram_slot[name] + bucket] += 1
+
+
+def flush(step, every):
+    """Print the counters / histograms of all the processes since the last flush, every `every` steps
+
+    Returns:
+        (counters, histograms) dicts, None when nothing was flushed
+    """
+    if _stats is None or every <= 0 or step % every != 0:
+        return None
+    total = _stats.values.sum(0)
+    delta = total - _stats.last
+    _stats.last = total
+    counters = {name: int(delta[i]) for name, i in _stats.counter_slot.items()}
+    histograms = {name: delta[i:i + NUM_BUCKETS].tolist() for name, i in _stats.histogram_slot.items()}
+
+    print("[diag] step {} : ".format(step) + " ".join("{}={}".format(k, v) for k, v in counters.items()))
+    for name, hist in histograms.items():
+        # lower bound of the bucket : count, empty buckets left out
+        if sum(hist) == 0:
+            continue
+        print("[diag] {} : ".format(name) + " ".join("{}:{}".format(0 if k == 0 else 2 ** (k - 1), c) for k, c in enumerate(hist) if c > 0))
+    return counters, histograms
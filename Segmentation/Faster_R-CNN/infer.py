@@ -0,0 +1,412 @@
+import os
+import sys
+import json
+import math
+import time
+import argparse
+
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import DataLoader
+
+from tools import get_anchors , rpn_to_roi_batch , batched_nms
+from utils import load_checkpoint , iou_matrix
+from dataset import Transform
+
+# Inference of a trained checkpoint (utils.save_checkpoint) on images without annotations
+#   python infer.py images/ -s models/ -o detections.jsonl
+# one JSON line per image : {"image": path, "boxes": [[x1, y1, x2, y2], ...] in pixels of the original image,
+# "scores": [...], "labels": [...]}, written (and flushed) batch by batch.
+# --tile runs the models on overlapping tiles of the full resolution frame instead of the frame resized to --height x --width,
+# see TiledImages and merge_tiles.
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp')
+
+
+def list_images(inputs):
+    # folders (sorted, not recursive), text files with one path per line, image files
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            paths += [os.path.join(item, f) for f in sorted(os.listdir(item)) if f.lower().endswith(IMAGE_EXTENSIONS)]
+        elif item.endswith('.txt'):
+            with open(item, 'r') as f:
+                paths += [line.strip() for line in f if line.strip()]
+        else:
+            paths.append(item)
+    return paths
+
+
+class ImageList(torch.utils.data.Dataset):
+    """Images resized to resize_size (h, w) and normalized like the test split of Dataset"""
+    def __init__(self, paths, resize_size, decode='full'):
+        super(ImageList, self).__init__()
+        self.paths = paths
+        self.transform = Transform(train=False, resize_size=resize_size, decode=decode)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, i):
+        image, orig_size = self.transform.open(self.paths[i])
+        image, _ = self.transform.apply_transform(image, [], orig_size=orig_size)
+        return self.transform.normalize(self.transform.to_tensor(image)), i, orig_size
+
+
+def collate_images(batch):
+    return torch.stack([b[0] for b in batch], 0), [b[1] for b in batch], [b[2] for b in batch]
+
+
+def load_models(save_dir, device='cpu'):
+    # model_rpn, model_classifier of the checkpoint in save_dir, in eval mode
+    state = load_checkpoint(save_dir, device='cpu' if torch.device(device).type == 'cpu' else device)
+    if state is None:
+        raise FileNotFoundError("no model.pth.tar checkpoint in {}".format(save_dir))
+    if not hasattr(state['model_classifier'], 'pooling'):
+        # checkpoints from before the roi pooling option
+        state['model_classifier'].pooling = 'avg'
+    if 'int8' in state:
+        # checkpoint of quantize.py, the quantized kernels run on cpu only
+        if torch.device(device).type != 'cpu':
+            raise ValueError("the checkpoint in {} is quantized (INT8), use --device cpu".format(save_dir))
+        from quantize import load_int8
+        return load_int8(state)
+    return state['model_rpn'].to(device).eval(), state['model_classifier'].to(device).eval()
+
+
+def decode_boxes(rois, regr, classifier_regr_std=(8.0, 8.0, 4.0, 4.0)):
+    # type: (Tensor, Tensor, List[float]) -> Tensor
+    """Inverse of the classifier regression targets of calc_iou_batch
+
+    Args:
+        rois: shape=(..., 4) x1, y1, x2, y2 on the feature map
+        regr: shape=(..., 4) tx, ty, tw, th scaled by classifier_regr_std
+    Returns:
+        shape=(..., 4) x1, y1, x2, y2 on the feature map
+    """
+    x1, y1, x2, y2 = rois.unbind(-1)
+    w, h = x2 - x1, y2 - y1
+    t = regr / torch.tensor(classifier_regr_std, dtype=regr.dtype, device=regr.device)
+    tx, ty, tw, th = t.unbind(-1)
+    cx = x1 + w / 2.0 + tx * w
+    cy = y1 + h / 2.0 + ty * h
+    w1 = torch.exp(tw) * w
+    h1 = torch.exp(th) * h
+    return torch.stack([cx - w1 / 2, cy - h1 / 2, cx + w1 / 2, cy + h1 / 2], -1)
+
+
+@torch.no_grad()
+def detect(model_rpn, model_classifier, images, grid, bg_class, score_thresh=0.5, nms_thresh=0.3, max_detections=100,
+           rpn_max_boxes=300, rpn_overlap_thresh=0.9, classifier_regr_std=(8.0, 8.0, 4.0, 4.0)):
+    """Detections of a batch : proposals, classifier on all the rois of the batch at once, per class NMS
+
+    The classifier regression of class c is the c-th block of 4 (bg is the last class, see calc_iou_batch).
+    Args:
+        images: shape=(B, 3, H, W) normalized
+        grid: anchor grid of (H, W), Anchors.grid_tensor
+    Returns:
+        boxes: shape=(B, max_detections, 4) x1, y1, x2, y2 in pixels of images, padded with 0
+        scores, classes: shape=(B, max_detections)
+        num: shape=(B,) number of detections per image
+    """
+    base_x, cls_k, reg_k = model_rpn(images)
+    rois, num_rois = rpn_to_roi_batch(cls_k, reg_k, grid, max_boxes=rpn_max_boxes, overlap_thresh=rpn_overlap_thresh)
+    roi_index, roi = batch_rois(num_rois, rois.size(1))
+    out_class, out_regr = model_classifier(base_x, torch.cat([roi_index[:, None].to(rois.dtype), rois[roi_index, roi]], 1))
+    return select_detections(rois, num_rois, roi_index, roi, out_class, out_regr, images.size(2), images.size(3), grid.size(1), bg_class,
+                             score_thresh, nms_thresh, max_detections, list(classifier_regr_std))
+
+
+def batch_rois(num_rois, k):
+    # type: (Tensor, int) -> Tuple[Tensor, Tensor]
+    # (image, roi) of the valid rois of a padded (B, k) batch
+    valid = torch.arange(k, device=num_rois.device)[None, :] < num_rois[:, None]
+    index = torch.nonzero(valid)
+    return index[:, 0], index[:, 1]
+
+
+def select_detections(rois, num_rois, roi_index, roi, out_class, out_regr, height, width, grid_height, bg_class,
+                      score_thresh, nms_thresh, max_detections, classifier_regr_std):
+    # type: (Tensor, Tensor, Tensor, Tensor, Tensor, Tensor, int, int, int, int, float, float, int, List[float]) -> Tuple[Tensor, Tensor, Tensor, Tensor]
+    """Second stage of detect : class scores and boxes of the rois, per class NMS, best max_detections per image
+
+    Scriptable, the Detector of detector.py runs the same code.
+    """
+    b, k = rois.size(0), rois.size(1)
+    valid = torch.arange(k, device=rois.device)[None, :] < num_rois[:, None]
+
+    # dense (B, K, F) over the F foreground classes
+    num_classes = out_class.size(1)
+    fg = torch.arange(num_classes, device=out_class.device)
+    fg = fg[fg != bg_class]
+    f = fg.size(0)
+    probs = out_class.new_zeros(b, k, f)
+    probs[roi_index, roi] = out_class[:, fg]
+    regr = out_regr.new_zeros(b, k, f, 4)
+    regr[roi_index, roi] = out_regr.reshape(-1, num_classes - 1, 4)[:, :f]
+
+    downscale = height / grid_height
+    boxes = decode_boxes(rois[:, :, None, :].expand(b, k, f, 4), regr, classifier_regr_std) * downscale
+    boxes = torch.stack([boxes[..., 0].clamp(0, width), boxes[..., 1].clamp(0, height),
+                         boxes[..., 2].clamp(0, width), boxes[..., 3].clamp(0, height)], -1)
+
+    # one NMS problem per (image, class)
+    boxes = boxes.permute(0, 2, 1, 3).reshape(b * f, k, 4)
+    probs = probs.permute(0, 2, 1).reshape(b * f, k)
+    alive = valid[:, None, :].expand(b, f, k).reshape(b * f, k) & (probs >= score_thresh)
+    keep, num_keep = batched_nms(boxes, probs, overlap_thresh=nms_thresh, max_boxes=max_detections, valid=alive)
+
+    # best max_detections of all the classes of an image
+    kept = torch.arange(max_detections, device=keep.device)[None, :] < num_keep[:, None]
+    scores = torch.where(kept, torch.gather(probs, 1, keep), torch.full_like(keep, -1, dtype=probs.dtype))
+    boxes = torch.gather(boxes, 1, keep[:, :, None].expand(-1, -1, 4))
+    classes = fg[None, :, None].expand(b, f, max_detections).reshape(b, -1)
+    scores, boxes = scores.reshape(b, -1), boxes.reshape(b, -1, 4)
+    scores, order = scores.sort(dim=1, descending=True, stable=True)
+    order, scores = order[:, :max_detections], scores[:, :max_detections]
+    num = (scores >= 0).sum(1)
+    pad = torch.arange(order.size(1), device=order.device)[None, :] >= num[:, None]
+    boxes = torch.gather(boxes, 1, order[:, :, None].expand(-1, -1, 4)).masked_fill(pad[:, :, None], 0)
+    classes = torch.gather(classes, 1, order).masked_fill(pad, 0)
+    return boxes, scores.masked_fill(pad, 0), classes, num
+
+
+def tile_origins(length, tile, overlap):
+    """Starts of the tiles along one axis (the last one flush with the end) and the core of every tile
+
+    Cores split the axis at the middle of the overlap of two neighbours, every position belongs to 
+    exactly one core. The first and last cores are open ended (boxes clamped on the border of the frame). 
+    Returns:
+        starts, cores: list of int, list of (begin, end)
+    """
+    if not 0 <= overlap < tile:
+        raise ValueError("tile overlap of {} pixels for tiles of {}, it must be >= 0 and smaller than the tile".format(overlap, tile))
+    if length <= tile:
+        return [0], [(-math.inf, math.inf)]
+    starts = list(range(0, length - tile, tile - overlap)) + [length - tile]
+    cuts = [-math.inf] + [(starts[i] + tile + starts[i + 1]) / 2 for i in range(len(starts) - 1)] + [math.inf]
+    return starts, [(cuts[i], cuts[i + 1]) for i in range(len(starts))]
+
+
+class TiledImages(torch.utils.data.IterableDataset):
+    """Overlapping tiles of the frames of paths, normalized, cut one at a time
+
+    A frame is decoded once (uint8, scaled by scale), tiles are views of it converted to float only when
+    they are yielded : a worker holds one frame and the tiles of the batches in flight, never the whole frame 
+    in float. Tiles past the border (frames smaller than a tile) are padded with the mean (0 once normalized).
+    The workers split the frames, every tile carries its frame index, origin, core and the number of tiles of its frame.
+    """
+    def __init__(self, paths, tile_size, overlap=64, scale=1.0):
+        super(TiledImages, self).__init__()
+        self.paths = paths
+        self.tile_h, self.tile_w = tile_size
+        self.overlap = overlap
+        self.scale = scale
+        self.transform = Transform(train=False)
+
+    def frame(self, i):
+        image = Image.open(self.paths[i], mode='r')
+        orig_size = image.size
+        image = image.convert('RGB')
+        if self.scale != 1.0:
+            image = image.resize((round(orig_size[0] * self.scale), round(orig_size[1] * self.scale)))
+        return np.asarray(image), orig_size
+
+    def __iter__(self):
+        worker, num_workers = 0, 1
+        info = torch.utils.data.get_worker_info()
+        if info is not None:
+            worker, num_workers = info.id, info.num_workers
+        for i in range(worker, len(self.paths), num_workers):
+            frame, orig_size = self.frame(i)
+            h, w = frame.shape[:2]
+            ys, y_cores = tile_origins(h, self.tile_h, self.overlap)
+            xs, x_cores = tile_origins(w, self.tile_w, self.overlap)
+            for y0, (cy0, cy1) in zip(ys, y_cores):
+                for x0, (cx0, cx1) in zip(xs, x_cores):
+                    crop = frame[y0:y0 + self.tile_h, x0:x0 + self.tile_w]
+                    tile = torch.zeros(3, self.tile_h, self.tile_w)
+                    tile[:, :crop.shape[0], :crop.shape[1]] = self.transform.normalize(self.transform.to_tensor(crop))
+                    yield tile, i, (x0, y0), (cx0, cy0, cx1, cy1), len(ys) * len(xs), orig_size
+
+
+def collate_tiles(batch):
+    return torch.stack([b[0] for b in batch], 0), [b[1:] for b in batch]
+
+
+def merge_tiles(boxes, scores, classes, merge_thresh=0.3, mode='nms', max_detections=1000):
+    """Detections of the tiles of a frame ==> detections of the frame
+
+    boxes / scores / classes are those kept by the cores of their tiles (a box belongs to the tile whose core holds
+    its center, so an object smaller than the overlap is seen whole, and once). What is left across the seams 
+    (larger objects) goes through one more NMS per class ('nms'), or is averaged into the kept box weighted
+    by the scores ('fusion', boxes of the class above merge_thresh IoU with it).
+    Args:
+        boxes: shape=(N, 4) x1, y1, x2, y2 in frame pixels
+    """
+    keep_all = []
+    for c in torch.unique(classes).tolist():
+        rows = torch.nonzero(classes == c, as_tuple=True)[0]
+        keep, num_keep = batched_nms(boxes[rows][None], scores[rows][None], overlap_thresh=merge_thresh, max_boxes=min(max_detections, rows.numel()))
+        keep = rows[keep[0, :num_keep[0]]]
+        if mode == 'fusion' and keep.numel() > 0:
+            ious = torch.from_numpy(iou_matrix(boxes[keep].numpy(), boxes[rows].numpy())).to(scores.dtype)
+            weights = (ious > merge_thresh).to(scores.dtype) * scores[rows][None, :]
+            fused = weights @ boxes[rows] / weights.sum(1, keepdim=True)
+            boxes = boxes.clone()
+            boxes[keep] = fused
+        keep_all.append(keep)
+    if not keep_all:
+        return boxes[:0], scores[:0], classes[:0]
+    keep = torch.cat(keep_all)
+    keep = keep[torch.argsort(scores[keep], descending=True, stable=True)][:max_detections]
+    return boxes[keep], scores[keep], classes[keep]
+
+
+class DetectionWriter(object):
+    # JSON lines, flushed after every batch so a long run can be followed (or resumed by hand)
+    def __init__(self, path):
+        self.f = sys.stdout if path == '-' else open(path, 'w')
+
+    def write(self, image, boxes, scores, labels):
+        self.f.write(json.dumps({'image': image, 'boxes': boxes, 'scores': scores, 'labels': labels}) + "\n")
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        if self.f is not sys.stdout:
+            self.f.close()
+
+
+def run(args):
+    """Detections of every image of args.inputs written to args.output
+
+    Returns:
+        dict with the number of images, the time and images per second (model + decode, after the first batch)
+    """
+    device = torch.device(args.device)
+    paths = list_images(args.inputs)
+    labels = args.labels.split(',') + ['bg']
+    height, width = args.height, args.width
+
+    model_rpn, model_classifier = load_models(args.save_dir, device=device)
+    anchor_sizes = [int(s) for s in args.anchor_sizes.split(',')]
+    anchor_ratios = [float(r) for r in args.anchor_ratios.split(',')]
+    anchors = get_anchors(height, width, anchor_sizes, anchor_ratios)
+    if anchors.num_anchors != model_rpn.num_anchors:
+        raise ValueError("{} anchors per location, the checkpoint has {}".format(anchors.num_anchors, model_rpn.num_anchors))
+    grid = anchors.grid_tensor(device=device)
+
+    writer = DetectionWriter(args.output)
+    if args.tile:
+        return run_tiled(args, paths, labels, model_rpn, model_classifier, grid, writer)
+    loader = DataLoader(ImageList(paths, (height, width), decode=args.decode), batch_size=args.batch_size, num_workers=args.workers,
+                        collate_fn=collate_images, pin_memory=device.type == 'cuda')
+    count, start = 0, None
+    try:
+        for images, indices, sizes in loader:
+            boxes, scores, classes, num = detect(model_rpn, model_classifier, images.to(device), grid, bg_class=len(labels) - 1,
+                                                 score_thresh=args.score_thresh, nms_thresh=args.nms_thresh,
+                                                 max_detections=args.max_detections, rpn_max_boxes=args.rpn_max_boxes)
+            boxes, scores, classes, num = boxes.cpu(), scores.cpu(), classes.cpu(), num.tolist()
+            for j, i in enumerate(indices):
+                # back to the pixels of the original image
+                sx, sy = sizes[j][0] / width, sizes[j][1] / height
+                write_detections(writer, paths[i], boxes[j, :num[j]] * torch.tensor([sx, sy, sx, sy]), scores[j, :num[j]], classes[j, :num[j]], labels)
+            writer.flush()
+            # the first batch pays for the worker start and the allocator warm up
+            if start is None:
+                start = time.perf_counter()
+            else:
+                count += len(indices)
+    finally:
+        writer.close()
+    elapsed = time.perf_counter() - start if start is not None else 0.0
+    stats = {'images': len(paths), 'timed_images': count, 'time': elapsed, 'images_per_sec': count / elapsed if elapsed > 0 else 0.0}
+    print("{} images , {:.2f} images / s".format(len(paths), stats['images_per_sec']), file=sys.stderr)
+    return stats
+
+
+def write_detections(writer, path, boxes, scores, classes, labels):
+    writer.write(path, [[round(c, 2) for c in bx] for bx in boxes.tolist()], [round(v, 4) for v in scores.tolist()],
+                 [labels[c] for c in classes.tolist()])
+
+
+def run_tiled(args, paths, labels, model_rpn, model_classifier, grid, writer):
+    # --tile : batches of --tile-batch tiles of any frames, a frame is merged and written once all its tiles are in
+    device = torch.device(args.device)
+    loader = DataLoader(TiledImages(paths, (args.height, args.width), overlap=args.tile_overlap, scale=args.tile_scale),
+                        batch_size=args.tile_batch, num_workers=args.workers, collate_fn=collate_tiles, pin_memory=device.type == 'cuda')
+    pending = {} # frame ==> detections of its tiles so far
+    count, tiles, start = 0, 0, None
+    try:
+        for images, infos in loader:
+            boxes, scores, classes, num = detect(model_rpn, model_classifier, images.to(device), grid, bg_class=len(labels) - 1,
+                                                 score_thresh=args.score_thresh, nms_thresh=args.nms_thresh,
+                                                 max_detections=args.max_detections, rpn_max_boxes=args.rpn_max_boxes)
+            boxes, scores, classes, num = boxes.cpu(), scores.cpu(), classes.cpu(), num.tolist()
+            for j, (i, (x0, y0), (cx0, cy0, cx1, cy1), num_tiles, orig_size) in enumerate(infos):
+                bxs = boxes[j, :num[j]] + torch.tensor([x0, y0, x0, y0], dtype=boxes.dtype)
+                # the tile keeps the boxes centered in its core
+                cx, cy = (bxs[:, 0] + bxs[:, 2]) / 2, (bxs[:, 1] + bxs[:, 3]) / 2
+                own = (cx >= cx0) & (cx < cx1) & (cy >= cy0) & (cy < cy1)
+                entry = pending.setdefault(i, [0, [], [], []])
+                entry[0] += 1
+                entry[1].append(bxs[own])
+                entry[2].append(scores[j, :num[j]][own])
+                entry[3].append(classes[j, :num[j]][own])
+                if entry[0] == num_tiles:
+                    del pending[i]
+                    merged = merge_tiles(torch.cat(entry[1]), torch.cat(entry[2]), torch.cat(entry[3]), merge_thresh=args.tile_merge_thresh,
+                                         mode=args.tile_merge, max_detections=args.max_detections * num_tiles)
+                    write_detections(writer, paths[i], merged[0] / args.tile_scale, merged[1], merged[2], labels)
+                    count += 1 if start is not None else 0
+            writer.flush()
+            if start is None:
+                start = time.perf_counter()
+            else:
+                tiles += images.size(0)
+    finally:
+        writer.close()
+    elapsed = time.perf_counter() - start if start is not None else 0.0
+    stats = {'images': len(paths), 'timed_images': count, 'timed_tiles': tiles, 'time': elapsed,
+             'images_per_sec': count / elapsed if elapsed > 0 else 0.0, 'tiles_per_sec': tiles / elapsed if elapsed > 0 else 0.0}
+    print("{} images , {:.2f} tiles / s".format(len(paths), stats['tiles_per_sec']), file=sys.stderr)
+    return stats
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Faster RCNN inference on a folder / list of images')
+    parser.add_argument('inputs', nargs='+', help="image files, folders of images or .txt files with one path per line")
+    parser.add_argument('-s', '--save-dir', type=str, default='models/', help="folder of the checkpoint (utils.save_checkpoint)")
+    parser.add_argument('-o', '--output', type=str, default='detections.jsonl', help="JSON lines output, - for stdout")
+    parser.add_argument('--labels', type=str, default='yeast_cell', help="comma separated class names, in the order of training (bg is added last)")
+    parser.add_argument('--batch-size', type=int, default=4)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--height', type=int, default=512)
+    parser.add_argument('--width', type=int, default=512)
+    parser.add_argument('--decode', type=str, default='full', choices=['full', 'draft'])
+    parser.add_argument('--anchor-sizes', type=str, default='8,16,32,64,128')
+    parser.add_argument('--anchor-ratios', type=str, default='0.5,1,2')
+    parser.add_argument('--score-thresh', type=float, default=0.5, help="minimum class score of a detection")
+    parser.add_argument('--nms-thresh', type=float, default=0.3, help="per class NMS overlap")
+    parser.add_argument('--max-detections', type=int, default=100, help="per image")
+    parser.add_argument('--rpn-max-boxes', type=int, default=300, help="proposals per image")
+    parser.add_argument('--tile', action='store_true', default=False,
+                        help="if used, run on --height x --width tiles of the full resolution frame (scaled by --tile-scale)")
+    parser.add_argument('--tile-overlap', type=int, default=64, help="pixels shared by two neighbour tiles, above the size of an object")
+    parser.add_argument('--tile-scale', type=float, default=1.0, help="scale of the frame before tiling")
+    parser.add_argument('--tile-batch', type=int, default=max(2, torch.get_num_threads()), help="tiles per batch (default : the number of threads)")
+    parser.add_argument('--tile-merge', type=str, default='nms', choices=['nms', 'fusion'], help="merge of the boxes across the seams")
+    parser.add_argument('--tile-merge-thresh', type=float, default=0.3)
+    args = parser.parse_args(argv)
+    if args.tile and not 0 <= args.tile_overlap < min(args.height, args.width):
+        parser.error("--tile-overlap must be >= 0 and smaller than the tile (--height {} , --width {}), got {}".format(
+            args.height, args.width, args.tile_overlap))
+    return args
+
+
+if __name__ == '__main__':
+    run(parse_args())
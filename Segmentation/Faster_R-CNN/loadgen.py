@@ -0,0 +1,181 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+
+import numpy as np
+
+# Load generator for server.py, stdlib only (no outside service needed) :
+#   python loadgen.py YeastCellDataset/test --port 8080 --concurrency 8 --requests 64
+#   python loadgen.py YeastCellDataset/test --unix /tmp/detector.sock --rate 4 --duration 30
+# --concurrency n : n instruments, each posts its next frame as soon as the last answer is in (closed loop)
+# --rate r        : frames posted at r per second on average (Poisson arrivals), whatever the answers (open loop)
+# Prints the throughput and the latency seen by the clients, then the /stats of the server.
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp')
+
+
+class Connection(object):
+    """One keep alive HTTP/1.1 connection to the server"""
+    def __init__(self, host='127.0.0.1', port=8080, unix=None):
+        self.host, self.port, self.unix = host, port, unix
+        self.reader = self.writer = None
+
+    async def open(self):
+        if self.unix:
+            self.reader, self.writer = await asyncio.open_unix_connection(self.unix)
+        else:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def request(self, method, path, body=b''):
+        # (status, decoded JSON answer)
+        if self.writer is None:
+            await self.open()
+        self.writer.write("{} {} HTTP/1.1\r\nHost: {}\r\nContent-Length: {}\r\nContent-Type: application/octet-stream\r\n\r\n".format(
+            method, path, self.host, len(body)).encode() + body)
+        await self.writer.drain()
+        status = int((await self.reader.readline()).split()[1])
+        length, close = 0, False
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            if name.strip().lower() == 'content-length':
+                length = int(value)
+            elif name.strip().lower() == 'connection':
+                close = value.strip().lower() == 'close'
+        answer = json.loads(await self.reader.readexactly(length)) if length else None
+        if close:
+            await self.close()
+            self.writer = None
+        return status, answer
+
+
+def read_frames(inputs):
+    # encoded bytes of the images of inputs (folders, files), read once
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            paths += [os.path.join(item, f) for f in sorted(os.listdir(item)) if f.lower().endswith(IMAGE_EXTENSIONS)]
+        else:
+            paths.append(item)
+    frames = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            frames.append(f.read())
+    if not frames:
+        raise ValueError("no image in {}".format(inputs))
+    return frames
+
+
+async def closed_loop(frames, connect, concurrency, num_requests):
+    # latencies (s) of num_requests frames posted by concurrency clients, one frame in flight per client
+    latencies, errors = [], []
+    counter = iter(range(num_requests))
+
+    async def client(k):
+        connection = connect()
+        try:
+            for n in counter:
+                start = time.perf_counter()
+                status, answer = await connection.request('POST', '/detect', frames[(n + k) % len(frames)])
+                if status == 200:
+                    latencies.append(time.perf_counter() - start)
+                else:
+                    errors.append(answer)
+        finally:
+            await connection.close()
+
+    await asyncio.gather(*[client(k) for k in range(concurrency)])
+    return latencies, errors
+
+
+async def open_loop(frames, connect, rate, duration, seed=0):
+    # latencies (s) of frames posted with exponential gaps of mean 1 / rate for duration seconds, one connection per frame
+    rng = random.Random(seed)
+    latencies, errors, tasks = [], [], []
+
+    async def post(frame):
+        connection = connect()
+        try:
+            start = time.perf_counter()
+            status, answer = await connection.request('POST', '/detect', frame)
+            if status == 200:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors.append(answer)
+        finally:
+            await connection.close()
+
+    end = time.perf_counter() + duration
+    n = 0
+    while time.perf_counter() < end:
+        tasks.append(asyncio.get_running_loop().create_task(post(frames[n % len(frames)])))
+        n += 1
+        await asyncio.sleep(rng.expovariate(rate))
+    await asyncio.gather(*tasks)
+    return latencies, errors
+
+
+async def generate(args):
+    frames = read_frames(args.inputs)
+    connect = lambda: Connection(args.host, args.port, args.unix)
+    start = time.perf_counter()
+    if args.rate:
+        latencies, errors = await open_loop(frames, connect, args.rate, args.duration, seed=args.seed)
+    else:
+        latencies, errors = await closed_loop(frames, connect, args.concurrency, args.requests)
+    elapsed = time.perf_counter() - start
+    stats_connection = connect()
+    try:
+        _, server_stats = await stats_connection.request('GET', '/stats')
+    finally:
+        await stats_connection.close()
+    ms = 1000 * np.array(latencies) if latencies else np.zeros(1)
+    out = {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'time': elapsed,
+        'frames_per_sec': len(latencies) / elapsed if elapsed > 0 else 0.0,
+        'latency_ms': {'p50': float(np.percentile(ms, 50)), 'p99': float(np.percentile(ms, 99)), 'max': float(ms.max())},
+        'server': server_stats,
+    }
+    return out
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Load generator for server.py')
+    parser.add_argument('inputs', nargs='+', help="image files or folders of images, posted in turn")
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--unix', type=str, default=None, help="unix socket of the server instead of --host / --port")
+    parser.add_argument('--concurrency', type=int, default=8, help="clients with one frame in flight each (closed loop)")
+    parser.add_argument('--requests', type=int, default=64, help="frames posted in closed loop")
+    parser.add_argument('--rate', type=float, default=None, help="if used, frames per second posted in open loop")
+    parser.add_argument('--duration', type=float, default=30.0, help="seconds of open loop")
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def print_report(out, file=None):
+    file = file or sys.stdout
+    print("{} frames in {:.1f} s : {:.2f} frames / s , {} errors".format(out['requests'], out['time'], out['frames_per_sec'], out['errors']), file=file)
+    print("client latency : p50 {p50:.0f} ms , p99 {p99:.0f} ms , max {max:.0f} ms".format(**out['latency_ms']), file=file)
+    server = out['server']
+    print("server : p50 {p50:.0f} ms , p99 {p99:.0f} ms , max queue depth {q} , batch sizes {h}".format(
+        q=server['max_queue_depth'], h=server['batch_size_histogram'], **server['latency_ms']), file=file)
+
+
+if __name__ == '__main__':
+    print_report(asyncio.run(generate(parse_args())))
@@ -1,45 +1,62 @@
 import torch 
-import torch.nn as nn 
+from torch.nn import functional as F
 
-from utils import tile 
 
-def rpn_loss_regr(y_true, y_pred , y_is_box_label , lambda_rpn_regr = 1.0 , epsilon = 1e-6, device='cpu'):
+def batch_index(offsets):
+    # image index of every entry of a concatenated sparse target, from its (b + 1) offsets 
+    counts = offsets[1:] - offsets[:-1]
+    return torch.repeat_interleave(torch.arange(counts.size(0), device=offsets.device), counts)
+
+
+def gather_anchors(y_pred, index, offsets, values_per_anchor):
+    # y_pred [b, h, w, values_per_anchor * A] at the flat (h, w, A) anchor indices of each image
+    b, h, w, c = y_pred.shape
+    num_anchors = c // values_per_anchor
+    index = index.long()
+    jy = index // (w * num_anchors)
+    ix = (index // num_anchors) % w
+    a = index % num_anchors
+    y_pred = y_pred.reshape(b, h, w, num_anchors, values_per_anchor)
+    return y_pred[batch_index(offsets), jy, ix, a]
+
+
+def rpn_loss_regr(targets, y_pred , lambda_rpn_regr = 1.0 , epsilon = 1e-6):
         # Smooth L1 loss function 
         #                    0.5*x*x (if x_abs < 1)
         #                    x_abx - 0.5 (otherwise)
 
-        # y_true [: , : , : , 36]: 4 values per 9 anchor boxes 
-        # y_is_box_label [: , : , : , 9] tilled on the last dimension 4 times. label 1 propogated through all 4 values ,
-         # similarly other labels replicated 4 times 
-        b = y_true.size(0)
-        x_abs = y_true - y_pred
+        # y_pred [: , : , : , 36]: 4 values per 9 anchor boxes 
+        # targets : sparse RPN targets from dataset.collate_fn, only the positive anchors have a regression target
+        # the loss of an image is averaged over its positive anchors (4 values each)
+        b = y_pred.size(0)
+        y_true = targets['regr']
+        x_abs = y_true - gather_anchors(y_pred, targets['pos'], targets['pos_offsets'], 4)
         x_abs = torch.abs(x_abs)
-        index_small = torch.where(x_abs <= 1 )
-        
-        x_abs[index_small] = torch.pow(x_abs[index_small], 2) /  2 + 0.5
-        x_abs = x_abs - 0.5
-        # label 1 means positive box, label 0 means neutral and -1 means negative box
-        # clamp min= 0, removes negative box error
-        y_is_box_label = tile(y_is_box_label, -1 , 4 , device=device).clamp(min=0)
-
-        loss = (y_is_box_label * x_abs).view(b,-1).sum(1) / (epsilon + y_is_box_label.view(b,-1).sum(1) )
-        # loss = (y_is_box_label * x_abs).sum() / (epsilon + y_is_box_label.sum() )
+        x_abs = torch.where(x_abs <= 1, torch.pow(x_abs, 2) / 2, x_abs - 0.5)
+
+        per_image = torch.zeros(b, device=y_pred.device, dtype=y_pred.dtype)
+        per_image = per_image.index_add(0, batch_index(targets['pos_offsets']), x_abs.sum(1))
+        num_pos = (targets['pos_offsets'][1:] - targets['pos_offsets'][:-1]).to(y_pred.dtype)
+        loss = per_image / (epsilon + 4 * num_pos)
         return lambda_rpn_regr * loss.mean() 
         
 
 
         
-def rpn_loss_cls_fixed_num(y_pred, y_is_box_label , lambda_rpn_class=1.0 , epsilon = 1e-6 ):
-        # torch.abs(y_is_box_label) will keep the positive and negative labels and ignore the 0 labels 
+def rpn_loss_cls_fixed_num(y_pred, targets , lambda_rpn_class=1.0 , epsilon = 1e-6 ):
+        # binary cross entropy over the sampled anchors only : postive label =1, negative label = 0, neutral ones are not in targets
         # y_pred [: ,: ,: , 9 ]
-        # y_is_box_label.clamp(min=0) converts the problem into binary cross entropy : postive label =1, negative & neutral label = 0 
+        # the loss of an image is averaged over its sampled anchors
 
         b = y_pred.size(0)
-        ce=  nn.BCELoss(reduction='none')
-        temp = torch.abs(y_is_box_label)
-        
-        ce_loss = ce(y_pred , y_is_box_label.clamp(min=0))
-        loss = ( temp * ce_loss ).view(b,-1).sum(1)  / (epsilon + temp.view(b,-1).sum(1))
+        pos = gather_anchors(y_pred, targets['pos'], targets['pos_offsets'], 1).view(-1)
+        neg = gather_anchors(y_pred, targets['neg'], targets['neg_offsets'], 1).view(-1)
+
+        per_image = torch.zeros(b, device=y_pred.device, dtype=y_pred.dtype)
+        per_image = per_image.index_add(0, batch_index(targets['pos_offsets']), F.binary_cross_entropy(pos, torch.ones_like(pos), reduction='none'))
+        per_image = per_image.index_add(0, batch_index(targets['neg_offsets']), F.binary_cross_entropy(neg, torch.zeros_like(neg), reduction='none'))
+        count = (targets['pos_offsets'][1:] - targets['pos_offsets'][:-1]) + (targets['neg_offsets'][1:] - targets['neg_offsets'][:-1])
+        loss = per_image / (epsilon + count.to(y_pred.dtype))
         return lambda_rpn_class * loss.mean()
 
 
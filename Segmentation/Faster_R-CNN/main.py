@@ -15,11 +15,16 @@ from  model import Model_RPN , Classifier
 from tools import * 
 from utils import WarmupMultiStepLR  , save_checkpoint , load_checkpoint
 
-from dataset import Dataset , collate_fn , Dataset_roi
+from dataset import Dataset , collate_fn , BalancedRoiSampler , BatchAugment , AspectRatioBatchSampler
+from shards import build_shards , ShardDataset
+from prefetch import DevicePrefetcher
+from slabs import SlabPool , SlabCollate , SlabLoader , num_slots
 import torchvision.transforms as transforms
 
 from torch.autograd import Variable
 from loss import rpn_loss_regr , rpn_loss_cls_fixed_num  , class_loss_cls , class_loss_regr
+from trainer import alternating_step , joint_step
+import diag
 
 from plot import save_evaluations_image
 
@@ -102,6 +107,12 @@ if __name__ == '__main__':
                         help="scalling factor for regression ")
     parser.add_argument('--n-roi', type=int, default=100,
                         help="number of roi to train classifiers with")
+    parser.add_argument('--joint-training', action='store_true', default=False,
+                        help="if used, train the rpn and the classifier together : one rpn forward and one optimizer step per batch")
+    parser.add_argument('--shared-backbone-grad', action='store_true', default=False,
+                        help="with --joint-training, let the classifier loss update the backbone too")
+    parser.add_argument('--roi-pooling', type=str, default='avg', choices=['avg', 'align'],
+                        help="roi pooling of the classifier, adaptive average or bilinear RoIAlign")
 
     # loss scaling factor
     parser.add_argument('--lambda-rpn-regr', default=1.0, type=float,
@@ -116,11 +127,41 @@ if __name__ == '__main__':
     # directory
     parser.add_argument('-s', '--save_dir', type=str, default='models/',
                         help="path of the model weights")
+    parser.add_argument('--cache-dir', type=str, default='cache/',
+                        help="path of the precomputed data (anchor grids ...)")
+    parser.add_argument('--annotations', type=str, default='json', choices=['json', 'store'],
+                        help="'store' maps the columnar <split>_annotations of the dataset folders (python annotations.py <folder> --split <split>)")
+    parser.add_argument('--aspect-buckets', type=str, default=None,
+                        help="comma separated w / h ratios (e.g. 0.75,1,1.333) : images are resized to the closest bucket of about height x width pixels, batches never mix buckets")
+    parser.add_argument('--batch-augment', action='store_true', default=False,
+                        help="if used, augment the collated train batches on the device instead of each PIL image in the workers")
+    parser.add_argument('--decode', type=str, default='full', choices=['full', 'draft'],
+                        help="'draft' decodes JPEG frames at a reduced DCT scale (>= image size) before the resize")
+    parser.add_argument('--fetch-threads', type=int, default=0,
+                        help="if > 0, the workers fetch whole batches (Dataset.__getitems__), images decoded by that many threads")
+    parser.add_argument('--image-store', action='store_true', default=False,
+                        help="if used, decode and resize the images once into a memory-mapped store (in --cache-dir)")
+    parser.add_argument('--shards', action='store_true', default=False,
+                        help="if used, pack the train images into large sequential shards (in --cache-dir) and stream them")
+    parser.add_argument('--prefetch', type=int, default=2,
+                        help="number of batches moved to the device by a background thread ahead of the step, 0 disables it")
+    parser.add_argument('--shm-collate', action='store_true', default=False,
+                        help="if used, the workers write the train batches into preallocated shared memory slabs (with --workers > 0)")
+    parser.add_argument('--rpn-cache', action='store_true', default=False,
+                        help="if used, precompute the RPN targets once (in --cache-dir) instead of every epoch")
+    parser.add_argument('--diag-level', type=str, default='off', choices=['off', 'warning', 'info', 'debug'],
+                        help="level of the (rate limited) diagnostics messages of tools.py / dataset.py")
+    parser.add_argument('--diag-every', type=int, default=0,
+                        help="if > 0, print the pipeline counters (nms, anchors, rois) of all the workers every n steps")
 
 
 
     args = parser.parse_args()
     torch.manual_seed(args.seed)
+    diag.configure(log_level=args.diag_level)
+    if args.diag_every > 0:
+        # before the DataLoaders, the workers write to their own row 
+        diag.enable_stats(num_workers=args.workers)
     torch.cuda.manual_seed_all(args.seed)
     random.seed(1)
     
@@ -180,21 +221,69 @@ if __name__ == '__main__':
     anchor_sizes = args.anchor_sizes
     num_anchors = len(anchor_ratios) * len(anchor_sizes)
 
-    valid_anchors = valid_anchors(anchor_sizes,anchor_ratios , downscale , output_width=out_w , resized_width=width , output_height=out_h , resized_height=height)
-    rpm = RPM(anchor_sizes , anchor_ratios, valid_anchors, config.rev_label_map, rpn_max_overlap=args.rpn_max_overlap , rpn_min_overlap= args.rpn_min_overlap , num_regions = args.thresold_num_region )
-
-    dataset_train =  Dataset(data_folder="YeastCellDataset/train", rpm=rpm, split='TRAIN', std_scaling=args.std_scaling, image_resize_size= (height, width),  debug= False , data_format= args.data_format)
-    dataset_test =  Dataset(data_folder="YeastCellDataset/test", rpm=rpm, split='TEST', std_scaling=args.std_scaling, image_resize_size= (height, width),  debug= False , data_format= args.data_format )
+    # valid anchors (for RPM) and the anchor grid (for rpn_to_roi), shared by all the DataLoader workers 
+    anchors = get_anchors(height, width, anchor_sizes, anchor_ratios, downscale, cache_dir=os.path.join(args.cache_dir, "anchors"))
+    rpm = RPM(anchor_sizes , anchor_ratios, anchors, config.rev_label_map, rpn_max_overlap=args.rpn_max_overlap , rpn_min_overlap= args.rpn_min_overlap , num_regions = args.thresold_num_region )
+
+    # canonical (h, w) of the aspect ratio buckets, each with its own anchors (see RPM.anchors_for)
+    buckets = None 
+    if args.aspect_buckets:
+        if args.shards:
+            raise ValueError("--aspect-buckets needs a batch sampler, not available with --shards")
+        buckets = bucket_sizes(height, width, [float(r) for r in args.aspect_buckets.split(',')])
+        print("Aspect ratio buckets (h, w) : {}".format(buckets))
+
+    if args.batch_augment:
+        # BatchAugment mirrors the RPN targets on the anchor grid, exact only if the grid is symmetric 
+        for size in [(height, width)] + (buckets or []):
+            feature_w = base_size_calculator(size[0], size[1])[1]
+            if size[1] != downscale * feature_w:
+                raise ValueError("--batch-augment needs a width of downscale x feature map width ({} x {} = {}), got {}".format(
+                    downscale, feature_w, downscale * feature_w, size[1]))
+
+    rpn_cache = os.path.join(args.cache_dir, "rpn_targets") if args.rpn_cache else None
+    image_store = os.path.join(args.cache_dir, "images") if args.image_store else None
+    dataset_train =  Dataset(data_folder="YeastCellDataset/train", rpm=rpm, split='TRAIN', std_scaling=args.std_scaling, image_resize_size= (height, width),  debug= False , data_format= args.data_format , rpn_cache=rpn_cache , image_store=image_store , decode=args.decode , 
+        augment='batch' if args.batch_augment else 'pil' , annotations=args.annotations , buckets=buckets , fetch_threads=args.fetch_threads)
+    dataset_test =  Dataset(data_folder="YeastCellDataset/test", rpm=rpm, split='TEST', std_scaling=args.std_scaling, image_resize_size= (height, width),  debug= False , data_format= args.data_format , rpn_cache=rpn_cache , image_store=image_store , decode=args.decode , annotations=args.annotations , buckets=buckets , fetch_threads=args.fetch_threads)
 
     # keep the number of workers greater than 4
-    train_loader = DataLoader(
-        dataset_train, shuffle=True,  collate_fn=collate_fn, 
-        batch_size=args.train_batch, num_workers=args.workers, pin_memory=pin_memory, drop_last=True)
+    if args.shards:
+        # streamed shard by shard, shuffled by the dataset itself 
+        train_data = ShardDataset(dataset_train, build_shards(dataset_train, os.path.join(args.cache_dir, "shards")), seed=args.seed)
+    else:
+        train_data = dataset_train
+    train_collate = collate_fn
+    if args.shm_collate and args.workers > 0:
+        # the slabs are held by the loop, and by the prefetcher queue when there is one
+        hold = args.prefetch + 2 if args.prefetch > 0 else 1
+        # largest image of a batch + 1 MB per image for the boxes, labels and sparse targets (a bigger batch falls back to collate_fn)
+        largest = max(h * w for h, w in buckets) if buckets else height * width
+        slab_pool = SlabPool(num_slots(args.workers, hold=hold), args.train_batch * (3 * 4 * largest + (1 << 20)))
+        train_collate = SlabCollate(slab_pool)
+    if buckets:
+        train_loader = DataLoader(
+            train_data, batch_sampler=AspectRatioBatchSampler(dataset_train.bucket, args.train_batch, seed=args.seed), collate_fn=train_collate, 
+            num_workers=args.workers, pin_memory=pin_memory, worker_init_fn=diag.worker_init())
+    else:
+        train_loader = DataLoader(
+            train_data, shuffle=not args.shards,  collate_fn=train_collate, 
+            batch_size=args.train_batch, num_workers=args.workers, pin_memory=pin_memory, drop_last=True, worker_init_fn=diag.worker_init())
 
 
     test_loader = DataLoader(
         dataset_test, shuffle=True,  collate_fn=collate_fn, 
-        batch_size=1, num_workers=args.workers, pin_memory=pin_memory, drop_last=True)
+        batch_size=1, num_workers=args.workers, pin_memory=pin_memory, drop_last=True, worker_init_fn=diag.worker_init())
+
+    if train_collate is not collate_fn:
+        train_loader = SlabLoader(train_loader, slab_pool, hold=hold)
+
+    # the batches come out on device, the .to(device) of the loops are then no-ops
+    if args.prefetch > 0:
+        train_batches = DevicePrefetcher(train_loader, device, depth=args.prefetch)
+        test_batches = DevicePrefetcher(test_loader, device, depth=args.prefetch)
+    else:
+        train_batches, test_batches = train_loader, test_loader
 
 
 
@@ -216,7 +305,7 @@ if __name__ == '__main__':
         start_epoch  = -1 
 
         model_rpn = Model_RPN(num_anchors= len(anchor_sizes) * len(anchor_ratios) ).to(device=device)
-        model_classifier = Classifier(num_classes=  len(config.voc_labels) ).to(device=device)
+        model_classifier = Classifier(num_classes=  len(config.voc_labels) , pooling=args.roi_pooling ).to(device=device)
 
         # weight decay is L2 regularization
         weight_decay = args.weight_decay 
@@ -246,6 +335,9 @@ if __name__ == '__main__':
 
         model_rpn = state['model_rpn'].to(device=device)
         model_classifier = state['model_classifier'].to(device=device)
+        pooling = getattr(model_classifier, 'pooling', 'avg')
+        if pooling != args.roi_pooling:
+            print("==== --roi-pooling {} ignored, the pretrained classifier uses {} pooling".format(args.roi_pooling, pooling))
 
         optimizer_model_rpn = state['optimizer_model_rpn']
         optimizer_classifier = state['optimizer_classifier']
@@ -271,10 +363,23 @@ if __name__ == '__main__':
     scheduler_rpn = WarmupMultiStepLR(optimizer_model_rpn, milestones=[40, 70], gamma=args.gamma, warmup_factor=0.01, warmup_iters=5)
     scheduler_class = WarmupMultiStepLR(optimizer_classifier, milestones=[40, 70], gamma=args.gamma, warmup_factor=0.01, warmup_iters=5)
     
-    # all possible anchor boxes
-    all_possible_anchor_boxes = default_anchors(out_h=out_h, out_w=out_w, anchor_sizes=anchor_sizes , anchor_ratios=anchor_ratios , downscale=16)
-    all_possible_anchor_boxes_tensor = torch.tensor(all_possible_anchor_boxes, dtype=torch.float32).to(device=device)
+    # all possible anchor boxes, same registry entry (and downscale) as the valid anchors 
+    all_possible_anchor_boxes_tensor = anchors.grid_tensor(device=device)
+    grids = {(height, width): all_possible_anchor_boxes_tensor}
+
+    def grid_for(image):
+        # anchor grid of the input size of this batch (one per aspect ratio bucket)
+        size = tuple(image.shape[2:])
+        if size not in grids:
+            grids[size] = rpm.anchors_for(size).grid_tensor(device=device)
+        return grids[size]
+
 
+    # flip / photometric augmentation of the train batches, after collate_fn (see --batch-augment)
+    batch_augment = BatchAugment(feature_size=all_possible_anchor_boxes_tensor.shape[1:3], num_anchors=num_anchors, downscale=downscale, seed=args.seed) if args.batch_augment else None
+
+    # pos / neg roi minibatches for the classifier, in-process and seeded
+    roi_sampler = BalancedRoiSampler(n_roi=args.n_roi, seed=args.seed)
 
     # Initialize lists to store losses
     train_rpn_cls_losses = []
@@ -288,6 +393,8 @@ if __name__ == '__main__':
 
     def train(epoch):
         print("Training epoch {}".format(epoch))
+        if args.shards:
+            train_data.set_epoch(epoch)
         rpn_accuracy_rpn_monitor = [] # list of number of bounding boxes that overlap ground truth boxes
         rpn_accuracy_for_epoch = []
         
@@ -306,138 +413,59 @@ if __name__ == '__main__':
         
         j = -1
 
-        for i,(image, boxes, labels , temp, num_pos) in enumerate(train_loader):
+        for i,(image, boxes, labels , temp, num_pos) in enumerate(train_batches):
             count_rpn +=1
-            # y_is_box_label : 1 if anchor box is valid, 0 if anchor box is background
-            y_is_box_label = temp[0].to(device=device)
-            y_rpn_regr = temp[1].to(device=device)
+            # sparse rpn targets : sampled positive / negative anchors and the regression of the positive ones 
+            rpn_targets = {k: v.to(device=device) for k, v in temp.items()}
             image = Variable(image).to(device=device)
-            boxes = boxes
+            grid = grid_for(image)
+            if batch_augment is not None:
+                image, boxes, rpn_targets = batch_augment(image, boxes, rpn_targets, feature_size=grid.shape[1:3])
+
+            step_args = (model_rpn, model_classifier, optimizer_model_rpn, optimizer_classifier, roi_sampler, 
+                         image, boxes, labels, rpn_targets, grid, downscale, config.label_map, args)
+            if args.joint_training:
+                # single forward, rpn + classifier losses in one backward / step 
+                stats = joint_step(*step_args, shared_backbone_grad=args.shared_backbone_grad)
+            else:
+                def on_class_step(j, stats):
+                    if (count_class + stats['class_steps']) % args.display_class == 0 :
+                        print('[Classifier] RPN Ex: {}-th , Anchor Box: {}-th, Classifier Model Classification loss: {} Regression loss: {} '.format(i,j, stats['class_cls'] / stats['class_steps'], stats['class_regr'] / stats['class_steps'] ))
+                # rpn step, then the classifier on the proposals of the updated rpn 
+                stats = alternating_step(*step_args, on_class_step=on_class_step)
 
-            base_x , cls_k , reg_k = model_rpn(image)
-            
-            # rpn loss
-            l1 = rpn_loss_regr(y_true=y_rpn_regr, y_pred=reg_k , y_is_box_label=y_is_box_label , lambda_rpn_regr=args.lambda_rpn_regr , device=device) # regression loss
-            l2 = rpn_loss_cls_fixed_num(y_pred = cls_k , y_is_box_label= y_is_box_label , lambda_rpn_class = args.lambda_rpn_class) # classification loss
-            
             # total loss
-            regr_rpn_loss += l1.item() 
-            class_rpn_loss += l2.item() 
-            loss = l1 + l2 
-            total_rpn_loss += loss.item()
-            
-            optimizer_model_rpn.zero_grad()
-            loss.backward()
-            optimizer_model_rpn.step()                        
-            with torch.no_grad():
-                base_x , cls_k , reg_k = model_rpn(image)
-            
-            for b in range(args.train_batch):
-                img_data = {}
-                with torch.no_grad():
-                    # Convert rpn layer to roi bboxes
-                    # cls_k.shape : b, h, w, 9
-                    # reg_k : b, h, w, 36
-                    rpn_rois = rpn_to_roi(cls_k[b,:], reg_k[b,:], no_anchors=num_anchors,  all_possible_anchor_boxes=all_possible_anchor_boxes_tensor.clone() )
-                    if rpn_rois.size() == 0:
-                        continue  # Skip this loop iteration if no ROIs
-                    rpn_rois.to(device=device)
-                    # can't concatenate batch 
-                    # no of boxes may vary across the batch 
-                    img_data["boxes"] = boxes[b].to(device=device) // downscale
-                    img_data['labels'] = labels[b]
-                    # X2 are qualified anchor boxes from model_rpn (converted anochors)
-                    # Y1 are the label, Y1[-1] is the background bounding box (negative bounding box), ambigous (neutral boxes are eliminated < min overlap thresold)
-                    # Y2 is concat of 1 , tx, ty, tw, th and 0, tx, ty, tw, th 
-                    X2, Y1, Y2, _ = calc_iou(rpn_rois, img_data, class_mapping=config.label_map )
-                    
-                    if X2 is not None:
-                        X2 = X2.to(device=device)
-                    else:
-                        continue 
-                    Y1 = Y1.to(device=device)
-                    Y2 = Y2.to(device=device)
-
-                    # If X2 is None means there are no matching bboxes
-                    if X2 is None:
-                        rpn_accuracy_rpn_monitor.append(0)
-                        rpn_accuracy_for_epoch.append(0)
-                        continue
-                    neg_samples = torch.where(Y1[:, -1] == 1)[0]
-                    pos_samples = torch.where(Y1[:, -1] == 0)[0]
-                    rpn_accuracy_rpn_monitor.append(pos_samples.size(0))
-                    rpn_accuracy_for_epoch.append(pos_samples.size(0))
-
-                db = Dataset_roi(pos=pos_samples.cpu() , neg= neg_samples.cpu())
-                roi_loader = DataLoader(db, shuffle=True,  
-                    batch_size=args.n_roi // 2, num_workers=args.workers, pin_memory=pin_memory, drop_last=False)
-                # list(roi_loader)
-                for j,potential_roi in enumerate(roi_loader):
-                    pos = potential_roi[0]
-                    neg = potential_roi[1]
-                    if type(pos) == list :
-                        rois = X2[neg]
-                        rpn_base = base_x[b].unsqueeze(0)
-                        Y11 = Y1[neg]
-                        Y22 = Y2[neg]
-                        # out_class : args.n_roi // 2 , # no of class
-                    elif type(neg) == list :
-                        rois = X2[pos]
-                        rpn_base = base_x[b].unsqueeze(0)
-                        #out_class :  args.n_roi // 2 , # no of class
-                        Y11 = Y1[pos]
-                        Y22 = Y2[pos]
-                    else:
-                        ind = torch.cat([pos,neg])
-                        rois = X2[ind]
-                        rpn_base = base_x[b].unsqueeze(0)
-                        #out_class:  args.n_roi , # no of class
-                        Y11 = Y1[ind]
-                        Y22 = Y2[ind]
-                    count_class += 1
-                    rois = Variable(rois).to(device=device)
-                    out_class , out_regr = model_classifier(base_x = rpn_base , rois= rois )
-                    
-                    l3 = class_loss_cls(y_true=Y11, y_pred=out_class , lambda_cls_class=args.lambda_cls_class)
-                    l4 = class_loss_regr(y_true=Y22, y_pred= out_regr , lambda_cls_regr= args.lambda_cls_regr)
-
-                    regr_class_loss += l4.item()
-                    class_class_loss += l3.item()   
-
-                    loss = l3 + l4 
-                    total_class_loss += loss.item()
-                    
-                    
-                    optimizer_classifier.zero_grad()
-                    loss.backward()
-                    optimizer_classifier.step()
-                    
-                    
-                    if j == -1:
-                        print("[No ROI] No regions of interest processed.")
-                    else:
-
-                        if count_class % args.display_class == 0 :
-                            if count_class == 0 :
-                                print('[Classifier] RPN Ex: {}-th ,Batch : {}, Anchor Box: {}-th, Classifier Model Classification loss: {} Regression loss: {} Total Loss: {}'.format(i,b,j,0,0,0))
-                            else:
-                                print('[Classifier] RPN Ex: {}-th ,Batch : {}, Anchor Box: {}-th, Classifier Model Classification loss: {} Regression loss: {} Total Loss: {} '.format(i,b,j, class_class_loss / count_class, regr_class_loss / count_class ,total_class_loss/ count_class ))
-
-                if i % args.display_rpn == 0 :
-                    if len(rpn_accuracy_rpn_monitor) == 0 :
-                        print('[RPN] RPN is not producing bounding boxes that overlap the ground truth boxes. Check RPN settings or keep training.')
-                    else:
-                        mean_overlapping_bboxes = float(sum(rpn_accuracy_rpn_monitor))/len(rpn_accuracy_rpn_monitor)
-                        print('[RPN] Mean number of bounding boxes from RPN overlapping ground truth boxes: {}'.format(mean_overlapping_bboxes)) 
-                    print('[RPN] RPN Ex: {}-th RPN Model Classification loss: {} Regression loss: {} Total Loss: {} '.format(i ,class_rpn_loss / count_rpn, regr_rpn_loss / count_rpn ,total_rpn_loss/ count_rpn ))
+            regr_rpn_loss += stats['rpn_regr'] 
+            class_rpn_loss += stats['rpn_cls'] 
+            total_rpn_loss += stats['rpn_regr'] + stats['rpn_cls']
+            regr_class_loss += stats['class_regr']
+            class_class_loss += stats['class_cls']
+            total_class_loss += stats['class_regr'] + stats['class_cls']
+            count_class += stats['class_steps']
+            j = stats['class_steps'] - 1
+            # images without rois or matching bboxes count as 0
+            rpn_accuracy_rpn_monitor.extend(stats['pos_per_image'])
+            rpn_accuracy_for_epoch.extend(stats['pos_per_image'])
+            diag.flush(i + 1, args.diag_every)
+
+            if j == -1:
+                print("[No ROI] No regions of interest processed.")
+
+            if i % args.display_rpn == 0 :
+                if len(rpn_accuracy_rpn_monitor) == 0 :
+                    print('[RPN] RPN is not producing bounding boxes that overlap the ground truth boxes. Check RPN settings or keep training.')
+                else:
+                    mean_overlapping_bboxes = float(sum(rpn_accuracy_rpn_monitor))/len(rpn_accuracy_rpn_monitor)
+                    print('[RPN] Mean number of bounding boxes from RPN overlapping ground truth boxes: {}'.format(mean_overlapping_bboxes)) 
+                print('[RPN] RPN Ex: {}-th RPN Model Classification loss: {} Regression loss: {} Total Loss: {} '.format(i ,class_rpn_loss / count_rpn, regr_rpn_loss / count_rpn ,total_rpn_loss/ count_rpn ))
 
             print("-- END OF BATCH -- {}".format(epoch)) 
             print("------------------------------" ) 
             print('[RPN] RPN Ex: {}-th RPN Model Classification loss: {} Regression loss: {} Total Loss: {} '.format(i ,class_rpn_loss / count_rpn, regr_rpn_loss / count_rpn ,total_rpn_loss/ count_rpn ))
             if count_class == 0 :
-                print('[Classifier] RPN Ex: {}-th ,Batch : {}, Anchor Box: {}-th, Classifier Model Classification loss: {} Regression loss: {} Total Loss: {}'.format(i,b,j,0,0,0))
+                print('[Classifier] RPN Ex: {}-th , Anchor Box: {}-th, Classifier Model Classification loss: {} Regression loss: {} Total Loss: {}'.format(i,j,0,0,0))
             else:
-                print('[Classifier] RPN Ex: {}-th ,Batch : {}, Anchor Box: {}-th, Classifier Model Classification loss: {} Regression loss: {} Total Loss: {} '.format(i,b,j, class_class_loss / count_class, regr_class_loss / count_class ,total_class_loss/ count_class ))
+                print('[Classifier] RPN Ex: {}-th , Anchor Box: {}-th, Classifier Model Classification loss: {} Regression loss: {} Total Loss: {} '.format(i,j, class_class_loss / count_class, regr_class_loss / count_class ,total_class_loss/ count_class ))
             if len(rpn_accuracy_rpn_monitor) == 0 :
                 print('[RPN] RPN is not producing bounding boxes that overlap the ground truth boxes. Check RPN settings or keep training.')
             else:
@@ -450,6 +478,10 @@ if __name__ == '__main__':
             
             print("------------------------------" ) 
             
+        if args.prefetch > 0:
+            stats = train_batches.stats()
+            print("[prefetch] waited on data {:.3f} s in {} batches (max {:.3f} s)".format(stats['wait_time'], stats['batches'], stats['max_wait']))
+            train_batches.reset_stats()
         train_rpn_cls_losses.append(class_rpn_loss / count_rpn)
         train_rpn_regr_losses.append(regr_rpn_loss / count_rpn)
         train_class_cls_losses.append(class_class_loss / count_class)
@@ -479,16 +511,15 @@ if __name__ == '__main__':
         
         save_image_once = True 
 
-        for i,(image, boxes, labels , temp, num_pos) in enumerate(test_loader):
+        for i,(image, boxes, labels , temp, num_pos) in enumerate(test_batches):
             count_rpn +=1
             
-            y_is_box_label = temp[0].to(device=device)
-            y_rpn_regr = temp[1].to(device=device)
+            rpn_targets = {k: v.to(device=device) for k, v in temp.items()}
             image = Variable(image).to(device=device)
 
             base_x , cls_k , reg_k = model_rpn(image)
-            l1 = rpn_loss_regr(y_true=y_rpn_regr, y_pred=reg_k , y_is_box_label=y_is_box_label , lambda_rpn_regr=args.lambda_rpn_regr, device=device)
-            l2 = rpn_loss_cls_fixed_num(y_pred = cls_k , y_is_box_label= y_is_box_label , lambda_rpn_class = args.lambda_rpn_class)
+            l1 = rpn_loss_regr(rpn_targets, y_pred=reg_k , lambda_rpn_regr=args.lambda_rpn_regr)
+            l2 = rpn_loss_cls_fixed_num(y_pred = cls_k , targets= rpn_targets , lambda_rpn_class = args.lambda_rpn_class)
             
             regr_rpn_loss += l1.item() 
             class_rpn_loss += l2.item() 
@@ -496,25 +527,17 @@ if __name__ == '__main__':
             total_rpn_loss += loss.item()
             
             base_x , cls_k , reg_k = model_rpn(image)
+            batch_rois, num_rois = rpn_to_roi_batch(cls_k, reg_k, grid_for(image))
+            gt_boxes, gt_labels, gt_valid = pad_gt([bx // downscale for bx in boxes], labels, device=device)
+            X, Y1_all, Y2_all, roi_index, _ = calc_iou_batch(batch_rois, num_rois, gt_boxes, gt_labels, gt_valid, class_mapping=config.label_map)
 
             for b in range(image.size(0)):
-                img_data = {}
-                rpn_rois = rpn_to_roi(cls_k[b,:], reg_k[b,:], no_anchors=num_anchors,  all_possible_anchor_boxes=all_possible_anchor_boxes_tensor.clone() )
-                rpn_rois.to(device=device)
-
-                img_data["boxes"] = boxes[b].to(device=device) // downscale
-                img_data['labels'] = labels[b]
-
-                X2, Y1, Y2, _ = calc_iou(rpn_rois, img_data, class_mapping=config.label_map )
-                
-                if X2 is None:
+                rows = roi_index == b
+                if not bool(rows.any()):
                     rpn_accuracy_rpn_monitor.append(0)
                     rpn_accuracy_for_epoch.append(0)
                     continue
-
-                X2 = X2.to(device=device)
-                Y1 = Y1.to(device=device)
-                Y2 = Y2.to(device=device)
+                X2, Y1, Y2 = X[rows], Y1_all[rows], Y2_all[rows]
 
                 count_class += 1 
                 rpn_base = base_x[b].unsqueeze(0)
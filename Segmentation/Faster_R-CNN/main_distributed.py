@@ -13,7 +13,7 @@ from  model import Model_RPN , Classifier
 from tools import * 
 from utils import WarmupMultiStepLR  , save_checkpoint , load_checkpoint
 
-from dataset import Dataset , collate_fn , Dataset_roi
+from dataset import Dataset , collate_fn , BalancedRoiSampler
 import torchvision.transforms as transforms
 
 from torch.autograd import Variable
@@ -277,6 +277,9 @@ scheduler_class = WarmupMultiStepLR(optimizer_classifier, milestones=[40, 70], g
 all_possible_anchor_boxes = default_anchors(out_h=out_h, out_w=out_w, anchor_sizes=anchor_sizes , anchor_ratios=anchor_ratios , downscale=16)
 all_possible_anchor_boxes_tensor = torch.tensor(all_possible_anchor_boxes).to(device=device)
 
+# pos / neg roi minibatches of n_roi // 2 rois for the classifier
+roi_sampler = BalancedRoiSampler(n_roi=args.n_roi // 2, seed=args.seed)
+
 
 def train(epoch):
     print("\n\nTraining epoch {}\n\n".format(epoch))
@@ -298,14 +301,13 @@ def train(epoch):
     for i,(image, boxes, labels , temp, num_pos) in enumerate(train_loader):
         count_rpn +=1
 
-        y_is_box_label = temp[0].to(device=model_rpn_cuda)
-        y_rpn_regr = temp[1].to(device=model_rpn_cuda)
+        rpn_targets = {k: v.to(device=model_rpn_cuda) for k, v in temp.items()}
         image = Variable(image).to(device=model_rpn_cuda)
         boxes = boxes
         base_x , cls_k , reg_k = model_rpn(image)
         
-        l1 = rpn_loss_regr(y_true=y_rpn_regr, y_pred=reg_k , y_is_box_label=y_is_box_label , lambda_rpn_regr=args.lambda_rpn_regr , device=model_rpn_cuda)
-        l2 = rpn_loss_cls_fixed_num(y_pred = cls_k , y_is_box_label= y_is_box_label , lambda_rpn_class = args.lambda_rpn_class)
+        l1 = rpn_loss_regr(rpn_targets, y_pred=reg_k , lambda_rpn_regr=args.lambda_rpn_regr)
+        l2 = rpn_loss_cls_fixed_num(y_pred = cls_k , targets= rpn_targets , lambda_rpn_class = args.lambda_rpn_class)
         
         regr_rpn_loss += l1.item() 
         class_rpn_loss += l2.item() 
@@ -368,32 +370,11 @@ def train(epoch):
                 rpn_accuracy_rpn_monitor.append(pos_samples.size(0))
                 rpn_accuracy_for_epoch.append(pos_samples.size(0))
             
-            db = Dataset_roi(pos=pos_samples.cpu() , neg= neg_samples.cpu())
-            roi_loader = DataLoader(db, shuffle=True,  
-                batch_size=args.n_roi // 4, num_workers=args.workers//2, pin_memory=False, drop_last=False)
-            # list(roi_loader)
-            for j,potential_roi in enumerate(roi_loader):
-                pos = potential_roi[0]
-                neg = potential_roi[1]
-                if type(pos) == list :
-                    rois = X2[neg]
-                    rpn_base = base_x[b].unsqueeze(0)
-                    Y11 = Y1[neg]
-                    Y22 = Y2[neg]
-                    # out_class : args.n_roi // 2 , # no of class
-                elif type(neg) == list :
-                    rois = X2[pos]
-                    rpn_base = base_x[b].unsqueeze(0)
-                    #out_class :  args.n_roi // 2 , # no of class
-                    Y11 = Y1[pos]
-                    Y22 = Y2[pos]
-                else:
-                    ind = torch.cat([pos,neg])
-                    rois = X2[ind]
-                    rpn_base = base_x[b].unsqueeze(0)
-                    #out_class:  args.n_roi , # no of class
-                    Y11 = Y1[ind]
-                    Y22 = Y2[ind]
+            for j, ind in enumerate(roi_sampler(Y1[:, -1] == 0, Y1[:, -1] == 1)):
+                rois = X2[ind]
+                rpn_base = base_x[b].unsqueeze(0)
+                Y11 = Y1[ind]
+                Y22 = Y2[ind]
                 
                 # IF YOU ARE NOT SEEING THESE SHAPES THEN SOMETHING IS WRONG
                 # Y11.shape  = 20,8
@@ -476,13 +457,12 @@ def test(epoch):
 
         count_rpn +=1
         
-        y_is_box_label = temp[0].to(device=model_rpn_cuda)
-        y_rpn_regr = temp[1].to(device=model_rpn_cuda)
+        rpn_targets = {k: v.to(device=model_rpn_cuda) for k, v in temp.items()}
         image = Variable(image).to(device=model_rpn_cuda)
 
         base_x , cls_k , reg_k = model_rpn(image)
-        l1 = rpn_loss_regr(y_true=y_rpn_regr, y_pred=reg_k , y_is_box_label=y_is_box_label , lambda_rpn_regr=args.lambda_rpn_regr, device=model_rpn_cuda)
-        l2 = rpn_loss_cls_fixed_num(y_pred = cls_k , y_is_box_label= y_is_box_label , lambda_rpn_class = args.lambda_rpn_class)
+        l1 = rpn_loss_regr(rpn_targets, y_pred=reg_k , lambda_rpn_regr=args.lambda_rpn_regr)
+        l2 = rpn_loss_cls_fixed_num(y_pred = cls_k , targets= rpn_targets , lambda_rpn_class = args.lambda_rpn_class)
         
         regr_rpn_loss += l1.item() 
         class_rpn_loss += l2.item() 
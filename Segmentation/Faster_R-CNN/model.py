@@ -4,9 +4,9 @@ import torch.nn as nn
 from torch.nn import functional as F
 
 class Model_RPN(nn.Module):
-    def __init__(self, num_anchors, **kwargs):
+    def __init__(self, num_anchors, pretrained=True, **kwargs):
         super(Model_RPN, self).__init__()
-        resnet34 = torchvision.models.resnet34(pretrained=True)
+        resnet34 = torchvision.models.resnet34(pretrained=pretrained)
         resnet34.layer4[0].conv1.stride = (1, 1)
         resnet34.layer4[0].downsample[0].stride = (1, 1)
         self.base = nn.Sequential(*list(resnet34.children())[:-2])
@@ -38,12 +38,71 @@ class Model_RPN(nn.Module):
         return base_x, cls_k, reg_k
 
 
+def xywh_to_rois(X, batch_idx=0):
+    # (R, 4) x, y, w, h ==> (R, 5) batch_idx, x1, y1, x2, y2 
+    if not torch.is_tensor(batch_idx):
+        batch_idx = torch.full((X.size(0),), batch_idx, dtype=X.dtype, device=X.device)
+    return torch.cat([batch_idx.to(X.dtype)[:, None], X[:, :2], X[:, :2] + X[:, 2:]], 1)
+
+
+def roi_pool(features, rois, output_size=7, mode='avg', sampling_ratio=2):
+    """Pool every roi of a batch in one vectorized op (forward and backward)
+
+    Args:
+        features: shape=(B, C, H, W)
+        rois: shape=(R, 5) batch_idx, x1, y1, x2, y2 on the feature map 
+        mode: 'avg' is F.adaptive_avg_pool2d over the integer crop [y1:y2, x1:x2] (computed with an integral image), 
+              'align' is bilinear RoIAlign (torchvision.ops.roi_align)
+    Returns:
+        shape=(R, C, output_size, output_size)
+    """
+    if mode == 'align':
+        return torchvision.ops.roi_align(features, rois.float(), output_size, spatial_scale=1.0, 
+                                         sampling_ratio=sampling_ratio, aligned=True)
+    if mode != 'avg':
+        raise ValueError("unknown roi pooling mode {}".format(mode))
+    return roi_pool_avg(features, rois, output_size)
+
+
+def _pool_bins(start, length, i, n):
+    # type: (Tensor, Tensor, Tensor, int) -> Tuple[Tensor, Tensor]
+    # adaptive pooling bins : [floor(i * L / n), ceil((i + 1) * L / n))
+    return start[:, None] + (length[:, None] * i) // n, start[:, None] + (length[:, None] * (i + 1) + n - 1) // n
+
+
+def roi_pool_avg(features, rois, output_size=7):
+    # type: (Tensor, Tensor, int) -> Tensor
+    # mode 'avg' of roi_pool (no torchvision op, scriptable)
+    b, c, h, w = features.size(0), features.size(1), features.size(2), features.size(3)
+    n = output_size
+    bi = rois[:, 0].long()
+    # integer crop like base_x[:, :, y1:y2, x1:x2], at least one cell 
+    x1 = rois[:, 1].long().clamp(0, w - 1)
+    y1 = rois[:, 2].long().clamp(0, h - 1)
+    x2 = torch.maximum(rois[:, 3].long().clamp(max=w), x1 + 1)
+    y2 = torch.maximum(rois[:, 4].long().clamp(max=h), y1 + 1)
+
+    i = torch.arange(n, device=features.device)[None, :]
+    ys0, ys1 = _pool_bins(y1, y2 - y1, i, n)
+    xs0, xs1 = _pool_bins(x1, x2 - x1, i, n)
+
+    # integral image (B, H + 1, W + 1, C) 
+    integral = F.pad(features.cumsum(2).cumsum(3), (1, 0, 1, 0)).permute(0, 2, 3, 1)
+    bi = bi[:, None, None]
+    sums = integral[bi, ys1[:, :, None], xs1[:, None, :]] - integral[bi, ys0[:, :, None], xs1[:, None, :]] \
+        - integral[bi, ys1[:, :, None], xs0[:, None, :]] + integral[bi, ys0[:, :, None], xs0[:, None, :]]
+    area = ((ys1 - ys0)[:, :, None] * (xs1 - xs0)[:, None, :]).to(sums.dtype)
+    return (sums / area[:, :, :, None]).permute(0, 3, 1, 2)
+
+
 class Classifier(nn.Module):
-    def __init__(self, num_classes, **kwargs):
+    def __init__(self, num_classes, pooling='avg', **kwargs):
         super(Classifier, self).__init__()
         
         self.pooling_regions = 7
         self.feat_dim = 512
+        # 'avg' (adaptive average, the original behaviour) or 'align' (bilinear RoIAlign)
+        self.pooling = pooling
 
         self.red_conv_roi = nn.Conv2d(self.feat_dim, self.feat_dim // 4, 1)
 
@@ -61,23 +120,19 @@ class Classifier(nn.Module):
         self.d4 = nn.Linear(self.feat_dim, 4 * (num_classes - 1), bias=False)
 
     def forward(self, base_x, rois):
-        outputs = []
-
-        b = base_x.size(0)
-        f = base_x.size(1)
-        h = base_x.size(2)
-        w = base_x.size(3)
-        
-        for rid in range(rois.size(0)):
-            x, y, h, w = rois[rid]
-            x, y, h, w = x.int(), y.int(), h.int(), w.int()
-            cropped_image = base_x[:, :, x:x+w, y:y+h]
-            resized_image = F.adaptive_avg_pool2d(cropped_image, (self.pooling_regions, self.pooling_regions))
-            outputs.append(resized_image)
-
-        out_roi_pool = torch.cat(outputs, 0)
-        out_roi_pool = self.red_conv_roi(out_roi_pool)
-        out_roi_pool = out_roi_pool.view(rois.size(0), -1)
+        """
+        Args:
+            base_x: shape=(B, 512, h, w) feature map
+            rois: shape=(R, 5) batch_idx, x1, y1, x2, y2 or shape=(R, 4) x, y, w, h of the first image 
+        """
+        if rois.size(1) == 4:
+            rois = xywh_to_rois(rois)
+
+        # the 1x1 reduction is linear, running it before the pooling is the same and pools 4x less channels 
+        base_x = self.red_conv_roi(base_x)
+        # (checkpoints from before the roi pooling option pickle a Classifier without it)
+        out_roi_pool = roi_pool(base_x, rois, self.pooling_regions, mode=getattr(self, 'pooling', 'avg'))
+        out_roi_pool = out_roi_pool.reshape(rois.size(0), -1)
 
         out_roi_pool = self.drop_d1(self.relu_d1(self.d1(out_roi_pool)))
         out_roi_pool = self.drop_d2(self.relu_d2(self.d2(out_roi_pool)))
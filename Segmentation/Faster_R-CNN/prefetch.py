@@ -0,0 +1,129 @@
+import time
+import queue
+import threading
+
+import torch
+
+
+def map_tensors(batch, fn, path=()):
+    # applies fn(tensor, path) to every tensor of a (nested) tuple / list / dict batch, the rest is kept as is
+    if torch.is_tensor(batch):
+        return fn(batch, path)
+    if isinstance(batch, dict):
+        return {k: map_tensors(v, fn, path + (k,)) for k, v in batch.items()}
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(map_tensors(v, fn, path + (k,)) for k, v in enumerate(batch))
+    return batch
+
+
+class DevicePrefetcher(object):
+    """Wraps a DataLoader (any iterable of batches) and moves its batches to device in a background thread
+
+    The thread keeps up to depth batches ahead of the training loop. On cuda every tensor is staged in a
+    reused pinned buffer (unless the DataLoader already pinned it) and copied with non_blocking=True on a
+    side stream, the loop waits on that copy only when it gets the batch. On cpu nothing is copied, the thread
+    still runs the DataLoader (collate, worker results) while the loop computes.
+    wait_time is how long the loop was blocked on data, see stats().
+    """
+    def __init__(self, loader, device, depth=2, pin=None):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth = max(1, depth)
+        self.cuda = self.device.type == 'cuda'
+        # pinned staging only helps (and only works) with cuda
+        self.pin = self.cuda and (pin is None or pin)
+        self.stream = torch.cuda.Stream(device=self.device) if self.cuda else None
+        # depth batches queued + one in the loop + one being staged, each slot has its own buffers
+        self.num_slots = self.depth + 2
+        self.buffers = {}
+        self.events = [None] * self.num_slots
+        self.reset_stats()
+
+    def __len__(self):
+        return len(self.loader)
+
+    def reset_stats(self):
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.batches = 0
+
+    def stats(self):
+        return {'batches': self.batches, 'wait_time': self.wait_time, 'max_wait': self.max_wait,
+                'wait_per_batch': self.wait_time / max(1, self.batches)}
+
+    def stage(self, tensor, slot, path):
+        # copy into the pinned buffer of (slot, path), grown when too small, a view of the right shape is returned
+        if not self.pin or tensor.is_pinned() or tensor.device.type != 'cpu':
+            return tensor
+        key = (slot, path)
+        buffer = self.buffers.get(key)
+        if buffer is None or buffer.dtype != tensor.dtype or buffer.numel() < tensor.numel():
+            buffer = torch.empty(max(tensor.numel(), 1), dtype=tensor.dtype).pin_memory()
+            self.buffers[key] = buffer
+        staged = buffer[:tensor.numel()].view(tensor.shape)
+        staged.copy_(tensor)
+        return staged
+
+    def to_device(self, batch, slot):
+        if not self.cuda:
+            return map_tensors(batch, lambda t, path: t.to(self.device))
+        # the pinned buffers of this slot are free once its previous copy is done
+        if self.events[slot] is not None:
+            self.events[slot].synchronize()
+        with torch.cuda.stream(self.stream):
+            batch = map_tensors(batch, lambda t, path: self.stage(t, slot, path).to(self.device, non_blocking=True))
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        self.events[slot] = event
+        return batch, event
+
+    def producer(self, out, stop):
+        try:
+            for n, batch in enumerate(self.loader):
+                item = ('batch', self.to_device(batch, n % self.num_slots))
+                while not stop.is_set():
+                    try:
+                        out.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if stop.is_set():
+                    return
+            out.put(('end', None))
+        except Exception as e:
+            out.put(('error', e))
+
+    def __iter__(self):
+        out = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self.producer, args=(out, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                kind, item = out.get()
+                waited = time.perf_counter() - start
+                if kind == 'end':
+                    break
+                if kind == 'error':
+                    raise item
+                self.wait_time += waited
+                self.max_wait = max(self.max_wait, waited)
+                self.batches += 1
+                if self.cuda:
+                    batch, event = item
+                    # the loop's stream waits for the copy, the allocator must not reuse the memory early
+                    current = torch.cuda.current_stream(self.device)
+                    current.wait_event(event)
+                    map_tensors(batch, lambda t, path: t.record_stream(current) if t.is_cuda else None)
+                    yield batch
+                else:
+                    yield item
+        finally:
+            stop.set()
+            # unblock a producer waiting on a full queue
+            while thread.is_alive():
+                try:
+                    out.get(timeout=0.1)
+                except queue.Empty:
+                    pass
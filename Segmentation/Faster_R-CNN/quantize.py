@@ -0,0 +1,289 @@
+import io
+import os
+import sys
+import copy
+import json
+import time
+import argparse
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.ao import quantization as quant
+from torch.utils.data import DataLoader
+
+from tools import get_anchors
+from utils import load_checkpoint , save_checkpoint , iou_matrix
+from infer import list_images , ImageList , collate_images , load_models , detect
+
+# INT8 checkpoint for cpu inference :
+#   * backbone (model_rpn.base, the ResNet34 layers) : static quantization, conv + bn (+ relu) fused, activation ranges
+#     calibrated on a few images, the residual adds become quantized add + relu
+#   * classifier dense layers (d1 6272 -> 1024, d2 1024 -> 512, d3, d4) : dynamic quantization (int8 weights,
+#     activations quantized on the fly per batch)
+#   * RPN head convs, red_conv_roi and the roi pooling stay float (the objectness scores feed the proposal NMS)
+# The result is a regular checkpoint (utils.save_checkpoint), infer.py / load_models run it on cpu :
+#   python quantize.py -s models/ -o models_int8/ --calibration YeastCellDataset/train --eval YeastCellDataset/test
+#   python infer.py images/ -s models_int8/ --device cpu
+
+
+class QuantizableBlock(nn.Module):
+    """torchvision BasicBlock with the residual add + relu as a FloatFunctional (same weights, same strides)"""
+    def __init__(self, block):
+        super(QuantizableBlock, self).__init__()
+        self.conv1, self.bn1, self.relu = block.conv1, block.bn1, nn.ReLU()
+        self.conv2, self.bn2 = block.conv2, block.bn2
+        self.downsample = block.downsample
+        self.add_relu = nn.quantized.FloatFunctional()
+
+    def forward(self, x):
+        out = self.relu(self.bn1(self.conv1(x)))
+        out = self.bn2(self.conv2(out))
+        identity = x if self.downsample is None else self.downsample(x)
+        return self.add_relu.add_relu(out, identity)
+
+    def fuse(self):
+        quant.fuse_modules(self, [['conv1', 'bn1', 'relu'], ['conv2', 'bn2']], inplace=True)
+        if self.downsample is not None:
+            quant.fuse_modules(self.downsample, [['0', '1']], inplace=True)
+
+
+class QuantizableBase(nn.Module):
+    """model_rpn.base (conv1, bn1, relu, maxpool, layer1 ... layer4) between a quant and a dequant stub"""
+    def __init__(self, base):
+        super(QuantizableBase, self).__init__()
+        children = list(base.children())
+        self.quant = quant.QuantStub()
+        self.conv1, self.bn1, self.relu, self.maxpool = children[:4]
+        self.layers = nn.Sequential(*[nn.Sequential(*[QuantizableBlock(b) for b in layer]) for layer in children[4:]])
+        self.dequant = quant.DeQuantStub()
+
+    def forward(self, x):
+        x = self.maxpool(self.relu(self.bn1(self.conv1(self.quant(x)))))
+        return self.dequant(self.layers(x))
+
+    def fuse(self):
+        quant.fuse_modules(self, [['conv1', 'bn1', 'relu']], inplace=True)
+        for layer in self.layers:
+            for block in layer:
+                block.fuse()
+
+
+def quantize_rpn(model_rpn, batches=None, engine='x86'):
+    """INT8 copy of model_rpn : backbone statically quantized, activations calibrated on batches (normalized images)
+
+    model_rpn is left as is. Without batches the ranges are placeholders, to be overwritten by load_state_dict
+    (see load_int8).
+    """
+    torch.backends.quantized.engine = engine
+    model = copy.deepcopy(model_rpn).cpu().eval()
+    base = QuantizableBase(model.base).eval()
+    base.fuse()
+    base.qconfig = quant.get_default_qconfig(engine)
+    quant.prepare(base, inplace=True)
+    with torch.no_grad():
+        for images in batches or [torch.zeros(1, 3, 64, 64)]:
+            base(images)
+    quant.convert(base, inplace=True)
+    model.base = base
+    return model
+
+
+def quantize_classifier(model_classifier, engine='x86'):
+    """INT8 copy of model_classifier, every nn.Linear dynamically quantized"""
+    torch.backends.quantized.engine = engine
+    return quant.quantize_dynamic(copy.deepcopy(model_classifier).cpu().eval(), {nn.Linear}, dtype=torch.qint8)
+
+
+def save_int8(save_dir, state, int8_rpn, int8_classifier, engine):
+    """Checkpoint of the int8 models : the fp32 modules of state (the architecture) + the int8 state dicts
+
+    Quantized modules do not unpickle, load_int8 rebuilds them from the fp32 ones.
+    """
+    int8 = {'engine': engine, 'model_rpn': int8_rpn.state_dict(), 'model_classifier': int8_classifier.state_dict()}
+    save_checkpoint(state['epoch'], state['model_rpn'], state['model_classifier'], None, None, state['best_error'],
+                    save_dir=save_dir, extra={'int8': int8})
+
+
+def load_int8(state):
+    # model_rpn, model_classifier of a save_int8 checkpoint (cpu, eval mode)
+    int8 = state['int8']
+    model_rpn = quantize_rpn(state['model_rpn'], engine=int8['engine'])
+    model_rpn.load_state_dict(int8['model_rpn'])
+    model_classifier = quantize_classifier(state['model_classifier'], engine=int8['engine'])
+    model_classifier.load_state_dict(int8['model_classifier'])
+    return model_rpn.eval(), model_classifier.eval()
+
+
+def model_bytes(model):
+    # size of the pickled module (what the checkpoint stores)
+    buffer = io.BytesIO()
+    torch.save(model, buffer)
+    return buffer.tell()
+
+
+def match(boxes, ref_boxes, labels=None, ref_labels=None, iou_thresh=0.5):
+    """Greedy one to one matching of boxes (in score order) to ref_boxes, same label if labels are given
+
+    Returns:
+        matched: list of (index in boxes, index in ref_boxes)
+    """
+    ious = iou_matrix(boxes, ref_boxes)
+    if labels is not None:
+        ious = np.where(np.asarray(labels)[:, None] == np.asarray(ref_labels)[None, :], ious, 0.0)
+    taken = np.zeros(ious.shape[1], dtype=bool)
+    matched = []
+    for i in range(ious.shape[0]):
+        candidates = np.where(taken, -1.0, ious[i])
+        j = int(np.argmax(candidates)) if candidates.size else -1
+        if j >= 0 and candidates[j] >= iou_thresh:
+            taken[j] = True
+            matched.append((i, j))
+    return matched
+
+
+def run_models(model_rpn, model_classifier, loader, grid, bg_class, **kwargs):
+    # detections of every image of loader (in pixels of the original images) and the time of every batch
+    detections, times = [], []
+    with torch.no_grad():
+        for images, indices, sizes in loader:
+            start = time.perf_counter()
+            boxes, scores, classes, num = detect(model_rpn, model_classifier, images, grid, bg_class=bg_class, **kwargs)
+            times.append((time.perf_counter() - start) / images.size(0))
+            height, width = images.shape[2:]
+            for j in range(len(indices)):
+                sx, sy = sizes[j][0] / width, sizes[j][1] / height
+                detections.append((boxes[j, :num[j]] * torch.tensor([sx, sy, sx, sy]), scores[j, :num[j]], classes[j, :num[j]]))
+    return detections, times
+
+
+def report(fp32, int8, paths, grid, num_classes, height=512, width=512, batch_size=4, annotations=None, **kwargs):
+    """Accuracy delta and latency / size of the INT8 models against the FP32 ones on the images of paths
+
+    Args:
+        fp32, int8: (model_rpn, model_classifier)
+        annotations: optional list of ground truth boxes (N, 4) per image, in pixels of the original images,
+            None for the images without annotations (left out of recall / precision)
+        kwargs: thresholds of infer.detect
+    Returns:
+        dict of the measures, see print_report
+    """
+    loader = DataLoader(ImageList(paths, (height, width)), batch_size=batch_size, num_workers=0, collate_fn=collate_images)
+    out = {'images': len(paths)}
+    results = {}
+    for name, (model_rpn, model_classifier) in (('fp32', fp32), ('int8', int8)):
+        # one warm up pass (allocator, packed weights)
+        run_models(model_rpn, model_classifier, [next(iter(loader))], grid, num_classes - 1, **kwargs)
+        results[name] = run_models(model_rpn, model_classifier, loader, grid, num_classes - 1, **kwargs)
+        out[name] = {
+            'ms_per_image': 1000 * float(np.median(results[name][1])),
+            'rpn_bytes': model_bytes(model_rpn),
+            'classifier_bytes': model_bytes(model_classifier),
+            'detections': sum(len(d[0]) for d in results[name][0]),
+        }
+
+    # int8 detections against the fp32 ones (same class, IoU >= 0.5)
+    matched = score_delta = 0
+    for (boxes, scores, classes), (ref_boxes, ref_scores, ref_classes) in zip(results['int8'][0], results['fp32'][0]):
+        pairs = match(boxes.numpy(), ref_boxes.numpy(), classes.numpy(), ref_classes.numpy())
+        matched += len(pairs)
+        score_delta += sum(abs(float(scores[i]) - float(ref_scores[j])) for i, j in pairs)
+    out['agreement'] = {
+        'recall_of_fp32': matched / max(1, out['fp32']['detections']),
+        'precision_to_fp32': matched / max(1, out['int8']['detections']),
+        'mean_score_delta': score_delta / max(1, matched),
+    }
+
+    # against the ground truth (boxes only)
+    if annotations is not None:
+        annotated = [i for i, gt in enumerate(annotations) if gt is not None]
+        num_gt = sum(len(annotations[i]) for i in annotated)
+        out['annotated_images'] = len(annotated)
+        for name in ('fp32', 'int8'):
+            detections = [results[name][0][i][0].numpy() for i in annotated]
+            hits = sum(len(match(d, np.asarray(annotations[i], dtype=np.float64).reshape(-1, 4))) for d, i in zip(detections, annotated))
+            out[name]['recall'] = hits / max(1, num_gt)
+            out[name]['precision'] = hits / max(1, sum(len(d) for d in detections))
+        out['recall_delta'] = out['int8']['recall'] - out['fp32']['recall']
+        out['precision_delta'] = out['int8']['precision'] - out['fp32']['precision']
+    return out
+
+
+def print_report(out, file=None):
+    file = file or sys.stdout
+    print("{} images".format(out['images']), file=file)
+    for name in ('fp32', 'int8'):
+        r = out[name]
+        line = "{} : {:8.1f} ms / image | rpn {:6.1f} MB | classifier {:6.1f} MB | {} detections".format(
+            name, r['ms_per_image'], r['rpn_bytes'] / 2 ** 20, r['classifier_bytes'] / 2 ** 20, r['detections'])
+        if 'recall' in r:
+            line += " | recall {:.3f} precision {:.3f} (IoU 0.5)".format(r['recall'], r['precision'])
+        print(line, file=file)
+    a = out['agreement']
+    print("int8 vs fp32 : {:.3f} of the fp32 detections found , {:.3f} of the int8 ones match , mean score delta {:.4f}".format(
+        a['recall_of_fp32'], a['precision_to_fp32'], a['mean_score_delta']), file=file)
+    print("speed up {:.2f}x , size {:.2f}x smaller".format(out['fp32']['ms_per_image'] / out['int8']['ms_per_image'],
+          (out['fp32']['rpn_bytes'] + out['fp32']['classifier_bytes']) / (out['int8']['rpn_bytes'] + out['int8']['classifier_bytes'])), file=file)
+    if 'recall_delta' in out:
+        print("recall delta {:+.3f} , precision delta {:+.3f} ({} annotated images)".format(
+              out['recall_delta'], out['precision_delta'], out['annotated_images']), file=file)
+
+
+def load_annotations(folder, paths):
+    # ground truth boxes of paths (None when not annotated) from the <split>_images.json / <split>_objects.json lists 
+    # of folder, None without any
+    boxes = {}
+    for split in ('TEST', 'TRAIN'):
+        images, objects = os.path.join(folder, split + '_images.json'), os.path.join(folder, split + '_objects.json')
+        if os.path.isfile(images) and os.path.isfile(objects):
+            with open(images, 'r') as i, open(objects, 'r') as o:
+                boxes.update({os.path.basename(p): obj['boxes'] for p, obj in zip(json.load(i), json.load(o))})
+    annotations = [boxes.get(os.path.basename(p)) for p in paths]
+    return annotations if any(a is not None for a in annotations) else None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='INT8 checkpoint for cpu inference, with an accuracy / latency report against fp32')
+    parser.add_argument('-s', '--save-dir', type=str, default='models/', help="folder of the fp32 checkpoint")
+    parser.add_argument('-o', '--output', type=str, default='models_int8/', help="folder of the int8 checkpoint")
+    parser.add_argument('--calibration', nargs='+', default=['YeastCellDataset/train'], help="images (folders, files, .txt lists) for the activation ranges")
+    parser.add_argument('--num-calibration', type=int, default=8, help="calibration images used")
+    parser.add_argument('--eval', nargs='*', default=['YeastCellDataset/test'], help="images of the report, with the ground truth of their folder when it has one")
+    parser.add_argument('--labels', type=str, default='yeast_cell', help="comma separated class names, in the order of training (bg is added last)")
+    parser.add_argument('--engine', type=str, default='x86', choices=torch.backends.quantized.supported_engines)
+    parser.add_argument('--batch-size', type=int, default=4)
+    parser.add_argument('--height', type=int, default=512)
+    parser.add_argument('--width', type=int, default=512)
+    parser.add_argument('--anchor-sizes', type=str, default='8,16,32,64,128')
+    parser.add_argument('--anchor-ratios', type=str, default='0.5,1,2')
+    parser.add_argument('--score-thresh', type=float, default=0.5)
+    return parser.parse_args(argv)
+
+
+def run(args):
+    state = load_checkpoint(args.save_dir, device='cpu')
+    if state is None:
+        raise FileNotFoundError("no model.pth.tar checkpoint in {}".format(args.save_dir))
+    model_rpn, model_classifier = load_models(args.save_dir, device='cpu')
+
+    calibration = list_images(args.calibration)[:args.num_calibration]
+    loader = DataLoader(ImageList(calibration, (args.height, args.width)), batch_size=args.batch_size, num_workers=0, collate_fn=collate_images)
+    int8_rpn = quantize_rpn(model_rpn, [images for images, _, _ in loader], engine=args.engine)
+    int8_classifier = quantize_classifier(model_classifier, engine=args.engine)
+    save_int8(args.output, state, int8_rpn, int8_classifier, args.engine)
+    print("int8 checkpoint in {} , calibrated on {} images".format(args.output, len(calibration)), file=sys.stderr)
+
+    paths = list_images(args.eval)
+    if not paths:
+        return None
+    anchors = get_anchors(args.height, args.width, [int(s) for s in args.anchor_sizes.split(',')], [float(r) for r in args.anchor_ratios.split(',')])
+    folder = args.eval[0] if len(args.eval) == 1 and os.path.isdir(args.eval[0]) else None
+    out = report((model_rpn, model_classifier), load_models(args.output, device='cpu'), paths, anchors.grid_tensor(),
+                 len(args.labels.split(',')) + 1, args.height, args.width, args.batch_size,
+                 annotations=load_annotations(folder, paths) if folder else None, score_thresh=args.score_thresh)
+    print_report(out)
+    return out
+
+
+if __name__ == '__main__':
+    run(parse_args())
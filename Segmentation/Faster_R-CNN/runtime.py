@@ -0,0 +1,108 @@
+import os
+import sys
+import json
+import time
+import zipfile
+import argparse
+
+import numpy as np
+import torch
+from PIL import Image
+
+# Runs a detector exported by detector.py. Imports torch, numpy and PIL only (no main.py, matplotlib, torchvision
+# models), so a fresh process starts detecting after loading one file :
+#   python runtime.py detector.pt images/ -o detections.jsonl
+# Same JSON lines as infer.py : {"image": path, "boxes": [[x1, y1, x2, y2], ...] in pixels of the original image,
+# "scores": [...], "labels": [...]}
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp')
+
+
+def read_config(path):
+    # config.json saved next to the graph by detector.export_detector (the archive is a zip)
+    with zipfile.ZipFile(path) as archive:
+        name = next(n for n in archive.namelist() if n.endswith('/extra/config.json'))
+        return json.loads(archive.read(name))
+
+
+def load_detector(path, device='cpu'):
+    """The scripted Detector saved at path (eval mode, on device) and its config (height, width, labels, thresholds)"""
+    config = read_config(path)
+    if config.get('pooling') == 'align':
+        # registers torchvision::roi_align, the only torchvision op of the graph
+        import torchvision.ops # noqa: F401
+    detector = torch.jit.load(path, map_location=device)
+    return detector.eval(), config
+
+
+def read_image(path, height, width):
+    """uint8 (height, width, 3) RGB tensor of the image at path resized like infer.ImageList, and its size (w, h)"""
+    with Image.open(path, mode='r') as image:
+        orig_size = image.size
+        image = image.convert('RGB')
+        if image.size != (width, height):
+            image = image.resize((width, height))
+        return torch.from_numpy(np.asarray(image).copy()), orig_size
+
+
+def list_images(inputs):
+    # folders (sorted, not recursive), text files with one path per line, image files, like infer.list_images
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            paths += [os.path.join(item, f) for f in sorted(os.listdir(item)) if f.lower().endswith(IMAGE_EXTENSIONS)]
+        elif item.endswith('.txt'):
+            with open(item, 'r') as f:
+                paths += [line.strip() for line in f if line.strip()]
+        else:
+            paths.append(item)
+    return paths
+
+
+@torch.no_grad()
+def predict(detector, config, paths, batch_size=4, device='cpu'):
+    """Yields (path, boxes, scores, labels) of every image of paths, boxes in pixels of the original image"""
+    height, width, labels = config['height'], config['width'], config['labels']
+    for start in range(0, len(paths), batch_size):
+        batch = [read_image(p, height, width) for p in paths[start:start + batch_size]]
+        images = torch.stack([b[0] for b in batch], 0).to(device)
+        boxes, scores, classes, num = detector(images)
+        boxes, scores, classes, num = boxes.cpu(), scores.cpu(), classes.cpu(), num.tolist()
+        for j, (_, (w, h)) in enumerate(batch):
+            scale = torch.tensor([w / width, h / height, w / width, h / height])
+            yield paths[start + j], boxes[j, :num[j]] * scale, scores[j, :num[j]], [labels[c] for c in classes[j, :num[j]].tolist()]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Detections of a detector exported by detector.py')
+    parser.add_argument('detector', type=str, help="file written by detector.py")
+    parser.add_argument('inputs', nargs='+', help="image files, folders of images or .txt files with one path per line")
+    parser.add_argument('-o', '--output', type=str, default='detections.jsonl', help="JSON lines output, - for stdout")
+    parser.add_argument('--batch-size', type=int, default=4)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    return parser.parse_args(argv)
+
+
+def run(args):
+    start = time.perf_counter()
+    detector, config = load_detector(args.detector, device=args.device)
+    paths = list_images(args.inputs)
+    out = sys.stdout if args.output == '-' else open(args.output, 'w')
+    first = None
+    try:
+        for path, boxes, scores, labels in predict(detector, config, paths, batch_size=args.batch_size, device=args.device):
+            out.write(json.dumps({'image': path, 'boxes': [[round(c, 2) for c in b] for b in boxes.tolist()],
+                                  'scores': [round(v, 4) for v in scores.tolist()], 'labels': labels}) + "\n")
+            if first is None:
+                first = time.perf_counter() - start
+                out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    elapsed = time.perf_counter() - start
+    stats = {'images': len(paths), 'time': elapsed, 'first_image': first}
+    print("{} images in {:.2f} s , first after {:.2f} s".format(len(paths), elapsed, first or 0.0), file=sys.stderr)
+    return stats
+
+
+if __name__ == '__main__':
+    run(parse_args())
@@ -0,0 +1,345 @@
+import io
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from PIL import Image
+
+# Local inference server : the instruments post one frame per request, the server runs them in micro batches
+#   python server.py --detector detector.pt --port 8080          (exported by detector.py, fast start)
+#   python server.py -s models/ --unix /tmp/detector.sock         (checkpoint, like infer.py)
+#   curl --data-binary @frame.tif localhost:8080/detect
+# POST /detect : body = an encoded image (any format PIL reads), answer {"boxes": [[x1, y1, x2, y2], ...] in pixels
+#                of the image, "scores": [...], "labels": [...], "batch_size": n, "latency_ms": t}
+# GET /stats   : queue depth, batch size histogram, p50 / p99 latency (ms, from the end of the upload to the answer)
+# Frames are decoded / resized on a thread pool as they arrive. The batcher waits for a free worker, then takes the
+# first queued frame and whatever else arrives within --max-wait-ms, up to --max-batch frames.
+# Stdlib only for the network part (asyncio streams, HTTP/1.1 with keep alive), see loadgen.py to load it.
+LATENCY_WINDOW = 10000
+
+
+class ScriptedBackend(object):
+    """Batches of uint8 (B, H, W, 3) frames through a detector of detector.py"""
+    def __init__(self, path, device='cpu'):
+        from runtime import load_detector
+        self.detector, config = load_detector(path, device=device)
+        self.height, self.width, self.labels = config['height'], config['width'], config['labels']
+        self.device = device
+
+    @torch.no_grad()
+    def __call__(self, images):
+        return self.detector(images.to(self.device))
+
+
+class CheckpointBackend(object):
+    """Batches of uint8 (B, H, W, 3) frames through the models of a checkpoint and infer.detect"""
+    def __init__(self, save_dir, height=512, width=512, labels=('yeast_cell',), device='cpu', score_thresh=0.5,
+                 anchor_sizes=(8, 16, 32, 64, 128), anchor_ratios=(0.5, 1, 2)):
+        from infer import load_models
+        from tools import get_anchors
+        self.model_rpn, self.model_classifier = load_models(save_dir, device=device)
+        self.grid = get_anchors(height, width, list(anchor_sizes), list(anchor_ratios)).grid_tensor(device=device)
+        self.height, self.width, self.labels = height, width, list(labels) + ['bg']
+        self.device = torch.device(device)
+        self.score_thresh = score_thresh
+        self.mean = torch.tensor([0.485, 0.456, 0.406], device=self.device).reshape(1, 3, 1, 1)
+        self.std = torch.tensor([0.229, 0.224, 0.225], device=self.device).reshape(1, 3, 1, 1)
+
+    @torch.no_grad()
+    def __call__(self, images):
+        from infer import detect
+        images = (images.to(self.device).permute(0, 3, 1, 2).float() / 255 - self.mean) / self.std
+        return detect(self.model_rpn, self.model_classifier, images, self.grid, bg_class=len(self.labels) - 1,
+                      score_thresh=self.score_thresh)
+
+
+class Stats(object):
+    def __init__(self):
+        self.started = time.monotonic()
+        self.requests = 0
+        self.errors = 0
+        self.batches = collections.Counter()
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.max_queue = 0
+
+    def as_dict(self, queue_depth, busy_workers):
+        latencies = np.array(self.latencies) if self.latencies else np.zeros(1)
+        return {
+            'uptime_s': time.monotonic() - self.started,
+            'requests': self.requests,
+            'errors': self.errors,
+            'queue_depth': queue_depth,
+            'max_queue_depth': self.max_queue,
+            'busy_workers': busy_workers,
+            'batch_size_histogram': {str(k): v for k, v in sorted(self.batches.items())},
+            'mean_batch_size': sum(k * v for k, v in self.batches.items()) / max(1, sum(self.batches.values())),
+            'latency_ms': {'p50': float(np.percentile(latencies, 50)), 'p99': float(np.percentile(latencies, 99)),
+                           'window': len(self.latencies)},
+        }
+
+
+async def get_within(queue, timeout):
+    # next item of queue, None after timeout seconds (an item arriving as the wait is cancelled is still returned,
+    # wait_for could drop it)
+    getter = asyncio.get_running_loop().create_task(queue.get())
+    done, _ = await asyncio.wait({getter}, timeout=timeout)
+    if not done:
+        getter.cancel()
+    try:
+        return await getter
+    except asyncio.CancelledError:
+        return None
+
+
+class MicroBatcher(object):
+    """Queue of decoded frames, runs them in batches of at most max_batch on num_workers threads
+
+    submit(image) returns the detections of the frame once its batch is done.
+    """
+    def __init__(self, backend, max_batch=8, max_wait=0.01, num_workers=1, decode_threads=2):
+        self.backend = backend
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.num_workers = num_workers
+        self.workers = ThreadPoolExecutor(num_workers, thread_name_prefix='detect')
+        self.decoders = ThreadPoolExecutor(decode_threads, thread_name_prefix='decode')
+        self.stats = Stats()
+        self.queue = None
+        self.free = None
+        self.busy = 0
+        self.task = None
+        self.running = set() # the loop only keeps weak references to tasks
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.free = asyncio.Semaphore(self.num_workers)
+        self.task = asyncio.get_running_loop().create_task(self.batches())
+
+    async def stop(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.workers.shutdown(wait=True)
+        self.decoders.shutdown(wait=True)
+
+    def decode(self, data):
+        # uint8 (H, W, 3) frame at the input size of the backend, and the size (w, h) of the posted image
+        with Image.open(io.BytesIO(data)) as image:
+            size = image.size
+            image = image.convert('RGB')
+            if image.size != (self.backend.width, self.backend.height):
+                image = image.resize((self.backend.width, self.backend.height))
+            return torch.from_numpy(np.asarray(image).copy()), size
+
+    async def submit(self, data, received):
+        loop = asyncio.get_running_loop()
+        image, size = await loop.run_in_executor(self.decoders, self.decode, data)
+        future = loop.create_future()
+        await self.queue.put((image, size, future, received))
+        self.stats.max_queue = max(self.stats.max_queue, self.queue.qsize())
+        return await future
+
+    async def batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.free.acquire()
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                # frames already queued are taken without waiting
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                item = await get_within(self.queue, remaining)
+                if item is None:
+                    break
+                batch.append(item)
+            self.busy += 1
+            task = loop.create_task(self.run(batch))
+            self.running.add(task)
+            task.add_done_callback(self.running.discard)
+
+    async def run(self, batch):
+        loop = asyncio.get_running_loop()
+        try:
+            images = torch.stack([b[0] for b in batch], 0)
+            boxes, scores, classes, num = await loop.run_in_executor(self.workers, self.backend, images)
+            boxes, scores, classes, num = boxes.cpu(), scores.cpu(), classes.cpu(), num.tolist()
+        except Exception as e:
+            self.stats.errors += len(batch)
+            for _, _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self.busy -= 1
+            self.free.release()
+        self.stats.batches[len(batch)] += 1
+        labels = self.backend.labels
+        for j, (_, (w, h), future, received) in enumerate(batch):
+            sx, sy = w / self.backend.width, h / self.backend.height
+            latency = 1000 * (time.monotonic() - received)
+            self.stats.requests += 1
+            self.stats.latencies.append(latency)
+            if not future.done():
+                future.set_result({
+                    'boxes': [[round(c, 2) for c in bx] for bx in (boxes[j, :num[j]] * torch.tensor([sx, sy, sx, sy])).tolist()],
+                    'scores': [round(v, 4) for v in scores[j, :num[j]].tolist()],
+                    'labels': [labels[c] for c in classes[j, :num[j]].tolist()],
+                    'batch_size': len(batch),
+                    'latency_ms': round(latency, 2),
+                })
+
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+async def read_request(reader, max_body):
+    # (method, path, headers, body) of the next request of the connection, None once the client closed it
+    line = await reader.readline()
+    if not line:
+        return None
+    method, path, _ = line.decode('latin-1').split(' ', 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0))
+    if length > max_body:
+        raise ValueError("body of {} bytes".format(length))
+    body = await reader.readexactly(length) if length > 0 else b''
+    return method, path, headers, body
+
+
+def write_response(writer, status, payload, keep_alive=True):
+    body = json.dumps(payload).encode()
+    writer.write("HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n".format(
+        status, REASONS[status], len(body), 'keep-alive' if keep_alive else 'close').encode() + body)
+
+
+class Server(object):
+    """HTTP front end of a MicroBatcher, on a TCP port or a unix socket"""
+    def __init__(self, batcher, host='127.0.0.1', port=8080, unix=None, max_body=64 << 20):
+        self.batcher = batcher
+        self.host, self.port, self.unix = host, port, unix
+        self.max_body = max_body
+        self.server = None
+
+    async def start(self):
+        self.batcher.start()
+        if self.unix:
+            if os.path.exists(self.unix):
+                os.remove(self.unix)
+            self.server = await asyncio.start_unix_server(self.handle, path=self.unix)
+        else:
+            self.server = await asyncio.start_server(self.handle, self.host, self.port)
+            self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        await self.batcher.stop()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await read_request(reader, self.max_body)
+                except ValueError as e:
+                    write_response(writer, 413 if 'body' in str(e) else 400, {'error': str(e)}, keep_alive=False)
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                status, payload = await self.route(method, path.split('?')[0], body)
+                write_response(writer, status, payload, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method, path, body):
+        if path == '/detect':
+            if method != 'POST':
+                return 405, {'error': "POST an encoded image"}
+            received = time.monotonic()
+            try:
+                return 200, await self.batcher.submit(body, received)
+            except (OSError, ValueError) as e:
+                # PIL could not read the body
+                self.batcher.stats.errors += 1
+                return 400, {'error': str(e)}
+            except Exception as e:
+                return 500, {'error': str(e)}
+        if path == '/stats':
+            return 200, self.batcher.stats.as_dict(self.batcher.queue.qsize(), self.batcher.busy)
+        if path == '/health':
+            return 200, {'status': 'ok'}
+        return 404, {'error': "unknown path {}".format(path)}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Micro batching HTTP inference server')
+    parser.add_argument('--detector', type=str, default=None, help="detector exported by detector.py (else -s checkpoint)")
+    parser.add_argument('-s', '--save-dir', type=str, default='models/', help="folder of the checkpoint, without --detector")
+    parser.add_argument('--labels', type=str, default='yeast_cell', help="comma separated class names, with -s")
+    parser.add_argument('--height', type=int, default=512, help="with -s")
+    parser.add_argument('--width', type=int, default=512, help="with -s")
+    parser.add_argument('--score-thresh', type=float, default=0.5, help="with -s")
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--unix', type=str, default=None, help="path of a unix socket instead of --host / --port")
+    parser.add_argument('--max-batch', type=int, default=8, help="frames per batch at most")
+    parser.add_argument('--max-wait-ms', type=float, default=10.0, help="longest wait for more frames once one is queued")
+    parser.add_argument('--workers', type=int, default=1, help="batches run at once (torch threads are split between them)")
+    parser.add_argument('--decode-threads', type=int, default=2)
+    return parser.parse_args(argv)
+
+
+def make_batcher(args):
+    if args.workers > 1:
+        torch.set_num_threads(max(1, torch.get_num_threads() // args.workers))
+    if args.detector:
+        backend = ScriptedBackend(args.detector, device=args.device)
+    else:
+        backend = CheckpointBackend(args.save_dir, args.height, args.width, args.labels.split(','), device=args.device,
+                                    score_thresh=args.score_thresh)
+    return MicroBatcher(backend, max_batch=args.max_batch, max_wait=args.max_wait_ms / 1000, num_workers=args.workers,
+                        decode_threads=args.decode_threads)
+
+
+async def serve(args):
+    server = Server(make_batcher(args), host=args.host, port=args.port, unix=args.unix)
+    await server.start()
+    print("serving on {}".format(args.unix or "http://{}:{}".format(args.host, server.port)), file=sys.stderr)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(serve(parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,143 @@
+import os
+import io
+import json
+import random
+import hashlib
+import warnings
+
+import numpy as np
+from torch.utils.data import IterableDataset, get_worker_info
+
+from dataset import write_cache_entry , annotations_digest
+
+# Packed shards for datasets on network storage : one folder per split
+#   shard_00000.bin ... : records back to back, a record is the encoded image file (as is, never re-encoded)
+#                         followed by its boxes (float32, 4 per box) and its labels (int64, as annotated)
+#   shard.npy / offset.npy : shard and byte offset of record i, image_bytes.npy / num_boxes.npy / num_labels.npy its parts
+# Record i is image i of the Dataset (the RPN cache is indexed the same way). A shard is only read front to
+# back, so a worker opens one file per shard instead of one per image and never seeks.
+INDEX = ('shard', 'offset', 'image_bytes', 'num_boxes', 'num_labels')
+
+
+def shard_name(shard):
+    return "shard_{:05d}.bin".format(shard)
+
+
+def shard_key(dataset, shard_bytes):
+    return {
+        'split': dataset.split,
+        'annotations': annotations_digest(dataset),
+        'shard_bytes': shard_bytes,
+    }
+
+
+def build_shards(dataset, cache_dir, shard_bytes=256 << 20):
+    """Writer of the shards, returns the path of the entry for this dataset
+
+    Records are appended to the current shard until it would grow past shard_bytes.
+    """
+    if dataset.image_store is not None:
+        raise ValueError("the shards pack the original files, the dataset already reads an image store")
+    key = shard_key(dataset, shard_bytes)
+    name = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+    path = os.path.join(cache_dir, "shards_{}_{}".format(dataset.split, name))
+    if os.path.isdir(path):
+        return path
+
+    def fill(tmp):
+        index = {k: np.zeros(len(dataset), dtype=np.int64) for k in INDEX}
+        shard, offset, f = -1, 0, None
+        for i in range(len(dataset)):
+            with open(dataset.images[i], 'rb') as image:
+                data = image.read()
+            objects = dataset.objects[i]
+            boxes = np.asarray(objects['boxes'], dtype=np.float32).reshape(-1, 4)
+            labels = np.asarray(objects['labels'], dtype=np.int64).reshape(-1)
+            record = data + boxes.tobytes() + labels.tobytes()
+            if f is None or (offset > 0 and offset + len(record) > shard_bytes):
+                if f is not None:
+                    f.close()
+                shard, offset = shard + 1, 0
+                f = open(os.path.join(tmp, shard_name(shard)), 'wb')
+            f.write(record)
+            for k, v in zip(INDEX, (shard, offset, len(data), boxes.shape[0], labels.shape[0])):
+                index[k][i] = v
+            offset += len(record)
+        if f is not None:
+            f.close()
+        for k, v in index.items():
+            np.save(os.path.join(tmp, k + ".npy"), v)
+
+    return write_cache_entry(path, key, {}, fill=fill)
+
+
+class ShardDataset(IterableDataset):
+    """Streaming reader of build_shards, yields the samples of dataset (the tuples of Dataset.__getitem__)
+
+    Every epoch the shard order is shuffled (seed + epoch, the same in all the workers) and worker w reads
+    the shards w, w + num_workers, ... front to back. The records go through a shuffle buffer of buffer_size :
+    once it is full, every new record sends a random one of the buffer to decoding. Only encoded records
+    are buffered. Call set_epoch(epoch) before iterating.
+    """
+    def __init__(self, dataset, path, shuffle=True, buffer_size=64, seed=0):
+        super(ShardDataset, self).__init__()
+        self.dataset = dataset
+        self.path = path
+        with open(os.path.join(path, "key.json"), 'r') as j:
+            self.key = json.load(j)
+        if self.key != shard_key(dataset, self.key['shard_bytes']):
+            raise ValueError("stale shards {}".format(path))
+        self.index = {k: np.load(os.path.join(path, k + ".npy")) for k in INDEX}
+        self.num_shards = int(self.index['shard'].max()) + 1 if len(dataset) > 0 else 0
+        self.shuffle = shuffle
+        self.buffer_size = max(1, buffer_size)
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return len(self.index['shard'])
+
+    def records(self, shard):
+        # (i, encoded image, boxes, labels) of one shard, in file order
+        rows = np.flatnonzero(self.index['shard'] == shard)
+        rows = rows[np.argsort(self.index['offset'][rows], kind='stable')]
+        with open(os.path.join(self.path, shard_name(shard)), 'rb', buffering=1 << 22) as f:
+            for i in rows.tolist():
+                data = f.read(int(self.index['image_bytes'][i]))
+                boxes = np.frombuffer(f.read(16 * int(self.index['num_boxes'][i])), dtype=np.float32).reshape(-1, 4)
+                labels = np.frombuffer(f.read(8 * int(self.index['num_labels'][i])), dtype=np.int64)
+                yield i, data, boxes, labels
+
+    def load(self, i, data, boxes, labels):
+        image, orig_size = self.dataset.transform_for(i).open(io.BytesIO(data))
+        return self.dataset.make_sample(i, image, orig_size, boxes.tolist(), self.dataset.format_labels(labels.tolist()))
+
+    def __iter__(self):
+        shards = list(range(self.num_shards))
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(shards)
+        worker, num_workers = 0, 1
+        info = get_worker_info()
+        if info is not None:
+            worker, num_workers = info.id, info.num_workers
+            if num_workers > self.num_shards and worker == 0:
+                warnings.warn("{} workers for {} shards, some workers stay idle (smaller shards)".format(num_workers, self.num_shards))
+        rng = random.Random("{}-{}-{}".format(self.seed, self.epoch, worker))
+
+        buffer = []
+        for shard in shards[worker::num_workers]:
+            for record in self.records(shard):
+                if not self.shuffle:
+                    yield self.load(*record)
+                    continue
+                buffer.append(record)
+                if len(buffer) >= self.buffer_size:
+                    j = rng.randrange(len(buffer))
+                    buffer[j], buffer[-1] = buffer[-1], buffer[j]
+                    yield self.load(*buffer.pop())
+        rng.shuffle(buffer)
+        for record in buffer:
+            yield self.load(*record)
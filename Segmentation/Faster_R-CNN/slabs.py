@@ -0,0 +1,189 @@
+import time
+import collections
+import multiprocessing
+
+import torch
+
+import diag
+from dataset import collate_fn , Collated
+
+# Shared memory collate : with collate_fn every tensor of a batch is stacked / concatenated in the worker, then
+# copied again into a new shared memory segment (one file descriptor each) when the batch is sent to the main process.
+# Here the slabs are allocated once, before the workers start : the worker writes the batch straight into a free
+# slab and only sends a SlabBatch (slab number, layout, offsets), the main process reads views of the slab.
+# A slab holds, 64 byte aligned :
+#   images (b, 3, h, w) | boxes of all the images back to back | labels (int64) | rpn targets pos / neg / regr
+# image j owns boxes[box_offsets[j]:box_offsets[j + 1]], same for the labels and the targets (pos_offsets ...).
+ALIGN = 64
+FIELDS = ('images', 'boxes', 'labels', 'pos', 'neg', 'regr')
+
+
+def align(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+def sizes(tensors):
+    # offsets of the tensors once concatenated (python list, sent with the SlabBatch)
+    out = [0]
+    for t in tensors:
+        out.append(out[-1] + t.size(0))
+    return out
+
+
+def uncollate(batch):
+    # samples (views) of a Collated batch of Dataset.__getitems__
+    images, boxes, labels, targets, num_pos = batch
+    p, n = targets['pos_offsets'].tolist(), targets['neg_offsets'].tolist()
+    return [(images[j], boxes[j], labels[j], {'pos': targets['pos'][p[j]:p[j + 1]], 'neg': targets['neg'][n[j]:n[j + 1]],
+             'regr': targets['regr'][p[j]:p[j + 1]]}, num_pos[j]) for j in range(len(boxes))]
+
+
+class SlabBatch(object):
+    # what the worker sends : a few hundred bytes whatever the batch size
+    def __init__(self, slot, layout, offsets, num_pos):
+        self.slot = slot
+        self.layout = layout # field ==> (byte offset in the slab, dtype, shape)
+        self.offsets = offsets # box_offsets / label_offsets / pos_offsets / neg_offsets
+        self.num_pos = num_pos
+
+
+class SlabPool(object):
+    """num_slots slabs of slab_bytes in shared memory, a slab is either free or owned by one batch
+
+    Create it before the DataLoader (the workers inherit it, or get it pickled with the collate function).
+    A batch stays valid until its slab is released, see SlabLoader.
+    """
+    def __init__(self, num_slots, slab_bytes):
+        self.slab_bytes = align(slab_bytes)
+        self.slabs = torch.empty(num_slots, self.slab_bytes, dtype=torch.uint8).share_memory_()
+        self.free = torch.ones(num_slots, dtype=torch.uint8).share_memory_()
+        self.lock = multiprocessing.Lock()
+
+    def __len__(self):
+        return self.slabs.size(0)
+
+    def acquire(self, timeout=1.0):
+        # number of a free slab, None if there was none for timeout seconds
+        deadline = time.monotonic() + timeout
+        while True:
+            with self.lock:
+                free = torch.nonzero(self.free).flatten()
+                if free.numel() > 0:
+                    slot = int(free[0])
+                    self.free[slot] = 0
+                    return slot
+            if time.monotonic() > deadline:
+                return None
+            time.sleep(0.001)
+
+    def release(self, slot):
+        with self.lock:
+            self.free[slot] = 1
+
+    def view(self, slot, offset, dtype, shape):
+        numel = 1
+        for s in shape:
+            numel *= s
+        nbytes = numel * torch.empty(0, dtype=dtype).element_size()
+        return self.slabs[slot, offset:offset + nbytes].view(dtype).view(shape)
+
+    def unpack(self, batch):
+        """views of the slab of batch, same structure as collate_fn : images, boxes, labels, targets, num_pos"""
+        t = {name: self.view(batch.slot, *batch.layout[name]) for name in FIELDS}
+        o = batch.offsets
+        boxes = [t['boxes'][o['box_offsets'][j]:o['box_offsets'][j + 1]] for j in range(len(batch.num_pos))]
+        labels = [t['labels'][o['label_offsets'][j]:o['label_offsets'][j + 1]].tolist() for j in range(len(batch.num_pos))]
+        targets = {
+            'pos': t['pos'],
+            'neg': t['neg'],
+            'regr': t['regr'],
+            'pos_offsets': torch.tensor(o['pos_offsets'], dtype=torch.int64),
+            'neg_offsets': torch.tensor(o['neg_offsets'], dtype=torch.int64),
+        }
+        return t['images'], boxes, labels, targets, batch.num_pos
+
+
+class SlabCollate(object):
+    """collate_fn writing into a slab of pool (to be passed to the DataLoader)
+
+    Falls back to collate_fn (and says so once per second with diag) when the batch does not fit
+    in a slab or no slab was released within timeout seconds, a batch is never lost.
+    """
+    def __init__(self, pool, timeout=1.0):
+        self.pool = pool
+        self.timeout = timeout
+
+    def __call__(self, batch):
+        if isinstance(batch, Collated):
+            batch = uncollate(batch)
+        parts = {
+            'images': [b[0] for b in batch],
+            'boxes': [b[1].reshape(-1, 4) for b in batch],
+            'labels': [torch.as_tensor(b[2], dtype=torch.int64).reshape(-1) for b in batch],
+            'pos': [b[3]['pos'] for b in batch],
+            'neg': [b[3]['neg'] for b in batch],
+            'regr': [b[3]['regr'] for b in batch],
+        }
+        layout, offset = {}, 0
+        for name in FIELDS:
+            first = parts[name][0]
+            if name == 'images':
+                shape = (len(batch),) + tuple(first.shape)
+            else:
+                shape = (sum(t.size(0) for t in parts[name]),) + tuple(first.shape[1:])
+            layout[name] = (offset, first.dtype, shape)
+            offset += align(first.element_size() * int(torch.Size(shape).numel()))
+
+        slot = self.pool.acquire(self.timeout) if offset <= self.pool.slab_bytes else None
+        if slot is None:
+            diag.log(diag.WARNING, "slabs.collate", "batch of {} bytes sent without a slab (slab of {} bytes, {} slabs)",
+                     offset, self.pool.slab_bytes, len(self.pool))
+            return collate_fn(batch)
+
+        for name in FIELDS:
+            out = self.pool.view(slot, *layout[name])
+            if name == 'images':
+                torch.stack(parts[name], dim=0, out=out)
+            else:
+                torch.cat(parts[name], dim=0, out=out)
+        offsets = {
+            'box_offsets': sizes(parts['boxes']),
+            'label_offsets': sizes(parts['labels']),
+            'pos_offsets': sizes(parts['pos']),
+            'neg_offsets': sizes(parts['neg']),
+        }
+        return SlabBatch(slot, layout, offsets, [b[4] for b in batch])
+
+
+class SlabLoader(object):
+    """Iterates over a DataLoader using SlabCollate, yields the batches of collate_fn
+
+    The slab of batch n is released when batch n + hold arrives : hold is the number of batches the
+    consumer may use at once (1 for a plain loop, the prefetch depth + 2 behind a DevicePrefetcher on cpu).
+    The pool needs num_workers * prefetch_factor + hold + 1 slabs to never fall back to collate_fn.
+    """
+    def __init__(self, loader, pool, hold=1):
+        self.loader = loader
+        self.pool = pool
+        self.hold = hold
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        held = collections.deque()
+        try:
+            for batch in self.loader:
+                while len(held) >= self.hold:
+                    self.pool.release(held.popleft())
+                if isinstance(batch, SlabBatch):
+                    held.append(batch.slot)
+                    batch = self.pool.unpack(batch)
+                yield batch
+        finally:
+            while held:
+                self.pool.release(held.popleft())
+
+
+def num_slots(num_workers, prefetch_factor=2, hold=1):
+    return max(1, num_workers) * prefetch_factor + hold + 1
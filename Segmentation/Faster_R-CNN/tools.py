@@ -2,9 +2,14 @@ import math
 from matplotlib.pyplot import box
 import numpy as np 
 import random 
-from utils import iou , iou_tensor
+import os 
+import json 
+import hashlib 
+import warnings 
+from utils import iou , iou_tensor , iou_matrix
 import copy 
 import torch 
+import diag
 # Code taken from 
 # https://github.com/RockyXu66/Faster_RCNN_for_Open_Images_Dataset_Keras/blob/master/frcnn_train_vgg.ipynb
 
@@ -80,6 +85,237 @@ def default_anchors(out_h, out_w, anchor_sizes, anchor_ratios, downscale):
     return A 
             
 
+# Anchor registry 
+# one entry per (height, width, anchor_sizes, anchor_ratios, downscale), holding both anchor views : 
+#   valid_boxes / valid_locs : anchors fully inside the image, in valid_anchors() order (RPM targets)
+#   grid : dense (4, out_h, out_w, num_anchors) x, y, w, h on the feature map (rpn_to_roi)
+# entries are saved as .npy files and memory-mapped read-only, so DataLoader workers share the pages 
+ANCHOR_REGISTRY = {}
+
+
+def bucket_sizes(height, width, aspect_ratios, multiple=32):
+    """Canonical input sizes of the aspect ratio buckets, about height x width pixels each
+
+    Args:
+        aspect_ratios: w / h of every bucket, e.g. (3 / 4, 1, 4 / 3)
+        multiple: both sides are rounded to it (a whole number of feature map cells)
+    Returns:
+        list of (h, w)
+    """
+    area = height * width
+    sizes = []
+    for ratio in aspect_ratios:
+        h = max(multiple, int(round(math.sqrt(area / ratio) / multiple)) * multiple)
+        w = max(multiple, int(round(math.sqrt(area * ratio) / multiple)) * multiple)
+        sizes.append((h, w))
+    return sizes
+
+
+def anchor_key(height, width, anchor_sizes, anchor_ratios, downscale):
+    return (int(height), int(width), tuple(float(s) for s in anchor_sizes), tuple(float(r) for r in anchor_ratios), int(downscale))
+
+
+def default_downscale(height, width):
+    # see convention figure 
+    out_h , out_w = base_size_calculator(height, width)
+    return max(math.ceil(height / out_h) , math.ceil(width / out_w))
+
+
+class Anchors(object):
+    """Both anchor views of one registry key, see get_anchors"""
+    def __init__(self, key, valid_boxes, valid_locs, grid, path=None):
+        super(Anchors, self).__init__()
+        self.key = key
+        self.valid_boxes = valid_boxes
+        self.valid_locs = valid_locs
+        self.grid = grid
+        self.path = path
+
+    @property
+    def height(self):
+        return self.key[0]
+
+    @property
+    def width(self):
+        return self.key[1]
+
+    @property
+    def downscale(self):
+        return self.key[4]
+
+    @property
+    def num_anchors(self):
+        return self.grid.shape[3]
+
+    def __getstate__(self):
+        # cached entries only send their key and path to the DataLoader workers 
+        if self.path is not None:
+            return {'key': self.key, 'path': self.path}
+        return self.__dict__.copy()
+
+    def __setstate__(self, state):
+        if 'grid' not in state:
+            loaded = get_anchors(*state['key'], cache_dir=os.path.dirname(state['path']))
+            state = loaded.__dict__
+        self.__dict__.update(state)
+
+    def grid_tensor(self, device='cpu'):
+        # shares the (read-only) buffer on cpu, callers must not write into it 
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", UserWarning)
+            grid = torch.from_numpy(self.grid)
+        return grid.to(device=device)
+
+    def as_dict(self):
+        # nested dict layout of valid_anchors() 
+        n_anchratios = len(self.key[3])
+        anchor_boxes = {s: {r: [] for r in range(n_anchratios)} for s in range(len(self.key[2]))}
+        for (x1_anc , y1_anc , x2_anc,  y2_anc), (jy, ix, a) in zip(self.valid_boxes.tolist(), self.valid_locs.tolist()):
+            anchor_boxes[a // n_anchratios][a % n_anchratios].append((x1_anc , y1_anc , x2_anc,  y2_anc , ix , jy))
+        return anchor_boxes
+
+
+def build_anchors(height, width, anchor_sizes, anchor_ratios, downscale):
+    key = anchor_key(height, width, anchor_sizes, anchor_ratios, downscale)
+    out_h , out_w = base_size_calculator(height, width)
+    num_anchors = len(anchor_sizes) * len(anchor_ratios)
+
+    grid = np.zeros((4, out_h, out_w, num_anchors), dtype=np.float32)
+    valid_boxes = []
+    valid_locs = []
+    ix = np.arange(out_w)
+    jy = np.arange(out_h)
+    curr_layer = 0 
+    for anchor_size in anchor_sizes:
+        for anchor_ratio in anchor_ratios:
+            # (Equation : 1, see figure), same arithmetic as valid_anchors()
+            ratio_square_root = abs(math.sqrt(anchor_ratio))
+            anchor_x = anchor_size * ratio_square_root
+            anchor_y = anchor_size / ratio_square_root
+            x1_anc = downscale * (ix + 0.5) - anchor_x / 2
+            x2_anc = downscale * (ix + 0.5) + anchor_x / 2
+            y1_anc = downscale * (jy + 0.5) - anchor_y / 2
+            y2_anc = downscale * (jy + 0.5) + anchor_y / 2
+
+            # downscale transfers real image bounding box to base layer model output 
+            grid[0, :, :, curr_layer] = (x1_anc / downscale)[None, :]
+            grid[1, :, :, curr_layer] = (y1_anc / downscale)[:, None]
+            grid[2, :, :, curr_layer] = anchor_x / downscale
+            grid[3, :, :, curr_layer] = anchor_y / downscale
+
+            # ignore boxes that go across image boundaries, ix major like valid_anchors()
+            valid_x = np.where((x1_anc >= 0) & (x2_anc <= width))[0]
+            valid_y = np.where((y1_anc >= 0) & (y2_anc <= height))[0]
+            xs , ys = np.meshgrid(valid_x, valid_y, indexing='ij')
+            xs , ys = xs.reshape(-1), ys.reshape(-1)
+            valid_boxes.append(np.stack([x1_anc[xs], y1_anc[ys], x2_anc[xs], y2_anc[ys]], axis=1))
+            valid_locs.append(np.stack([ys, xs, np.full_like(xs, curr_layer)], axis=1))
+            curr_layer += 1
+
+    valid_boxes = np.ascontiguousarray(np.concatenate(valid_boxes, 0), dtype=np.float64)
+    valid_locs = np.ascontiguousarray(np.concatenate(valid_locs, 0), dtype=np.int64)
+    return Anchors(key, valid_boxes, valid_locs, grid)
+
+
+def _anchor_cache_path(key, cache_dir):
+    name = hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, "anchors_" + name)
+
+
+def _load_cached_anchors(key, path):
+    with open(os.path.join(path, "key.json"), 'r') as j:
+        if anchor_key(*json.load(j)) != key:
+            return None
+    arrays = [np.load(os.path.join(path, name + ".npy"), mmap_mode='r') for name in ("valid_boxes", "valid_locs", "grid")]
+    return Anchors(key, *arrays, path=path)
+
+
+def get_anchors(height, width, anchor_sizes, anchor_ratios, downscale=None, cache_dir=None):
+    """Returns the registry entry (Anchors) for this input size and anchor config
+
+    Built once per process. With a cache_dir the arrays are persisted there and memory-mapped,
+    so later runs and every DataLoader worker reuse the same read-only buffers.
+    """
+    if downscale is None:
+        downscale = default_downscale(height, width)
+    key = anchor_key(height, width, anchor_sizes, anchor_ratios, downscale)
+    if key in ANCHOR_REGISTRY:
+        return ANCHOR_REGISTRY[key]
+
+    anchors = None
+    if cache_dir is not None:
+        path = _anchor_cache_path(key, cache_dir)
+        if os.path.isdir(path):
+            anchors = _load_cached_anchors(key, path)
+        if anchors is None:
+            built = build_anchors(*key)
+            tmp = "{}.tmp{}".format(path, os.getpid())
+            os.makedirs(tmp, exist_ok=True)
+            for name in ("valid_boxes", "valid_locs", "grid"):
+                np.save(os.path.join(tmp, name + ".npy"), getattr(built, name))
+            with open(os.path.join(tmp, "key.json"), 'w') as j:
+                json.dump(list(key), j)
+            try:
+                os.replace(tmp, path)
+            except OSError:
+                # written by another process in the meantime 
+                for f in os.listdir(tmp):
+                    os.remove(os.path.join(tmp, f))
+                os.rmdir(tmp)
+            anchors = _load_cached_anchors(key, path)
+    else:
+        anchors = build_anchors(*key)
+
+    ANCHOR_REGISTRY[key] = anchors
+    return anchors
+
+
+
+def valid_anchor_arrays(valid_anchors, n_anchratios):
+    # flattens the nested dict from valid_anchors(), keeping its iteration order
+    # boxes : (N, 4) x1, y1, x2, y2 
+    # locs : (N, 3) jy, ix, anchor index (anchor_ratio_idx + n_anchratios * anchor_size_idx) 
+    boxes = []
+    locs = []
+    for anchor_size_idx in valid_anchors:
+        for anchor_ratio_idx in valid_anchors[anchor_size_idx]:
+            for (x1_anc , y1_anc , x2_anc,  y2_anc , ix , jy) in valid_anchors[anchor_size_idx][anchor_ratio_idx]:
+                boxes.append((x1_anc , y1_anc , x2_anc,  y2_anc))
+                locs.append((jy, ix, anchor_ratio_idx + n_anchratios * anchor_size_idx))
+    boxes = np.array(boxes, dtype=np.float64).reshape(-1, 4)
+    locs = np.array(locs, dtype=np.int64).reshape(-1, 3)
+    return boxes, locs
+
+
+
+def regr_targets(anchors, gta):
+    # tx, ty, tw, th of the GT boxes gta (N, 4) with respect to anchors (N, 4) 
+    golden_center_x = (gta[:, 0] + gta[:, 2]) / 2.0
+    golden_center_y = (gta[:, 1] + gta[:, 3]) / 2.0
+
+    anchor_center_x = (anchors[:, 0] + anchors[:, 2]) / 2.0
+    anchor_center_y = (anchors[:, 1] + anchors[:, 3]) / 2.0
+
+    tx = (golden_center_x - anchor_center_x) / (anchors[:, 2] - anchors[:, 0])
+    ty = (golden_center_y - anchor_center_y) / (anchors[:, 3] - anchors[:, 1])
+    tw = np.log((gta[:, 2] - gta[:, 0]) / (anchors[:, 2] - anchors[:, 0]))
+    th = np.log((gta[:, 3] - gta[:, 1]) / (anchors[:, 3] - anchors[:, 1]))
+    return np.stack([tx, ty, tw, th], axis=1)
+
+
+
+# max number of GT boxes (columns) of an IoU matrix of calc_rpn_targets_batch
+IOU_BLOCK = 64
+
+
+def best_anchor_for_bbox(ious):
+    # best anchor (row) for every GT box (column) of an IoU matrix, first one on ties 
+    # the anchor loop keeps its running best IoU in float32, so IoUs are compared at that precision 
+    best_anchor = ious.astype(np.float32).argmax(0)
+    return best_anchor, ious[best_anchor, np.arange(ious.shape[1])]
+
+
+
 class RPM():
     def __init__(self, anchor_sizes , anchor_ratios, valid_anchors, rev_label_map, rpn_max_overlap=0.7 , rpn_min_overlap=0.3, num_regions = 300 ):
         super(RPM, self).__init__()
@@ -90,12 +326,200 @@ class RPM():
         self.rpn_min_overlap = rpn_min_overlap
         self.rev_label_map = rev_label_map
         self.num_regions = num_regions
+        # valid_anchors is either an Anchors registry entry or the nested dict from valid_anchors()
+        if isinstance(valid_anchors, dict):
+            # flat copy (same order) for the vectorized engine 
+            boxes , locs = valid_anchor_arrays(valid_anchors, len(anchor_ratios))
+            self.anchors = Anchors(None, boxes, locs, None)
+        else:
+            self.anchors = valid_anchors
+
+    def anchors_for(self, image_resize_size):
+        # registry entry of another input size (aspect ratio buckets), same anchor config and downscale 
+        image_resize_size = tuple(int(s) for s in image_resize_size)
+        if self.anchors.key is None:
+            # a valid_anchors() dict only exists for its own size
+            return self.anchors
+        if image_resize_size == (self.anchors.height, self.anchors.width):
+            return self.anchors
+        cache_dir = os.path.dirname(self.anchors.path) if self.anchors.path is not None else None
+        return get_anchors(image_resize_size[0], image_resize_size[1], self.anchor_sizes, self.anchor_ratios, 
+                           downscale=self.anchors.downscale, cache_dir=cache_dir)
+
+    @property
+    def anchor_boxes(self):
+        return self.anchors.valid_boxes
+
+    @property
+    def anchor_locs(self):
+        return self.anchors.valid_locs
         
     
     def calc_rpn(self, boxes , labels , image_resize_size=(300,400) ): 
         
-        # print args
-        print("Tools.py -> calc_rpn", "len of boxes", len(boxes),"len of labels", len(labels), "image resize", image_resize_size)
+        diag.log(diag.DEBUG, "tools.calc_rpn", "len of boxes {} len of labels {} image resize {}", len(boxes), len(labels), image_resize_size)
+
+        y_is_box_label, y_rpn_regr = self.calc_rpn_targets(boxes, labels, image_resize_size=image_resize_size)
+        num_pos = self.sample_rpn_targets(y_is_box_label)
+
+        # y_is_box_label = np.transpose(y_is_box_label, (2, 0, 1))
+        y_is_box_label = np.expand_dims(y_is_box_label, axis=0)
+
+        # y_rpn_regr = np.transpose(y_rpn_regr, (2, 0, 1))
+        y_rpn_regr = np.expand_dims(y_rpn_regr, axis=0)
+        
+        return y_is_box_label, y_rpn_regr, num_pos
+
+
+    def calc_rpn_targets(self, boxes , labels , image_resize_size=(300,400) ): 
+        """Labels every valid anchor against the GT boxes, before the pos/neg subsampling 
+
+        Same rules as calc_rpn_targets_loop but computed from one (anchors x GT boxes) IoU matrix 
+        Returns:
+            y_is_box_label: shape=(h, w, num_anchors), 1 positive, 0 neutral, -1 negative
+            y_rpn_regr: shape=(h, w, 4 * num_anchors), tx, ty, tw, th of the positive anchors 
+        """
+        return self.calc_rpn_targets_batch([boxes], [labels], image_resize_size=image_resize_size)[0]
+
+
+    def calc_rpn_targets_batch(self, boxes , labels , image_resize_size=(300,400) ): 
+        """calc_rpn_targets of images of the same size, boxes / labels are lists (one entry per image)
+
+        The GT boxes of consecutive images are scored against the anchors in one IoU matrix, up to 
+        IOU_BLOCK boxes (an image with more gets its own) : the (anchors x boxes) float64 temporaries of a 
+        whole batch are slower than the same work in blocks. Image j owns its columns of its block. 
+        Returns the list of (y_is_box_label, y_rpn_regr) of the images.
+        """
+        num_anchors = len(self.anchor_sizes) * len(self.anchor_ratios)
+        (output_height , output_width) = base_size_calculator(image_resize_size[0], image_resize_size[1])
+
+        anchors = self.anchors_for(image_resize_size)
+        anc = anchors.valid_boxes
+        jy , ix , anchor_idx = anchors.valid_locs[:, 0], anchors.valid_locs[:, 1], anchors.valid_locs[:, 2]
+
+        gtas = [np.asarray(b, dtype=np.float64).reshape(-1, 4) for b in boxes]
+        # 'bg' GT boxes never make an anchor positive or neutral 
+        not_bgs = [np.array([self.rev_label_map[l] != 'bg' for l in lbls[:gta.shape[0]]], dtype=bool).reshape(-1) for gta, lbls in zip(gtas, labels)]
+
+        # blocks of consecutive images, image j is the columns place[j][1] of the block place[j][0]
+        blocks, block, place, start = [], [], [], 0
+        for j, gta in enumerate(gtas):
+            if block and start + gta.shape[0] > IOU_BLOCK:
+                blocks.append(block)
+                block, start = [], 0
+            block.append(j)
+            place.append((len(blocks), slice(start, start + gta.shape[0])))
+            start += gta.shape[0]
+        blocks.append(block)
+
+        out = []
+        for j, (gta, not_bg) in enumerate(zip(gtas, not_bgs)):
+            b, cols = place[j]
+            if j == blocks[b][0]:
+                # (num valid anchors, num GT boxes of the block)
+                gt = np.concatenate([gtas[k] for k in blocks[b]])
+                ious = iou_matrix(anc, gt) if gt.shape[0] > 0 else np.zeros((anc.shape[0], 0))
+                ious[:, ~np.concatenate([not_bgs[k] for k in blocks[b]])] = 0.0
+                above = ious > self.rpn_max_overlap
+                between = (ious > self.rpn_min_overlap) & (ious < self.rpn_max_overlap)
+
+            y_is_box_label = np.zeros((output_height, output_width, num_anchors))
+            y_rpn_regr = np.zeros((output_height, output_width, num_anchors , 4))
+
+            is_pos = above[:, cols].any(1)
+            is_neutral = between[:, cols].any(1) & ~is_pos
+
+            anchor_label = np.full(anc.shape[0], -1.0)
+            anchor_label[is_neutral] = 0
+            anchor_label[is_pos] = 1
+            y_is_box_label[jy, ix, anchor_idx] = anchor_label
+
+            # regression target of a positive anchor : GT box with the best IoU (first one on ties)
+            pos = np.where(is_pos)[0]
+            if pos.size > 0:
+                best_box = np.where(above[pos, cols], ious[pos, cols], -1.0).argmax(1)
+                y_rpn_regr[jy[pos], ix[pos], anchor_idx[pos]] = regr_targets(anc[pos], gta[best_box])
+
+            # we ensure that every bbox has at least one positive RPN region
+            if gta.shape[0] > 0:
+                best_anchor , best_iou = best_anchor_for_bbox(ious[:, cols])
+                # no anchor above rpn_max_overlap, and at least some overlap 
+                forced = np.where(not_bg & ~above[:, cols].any(0) & (best_iou > 0))[0]
+                if forced.size > 0:
+                    a = best_anchor[forced]
+                    y_is_box_label[jy[a], ix[a], anchor_idx[a]] = 1
+                    y_rpn_regr[jy[a], ix[a], anchor_idx[a]] = regr_targets(anc[a], gta[forced]).astype(np.float32)
+
+            out.append((y_is_box_label, y_rpn_regr.reshape(output_height, output_width, num_anchors * 4)))
+        return out
+
+
+    def subsample(self, num_pos, num_neg):
+        # one issue is that the RPN has many more negative than positive regions, so we turn off some of the negative
+        # regions. We also limit it to 256 regions.
+        # returns the (sorted) indices of the positive and negative anchors to keep 
+        diag.count('rpn.images')
+        diag.count('rpn.pos_anchors', num_pos)
+        diag.count('rpn.neg_anchors', num_neg)
+        diag.observe('rpn.pos_anchors', num_pos)
+        keep_pos = np.arange(num_pos)
+        keep_neg = np.arange(num_neg)
+
+        if num_pos > self.num_regions//2:
+            keep_pos = np.sort(np.array(random.sample(range(num_pos), self.num_regions//2), dtype=np.int64))
+            num_pos = self.num_regions//2
+
+        if num_neg + num_pos > self.num_regions:
+            # as many negatives as positives are kept 
+            keep_neg = np.sort(np.array(random.sample(range(num_neg), min(num_pos, num_neg)), dtype=np.int64))
+
+        return keep_pos, keep_neg
+
+
+    def sample_rpn_targets(self, y_is_box_label):
+        # works in place on the (h, w, num_anchors) labels, returns the number of positive anchors left 
+        flat = y_is_box_label.reshape(-1)
+        pos_locs = np.flatnonzero(flat == 1)
+        neg_locs = np.flatnonzero(flat == -1)
+        keep_pos, keep_neg = self.subsample(pos_locs.size, neg_locs.size)
+        flat[pos_locs] = 0
+        flat[pos_locs[keep_pos]] = 1
+        flat[neg_locs] = 0
+        flat[neg_locs[keep_neg]] = -1
+        return keep_pos.size
+
+
+    def sample_sparse(self, pos_locs, neg_locs, pos_regr):
+        """Sparse version of sample_rpn_targets
+
+        Args:
+            pos_locs, neg_locs: flat (h, w, num_anchors) indices of all the positive / negative anchors 
+            pos_regr: shape=(len(pos_locs), 4) regression targets of the positive anchors 
+        Returns:
+            pos, neg, regr: the same, once subsampled
+        """
+        keep_pos, keep_neg = self.subsample(pos_locs.size, neg_locs.size)
+        return pos_locs[keep_pos], neg_locs[keep_neg], pos_regr[keep_pos]
+
+
+    def calc_rpn_sparse(self, boxes , labels , image_resize_size=(300,400) ): 
+        # calc_rpn, returning the sampled anchors as index lists instead of dense (h, w, num_anchors) maps 
+        return self.calc_rpn_sparse_batch([boxes], [labels], image_resize_size=image_resize_size)[0]
+
+
+    def calc_rpn_sparse_batch(self, boxes , labels , image_resize_size=(300,400) ): 
+        # calc_rpn_sparse of images of the same size (see calc_rpn_targets_batch), list of (pos, neg, regr)
+        out = []
+        for y_is_box_label, y_rpn_regr in self.calc_rpn_targets_batch(boxes, labels, image_resize_size=image_resize_size):
+            flat = y_is_box_label.reshape(-1)
+            pos_locs = np.flatnonzero(flat == 1)
+            out.append(self.sample_sparse(pos_locs, np.flatnonzero(flat == -1), y_rpn_regr.reshape(-1, 4)[pos_locs]))
+        return out
+
+
+    def calc_rpn_targets_loop(self, boxes , labels , image_resize_size=(300,400) ): 
+        # reference (python loop) version of calc_rpn_targets, one utils.iou call per (anchor, GT box) pair
+        # kept to check the vectorized engine against, see benchmark.py
         
         num_anchors = len(self.anchor_sizes) * len(self.anchor_ratios) # 3x3=9
         n_anchratios = len(self.anchor_ratios) # 3
@@ -114,9 +538,10 @@ class RPM():
 
         gta = np.array((boxes))
 
-        for key1 in self.valid_anchors:
-            for key2 in self.valid_anchors[key1]:
-                for anchor_box in self.valid_anchors[key1][key2]: 
+        valid_anchors = self.valid_anchors if isinstance(self.valid_anchors, dict) else self.anchors.as_dict()
+        for key1 in valid_anchors:
+            for key2 in valid_anchors[key1]:
+                for anchor_box in valid_anchors[key1][key2]: 
                     anchor_ratio_idx = key2
                     anchor_size_idx = key1
 
@@ -198,37 +623,7 @@ class RPM():
                 y_rpn_regr[
                     best_anchor_for_bbox[idx,0], best_anchor_for_bbox[idx,1], start:start+4] = best_dx_for_bbox[idx, :]
 
-
-        
-        pos_locs = np.where(y_is_box_label == 1 )
-        num_pos = len(pos_locs[0])
-
-        neg_locs = np.where(y_is_box_label == -1 )
-        num_neg =  len(neg_locs[0])
-
-        # one issue is that the RPN has many more negative than positive regions, so we turn off some of the negative
-        # regions. We also limit it to 256 regions.
-        if num_pos > self.num_regions//2:
-            non_valid_boxes  = random.sample(range( num_pos ), num_pos - self.num_regions//2)
-            y_is_box_label[pos_locs[0][non_valid_boxes], pos_locs[1][non_valid_boxes], pos_locs[2][non_valid_boxes]] = 0 
-            num_pos = self.num_regions//2
-
-        if num_neg + num_pos > self.num_regions:
-            non_valid_boxes = random.sample(range(num_neg), num_neg - num_pos)
-            y_is_box_label[neg_locs[0][non_valid_boxes], neg_locs[1][non_valid_boxes], neg_locs[2][non_valid_boxes]] = 0 
-
-        # y_is_box_label = np.transpose(y_is_box_label, (2, 0, 1))
-        y_is_box_label = np.expand_dims(y_is_box_label, axis=0)
-
-        # y_rpn_regr = np.transpose(y_rpn_regr, (2, 0, 1))
-        y_rpn_regr = np.expand_dims(y_rpn_regr, axis=0)
-        
-        # y_rpn_regr = np.concatenate([np.repeat(y_is_box_label, 4, axis=1), y_rpn_regr], axis=1)
-
-        return y_is_box_label, y_rpn_regr, num_pos
-        # return np.copy(y_is_box_label), np.copy(y_rpn_regr), num_pos
-
-
+        return y_is_box_label, y_rpn_regr
 
 # Code taken from here: 
 # https://github.com/RockyXu66/Faster_RCNN_for_Open_Images_Dataset_Keras/blob/master/frcnn_train_vgg.ipynb
@@ -236,8 +631,7 @@ class RPM():
 
 def non_max_suppression_fast(boxes, probs, overlap_thresh=0.9, max_boxes=500):
     
-    # print args
-    print("Tools.py -> non_max_suppression_fast", "overlap thres", overlap_thresh, "max boxes", max_boxes)
+    diag.log(diag.DEBUG, "tools.non_max_suppression_fast", "overlap thres {} max boxes {}", overlap_thresh, max_boxes)
     if boxes.size(0) == 0:
         return boxes, probs
 
@@ -276,11 +670,145 @@ def non_max_suppression_fast(boxes, probs, overlap_thresh=0.9, max_boxes=500):
         if len(pick) >= max_boxes:
             break
 
+    diag.count('nms.calls')
+    diag.count('nms.boxes_in', boxes.size(0))
+    diag.count('nms.boxes_kept', len(pick))
+    diag.observe('nms.boxes_kept', len(pick))
     return boxes[pick], probs[pick]
 
 
 
 
+def _pairwise_overlap(a, b, area_a, area_b):
+    # overlap of non_max_suppression_fast (+1 pixel convention) : a (4, B, n), b (4, B, m) coordinates first ==> (B, n, m)
+    w = torch.minimum(a[2][:, :, None], b[2][:, None, :])
+    w -= torch.maximum(a[0][:, :, None], b[0][:, None, :])
+    w += 1
+    w.clamp_(min=0)
+    h = torch.minimum(a[3][:, :, None], b[3][:, None, :])
+    h -= torch.maximum(a[1][:, :, None], b[1][:, None, :])
+    h += 1
+    h.clamp_(min=0)
+    inter = w.mul_(h)
+    union = area_a[:, :, None] + area_b[:, None, :]
+    union -= inter
+    return inter.div_(union)
+
+
+def batched_nms(boxes, probs, overlap_thresh=0.9, max_boxes=500, pre_nms_top_n=None, score_thresh=None, valid=None, tile_size=256):
+    # type: (Tensor, Tensor, float, int, Optional[int], Optional[float], Optional[Tensor], int) -> Tuple[Tensor, Tensor]
+    """Greedy NMS on a batch of images, same selection as non_max_suppression_fast
+
+    Boxes are sorted by score (and cut to the pre_nms_top_n best), then processed in tiles of tile_size :
+    the boxes of a tile are first checked against the kept boxes of the earlier tiles, then the greedy pass
+    inside the tile is resolved with a few batched fixed-point steps over its (tile x tile) suppression mask.
+    Only the images with less than max_boxes kept boxes go on to the next tile.
+    Args:
+        boxes: shape=(B, N, 4) x1, y1, x2, y2
+        probs: shape=(B, N) 
+        score_thresh: boxes with a lower score are dropped before the NMS 
+        valid: shape=(B, N) bool, False entries (padding) are ignored
+    Returns:
+        keep: shape=(B, max_boxes) indices into N in selection order, padded with 0 
+        num_keep: shape=(B,) number of valid entries of keep 
+    """
+    b, n = probs.size(0), probs.size(1)
+    device = probs.device
+    alive = torch.ones(b, n, dtype=torch.bool, device=device) if valid is None else valid.clone()
+    if score_thresh is not None:
+        alive &= probs >= score_thresh
+
+    # descending scores, ties picked as non_max_suppression_fast does (last index first)
+    scores = torch.where(alive, probs, torch.full_like(probs, -math.inf))
+    order = torch.argsort(scores, dim=1, stable=True).flip(1)
+    k = n if pre_nms_top_n is None else min(n, pre_nms_top_n)
+    order = order[:, :k]
+    # coordinates first (4, B, k), contiguous for the pairwise ops
+    boxes = torch.gather(boxes, 1, order[:, :, None].expand(b, k, 4)).permute(2, 0, 1).contiguous()
+    candidate = torch.gather(alive, 1, order)
+    area = (boxes[2] - boxes[0] + 1) * (boxes[3] - boxes[1] + 1)
+
+    keep = torch.zeros(b, k, dtype=torch.bool, device=device)
+    # images that still need boxes, the full ones are left out of the later tiles
+    active = torch.arange(b, device=device)
+    for start in range(0, k, tile_size):
+        end = min(k, start + tile_size)
+        tile = boxes[:, :, start:end].index_select(1, active)
+        tile_area = area[:, start:end].index_select(0, active)
+        alive_tile = candidate[:, start:end].index_select(0, active)
+
+        # boxes of the tile suppressed by the kept boxes of the earlier tiles
+        # (column chunks keep the temporaries small on large batches)
+        for col in range(0, start, 4 * tile_size):
+            stop = min(start, col + 4 * tile_size)
+            earlier = _pairwise_overlap(boxes[:, :, col:stop].index_select(1, active), tile, 
+                                        area[:, col:stop].index_select(0, active), tile_area) > overlap_thresh
+            earlier &= keep[:, col:stop].index_select(0, active)[:, :, None]
+            alive_tile = alive_tile & ~earlier.any(1)
+
+        # a box of the tile survives if no earlier kept box of the tile suppresses it
+        suppress = _pairwise_overlap(tile, tile, tile_area, tile_area) > overlap_thresh
+        suppress = torch.triu(suppress, diagonal=1)
+        kept = alive_tile
+        while True:
+            new_kept = alive_tile & ~(suppress & kept[:, :, None]).any(1)
+            if torch.equal(new_kept, kept):
+                break
+            kept = new_kept
+        keep[:, start:end] = keep[:, start:end].index_copy(0, active, kept)
+
+        active = active[keep.index_select(0, active).sum(1) < max_boxes]
+        if active.numel() == 0:
+            break
+
+    # first max_boxes kept boxes of each image, in score order
+    rank = torch.cumsum(keep.long(), 1) - 1
+    keep &= rank < max_boxes
+    num_keep = keep.sum(1)
+    slot = torch.where(keep, rank, torch.full_like(rank, max_boxes))
+    out = torch.zeros(b, max_boxes + 1, dtype=torch.long, device=device)
+    out.scatter_(1, slot, order)
+    if not torch.jit.is_scripting():
+        _count_nms(alive, num_keep)
+    return out[:, :max_boxes], num_keep
+
+
+@torch.jit.unused
+def _count_nms(alive, num_keep):
+    # diag counters of batched_nms (left out of the scripted Detector, see detector.py)
+    if diag.collecting():
+        diag.count('nms.calls', alive.size(0))
+        diag.count('nms.boxes_in', int(alive.sum()))
+        for kept in num_keep.tolist():
+            diag.count('nms.boxes_kept', kept)
+            diag.observe('nms.boxes_kept', kept)
+
+
+def non_max_suppression_tiled(boxes, probs, overlap_thresh=0.9, max_boxes=500, pre_nms_top_n=None, score_thresh=None):
+    """Drop-in for non_max_suppression_fast on top of batched_nms
+
+    boxes (N, 4) / probs (N,) return (boxes, probs) of the kept boxes, in selection order. 
+    boxes (B, N, 4) / probs (B, N) return them padded to (B, max_boxes, ...) plus the number kept per image. 
+    """
+    single = boxes.dim() == 2
+    if boxes.size(-2) == 0:
+        # nothing to gather from, like non_max_suppression_fast
+        if single:
+            return boxes, probs
+        b = boxes.size(0)
+        return boxes.new_zeros(b, max_boxes, 4), probs.new_zeros(b, max_boxes), torch.zeros(b, dtype=torch.long, device=boxes.device)
+    if single:
+        boxes, probs = boxes[None], probs[None]
+    keep, num_keep = batched_nms(boxes, probs, overlap_thresh=overlap_thresh, max_boxes=max_boxes, 
+                                 pre_nms_top_n=pre_nms_top_n, score_thresh=score_thresh)
+    kept_boxes = torch.gather(boxes, 1, keep[:, :, None].expand(-1, -1, 4))
+    kept_probs = torch.gather(probs, 1, keep)
+    if single:
+        return kept_boxes[0, :num_keep[0]], kept_probs[0, :num_keep[0]]
+    pad = torch.arange(max_boxes, device=keep.device)[None, :] >= num_keep[:, None]
+    return kept_boxes.masked_fill(pad[:, :, None], 0), kept_probs.masked_fill(pad, 0), num_keep
+
+
 
 def apply_regr_np(X, T):
     """Apply regression layer to all anchors in one feature map
@@ -292,8 +820,7 @@ def apply_regr_np(X, T):
         X: regressed position and size for current anchor
     """
     
-    # print args
-    print("Tools.py -> apply_regr_np", X.shape, T.shape)
+    diag.log(diag.DEBUG, "tools.apply_regr_np", "{} {}", X.shape, T.shape)
     
     x = X[0, :, :]
     y = X[1, :, :]
@@ -324,15 +851,79 @@ def apply_regr_np(X, T):
 
 
 
-def rpn_to_roi(cls_k, reg_k, no_anchors,  use_regr=True, max_boxes=300, overlap_thresh=0.9 , std_scaling=4.0 , all_possible_anchor_boxes=None ):
+def decode_proposals(reg_k, all_possible_anchor_boxes, use_regr=True, std_scaling=4.0):
+    # type: (Tensor, Tensor, bool, float) -> Tensor
+    """Apply the regression layer to every anchor of the batch in one go (same arithmetic as apply_regr_np)
+
+    Args:
+        reg_k: regression layer shape=(b, h, w, 4 * A)
+        all_possible_anchor_boxes: anchor grid shape=(4, h, w, A) x, y, w, h on the feature map, only read 
+    Returns:
+        boxes: shape=(b, A, h, w, 4) x1, y1, x2, y2 clipped to the feature map
     """
+    b, h, w = reg_k.shape[:3]
+    num_anchors = all_possible_anchor_boxes.size(3)
+    anchors = all_possible_anchor_boxes.permute(3, 1, 2, 0)[None] # shape => (1, A, h, w, 4)
+    x, y, aw, ah = anchors.unbind(-1)
+    if use_regr:
+        regr = reg_k.reshape(b, h, w, num_anchors, 4).permute(0, 3, 1, 2, 4) / std_scaling # shape => (b, A, h, w, 4)
+        tx, ty, tw, th = regr.unbind(-1)
+        w1 = torch.exp(tw) * aw
+        h1 = torch.exp(th) * ah
+        x1 = (tx * aw + (x + aw / 2.) - w1 / 2).round()
+        y1 = (ty * ah + (y + ah / 2.) - h1 / 2).round()
+        x2 = x1 + w1.round()
+        y2 = y1 + h1.round()
+    else:
+        x1, y1 = x.expand(b, -1, -1, -1), y.expand(b, -1, -1, -1)
+        x2, y2 = x1 + aw, y1 + ah
+
+    # ensure within bounds
+    return torch.stack([x1.clamp(0, w), y1.clamp(0, h), x2.clamp(0, w), y2.clamp(0, h)], -1)
+
+
+def rpn_to_roi_batch(cls_k, reg_k, all_possible_anchor_boxes, use_regr=True, max_boxes=300, overlap_thresh=0.9 , std_scaling=4.0 , pre_nms_top_n=6000 , score_thresh=None ):
+    # type: (Tensor, Tensor, Tensor, bool, int, float, float, Optional[int], Optional[float]) -> Tuple[Tensor, Tensor]
+    """Proposals for a whole batch, the anchor grid is shared and never modified (no clone needed)
+
+    Args:
+        cls_k: shape=(b, h, w, A)
+        reg_k: shape=(b, h, w, 4 * A)
+    Returns:
+        rois: shape=(b, max_boxes, 4) x1, y1, x2, y2 on the feature map, padded with 0 
+        num_rois: shape=(b,) number of valid rois per image 
+    """
+    b = cls_k.size(0)
+    all_boxes = decode_proposals(reg_k, all_possible_anchor_boxes, use_regr=use_regr, std_scaling=std_scaling).reshape(b, -1, 4)
+    all_probs = cls_k.permute(0, 3, 1, 2).reshape(b, -1)
+    # the batch case of non_max_suppression_tiled, written out for the scripted Detector
+    keep, num_rois = batched_nms(all_boxes, all_probs, overlap_thresh=overlap_thresh, max_boxes=max_boxes, 
+                                 pre_nms_top_n=pre_nms_top_n, score_thresh=score_thresh)
+    rois = torch.gather(all_boxes, 1, keep[:, :, None].expand(-1, -1, 4))
+    pad = torch.arange(max_boxes, device=keep.device)[None, :] >= num_rois[:, None]
+    return rois.masked_fill(pad[:, :, None], 0), num_rois
+
+
+def rpn_to_roi(cls_k, reg_k, no_anchors,  use_regr=True, max_boxes=300, overlap_thresh=0.9 , std_scaling=4.0 , all_possible_anchor_boxes=None , pre_nms_top_n=6000 , score_thresh=None ):
+    """
+    Returns:
+        result: boxes from non-max-suppression (shape=(max_boxes, 4))
+            boxes: coordinates for bboxes (on the feature map)
+    """
+    rois, num_rois = rpn_to_roi_batch(cls_k[None], reg_k[None], all_possible_anchor_boxes, use_regr=use_regr, max_boxes=max_boxes, 
+                                      overlap_thresh=overlap_thresh, std_scaling=std_scaling, pre_nms_top_n=pre_nms_top_n, score_thresh=score_thresh)
+    return rois[0, :num_rois[0]]
+
+
+def rpn_to_roi_loop(cls_k, reg_k, no_anchors,  use_regr=True, max_boxes=300, overlap_thresh=0.9 , std_scaling=4.0 , all_possible_anchor_boxes=None , pre_nms_top_n=6000 , score_thresh=None ):
+    """Per anchor reference version of rpn_to_roi, modifies all_possible_anchor_boxes in place
+
     Returns:
         result: boxes from non-max-suppression (shape=(max_boxes, 4))
             boxes: coordinates for bboxes (on the feature map)
     """
     
-    # print args
-    print("Tools.py -> rpn_to_roi", no_anchors, use_regr, max_boxes, overlap_thresh, std_scaling, all_possible_anchor_boxes.shape)
+    diag.log(diag.DEBUG, "tools.rpn_to_roi_loop", "{} {} {} {} {} {}", no_anchors, use_regr, max_boxes, overlap_thresh, std_scaling, all_possible_anchor_boxes.shape)
     
     reg_k = reg_k / std_scaling
     h, w = all_possible_anchor_boxes.size(1), all_possible_anchor_boxes.size(2)
@@ -349,7 +940,7 @@ def rpn_to_roi(cls_k, reg_k, no_anchors,  use_regr=True, max_boxes=300, overlap_
     all_boxes = all_possible_anchor_boxes.permute(0,3,1,2).reshape(4,-1).permute(1,0)
     all_probs = cls_k.permute(2,0,1).reshape(-1)
 
-    boxes, probs = non_max_suppression_fast(all_boxes, all_probs, overlap_thresh=overlap_thresh, max_boxes=max_boxes)
+    boxes, probs = non_max_suppression_tiled(all_boxes, all_probs, overlap_thresh=overlap_thresh, max_boxes=max_boxes, pre_nms_top_n=pre_nms_top_n, score_thresh=score_thresh)
     if boxes.shape[0] == 0:
         return torch.empty(0, 4).to(cls_k.device) # Return empty tensor if no boxes
 
@@ -357,15 +948,137 @@ def rpn_to_roi(cls_k, reg_k, no_anchors,  use_regr=True, max_boxes=300, overlap_
 
 
 
+def pad_gt(gt_boxes, gt_labels, device=None):
+    """Stack the per image ground truth of a batch
+
+    Args:
+        gt_boxes: list of (n_b, 4) boxes x1, y1, x2, y2 
+        gt_labels: list of n_b labels (only the first n_b are used)
+    Returns:
+        boxes: shape=(B, G, 4), labels: shape=(B, G), valid: shape=(B, G) bool
+    """
+    num_gt = max([len(b) for b in gt_boxes] + [1])
+    boxes = torch.zeros(len(gt_boxes), num_gt, 4, device=device)
+    labels = torch.zeros(len(gt_boxes), num_gt, dtype=torch.long, device=device)
+    valid = torch.zeros(len(gt_boxes), num_gt, dtype=torch.bool, device=device)
+    for b, (gta, cls) in enumerate(zip(gt_boxes, gt_labels)):
+        n = len(gta)
+        if n == 0:
+            continue
+        boxes[b, :n] = torch.as_tensor(gta, dtype=torch.float32).reshape(-1, 4).to(device)
+        labels[b, :n] = torch.as_tensor(cls[:n], dtype=torch.long).to(device)
+        valid[b, :n] = True
+    return boxes, labels, valid
+
+
+def calc_iou_batch(rois, num_rois, gt_boxes, gt_labels, gt_valid, class_mapping, classifier_min_overlap=0.1 , classifier_max_overlap=0.5, classifier_regr_std = [8.0, 8.0, 4.0, 4.0] ):
+    """Match the proposals of a batch to the ground truth with one (rois x gt) IoU matrix, on the device of rois
+
+    Same rules as calc_iou_loop (gt boxes truncated to int, best gt per roi, rois under classifier_min_overlap dropped, 
+    bg under classifier_max_overlap), tw / th are encoded as log(gw / w), log(gh / h).
+    Args:
+        rois: shape=(B, K, 4) x1, y1, x2, y2 on the feature map, from rpn_to_roi_batch
+        num_rois: shape=(B,) number of valid rois per image 
+        gt_boxes, gt_labels, gt_valid: padded ground truth (on the feature map), see pad_gt
+    Returns:
+        X: shape=(M, 4) x, y, w, h of the matched rois
+        Y1: shape=(M, num_classes) one hot class (bg included)
+        Y2: shape=(M, 8 * (num_classes - 1)) regression labels then regression targets
+        roi_index: shape=(M,) image of each row
+        best_iou: shape=(M,) IoU with the matched gt box 
+    """
+    b, k = rois.shape[:2]
+    device = rois.device
+    num_classes = len(class_mapping)
+    gt_boxes = gt_boxes.to(device).int().float()
+    gt_labels, gt_valid = gt_labels.to(device), gt_valid.to(device)
+
+    # IoU matrix (B, K, G), same conventions as utils.iou_tensor 
+    x1, y1, x2, y2 = rois.unbind(-1)
+    gx1, gy1, gx2, gy2 = gt_boxes.unbind(-1)
+    iw = torch.minimum(x2[:, :, None], gx2[:, None, :]) - torch.maximum(x1[:, :, None], gx1[:, None, :])
+    ih = torch.minimum(y2[:, :, None], gy2[:, None, :]) - torch.maximum(y1[:, :, None], gy1[:, None, :])
+    inter = iw * ih
+    union = ((x2 - x1) * (y2 - y1))[:, :, None] + ((gx2 - gx1) * (gy2 - gy1))[:, None, :] - inter
+    overlap = (iw > 0) & (ih > 0) & (union > 0) & gt_valid[:, None, :]
+    ious = torch.where(overlap, inter / (union + 1e-6), torch.full_like(inter, -1))
+    # ties go to the last gt box, like the sort in utils.iou_tensor
+    num_gt = ious.size(2)
+    best_iou, best_gt = ious.flip(2).max(2)
+    best_gt = num_gt - 1 - best_gt
+
+    roi_valid = torch.arange(k, device=device)[None, :] < num_rois.to(device)[:, None]
+    keep = roi_valid & (best_iou >= 0) & (best_iou >= classifier_min_overlap)
+    roi_index, roi = torch.nonzero(keep, as_tuple=True)
+    best_iou, best_gt = best_iou[roi_index, roi], best_gt[roi_index, roi]
+    x1, y1, x2, y2 = rois[roi_index, roi].unbind(-1)
+    w, h = x2 - x1, y2 - y1
+    X = torch.stack([x1, y1, w, h], 1)
+
+    fg = best_iou >= classifier_max_overlap
+    class_num = torch.where(fg, gt_labels[roi_index, best_gt], torch.full_like(best_gt, class_mapping['bg']))
+    Y1 = torch.zeros(X.size(0), num_classes, dtype=torch.long, device=device)
+    Y1.scatter_(1, class_num[:, None], 1)
+
+    # regression targets of the positive rois, written at 4 * class 
+    gt = gt_boxes[roi_index, best_gt]
+    gw, gh = gt[:, 2] - gt[:, 0], gt[:, 3] - gt[:, 1]
+    tx = ((gt[:, 0] + gt[:, 2]) / 2 - (x1 + w / 2.0)) / w
+    ty = ((gt[:, 1] + gt[:, 3]) / 2 - (y1 + h / 2.0)) / h
+    tw = torch.log(gw / w)
+    th = torch.log(gh / h)
+    t = torch.stack([tx, ty, tw, th], 1) * torch.tensor(classifier_regr_std, dtype=X.dtype, device=device)
+
+    num_regr = 4 * (num_classes - 1)
+    fg_rows = torch.nonzero(fg, as_tuple=True)[0]
+    cols = (4 * class_num[fg_rows])[:, None] + torch.arange(4, device=device)[None, :]
+    labels = torch.zeros(X.size(0), num_regr, device=device)
+    coords = torch.zeros(X.size(0), num_regr, device=device)
+    labels[fg_rows[:, None], cols] = 1
+    coords[fg_rows[:, None], cols] = t[fg_rows].float()
+    Y2 = torch.cat([labels, coords], 1)
+
+    if diag.collecting():
+        diag.count('roi.images', rois.size(0))
+        diag.count('roi.proposals', int(num_rois.sum()))
+        diag.count('roi.matched', X.size(0))
+        diag.count('roi.pos', int(fg.sum()))
+        diag.count('roi.neg', int((~fg).sum()))
+        for pos in torch.bincount(roi_index[fg], minlength=rois.size(0)).tolist():
+            diag.observe('roi.pos', pos)
+    return X, Y1, Y2, roi_index, best_iou
+
+
 def calc_iou(rpn_rois, img_data, class_mapping , classifier_min_overlap=0.1 , classifier_max_overlap=0.5, classifier_regr_std = [8.0, 8.0, 4.0, 4.0] , debug=False):
-    """Converts from (x1,y1,x2,y2) to (x,y,w,h) format
+    """Converts from (x1,y1,x2,y2) to (x,y,w,h) format, single image wrapper of calc_iou_batch
+
+    Args:
+        rpn_rois: shape=(K, 4) proposals of one image
+        img_data: {'boxes': gt boxes on the feature map, 'labels': gt labels}
+    """
+    if rpn_rois.numel() == 0 or rpn_rois.size(0) == 0:
+        # No ROIs to process, return None or appropriate values
+        return None, None, None, None
+
+    gt_boxes, gt_labels, gt_valid = pad_gt([img_data['boxes']], [img_data['labels']], device=rpn_rois.device)
+    num_rois = torch.tensor([rpn_rois.size(0)], device=rpn_rois.device)
+    X, Y1, Y2, _, best_iou = calc_iou_batch(rpn_rois[None], num_rois, gt_boxes, gt_labels, gt_valid, class_mapping, 
+                                            classifier_min_overlap=classifier_min_overlap, classifier_max_overlap=classifier_max_overlap, 
+                                            classifier_regr_std=classifier_regr_std)
+    if X.size(0) == 0:
+        return None, None, None, None
+    return X, Y1, Y2, best_iou if debug else []
+
+
+def calc_iou_loop(rpn_rois, img_data, class_mapping , classifier_min_overlap=0.1 , classifier_max_overlap=0.5, classifier_regr_std = [8.0, 8.0, 4.0, 4.0] , debug=False):
+    """Per proposal reference version of calc_iou, kept to check calc_iou_batch against (see benchmark.py)
+    Note: tw / th are encoded here as log(gw) / w (log(gh) / h)
 
     Args:
         R: bboxes, probs
     """
     
-    # print args
-    print("Tools.py -> calc_iou", classifier_min_overlap, classifier_max_overlap, classifier_regr_std, debug)
+    diag.log(diag.DEBUG, "tools.calc_iou_loop", "{} {} {} {}", classifier_min_overlap, classifier_max_overlap, classifier_regr_std, debug)
     
     if rpn_rois.numel() == 0 or rpn_rois.size(0) == 0:
         # No ROIs to process, return None or appropriate values
@@ -418,8 +1131,7 @@ def calc_iou(rpn_rois, img_data, class_mapping , classifier_min_overlap=0.1 , cl
                 tw = (boxes[best_bbox][2] - boxes[best_bbox][0]).float().log() / w
                 th = (boxes[best_bbox][3] - boxes[best_bbox][1]).float().log() / h
             else:
-                print('roi = {}'.format(best_iou))
-                raise RuntimeError
+                raise RuntimeError('roi = {}'.format(best_iou))
 
         
         class_label = len(class_mapping) * [0]
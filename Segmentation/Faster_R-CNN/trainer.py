@@ -0,0 +1,107 @@
+import torch
+
+from tools import rpn_to_roi_batch , pad_gt , calc_iou_batch
+from model import xywh_to_rois
+from loss import rpn_loss_regr , rpn_loss_cls_fixed_num  , class_loss_cls , class_loss_regr
+
+
+def classifier_targets(cls_k, reg_k, boxes, labels, all_possible_anchor_boxes, downscale, label_map):
+    """Proposals of the whole batch matched to the ground truth (no gradient)
+
+    Returns:
+        X: shape=(M, 4) x, y, w, h of the matched rois (on the feature map), roi_index their image
+        Y1, Y2: classifier targets, see tools.calc_iou_batch
+        pos_samples, neg_samples: shape=(M,) bool
+    """
+    with torch.no_grad():
+        # batch_rois : b, max_boxes, 4 (padded, num_rois valid per image)
+        batch_rois, num_rois = rpn_to_roi_batch(cls_k, reg_k, all_possible_anchor_boxes)
+        gt_boxes, gt_labels, gt_valid = pad_gt([bx // downscale for bx in boxes], labels, device=cls_k.device)
+        X, Y1, Y2, roi_index, _ = calc_iou_batch(batch_rois, num_rois, gt_boxes, gt_labels, gt_valid, class_mapping=label_map)
+        # Y1[-1] is the background
+        neg_samples = Y1[:, -1] == 1
+        pos_samples = Y1[:, -1] == 0
+    return X, Y1, Y2, roi_index, pos_samples, neg_samples
+
+
+def rpn_losses(cls_k, reg_k, rpn_targets, args):
+    l1 = rpn_loss_regr(rpn_targets, y_pred=reg_k , lambda_rpn_regr=args.lambda_rpn_regr) # regression loss
+    l2 = rpn_loss_cls_fixed_num(y_pred = cls_k , targets= rpn_targets , lambda_rpn_class = args.lambda_rpn_class) # classification loss
+    return l1, l2
+
+
+def classifier_losses(model_classifier, base_x, X, Y1, Y2, roi_index, ind, args):
+    # rois : batch_idx, x1, y1, x2, y2 (on the feature map)
+    rois = xywh_to_rois(X[ind], roi_index[ind])
+    out_class , out_regr = model_classifier(base_x = base_x , rois= rois )
+    l3 = class_loss_cls(y_true=Y1[ind], y_pred=out_class , lambda_cls_class=args.lambda_cls_class)
+    l4 = class_loss_regr(y_true=Y2[ind], y_pred= out_regr , lambda_cls_regr= args.lambda_cls_regr)
+    return l3, l4
+
+
+def new_stats(num_images):
+    # losses of one training step, summed over its classifier minibatches
+    return {'rpn_regr': 0.0, 'rpn_cls': 0.0, 'class_cls': 0.0, 'class_regr': 0.0, 'class_steps': 0, 'pos_per_image': [0] * num_images}
+
+
+def alternating_step(model_rpn, model_classifier, optimizer_model_rpn, optimizer_classifier, roi_sampler,
+                     image, boxes, labels, rpn_targets, all_possible_anchor_boxes, downscale, label_map, args, on_class_step=None):
+    """RPN step, a second (no grad) forward of the updated RPN for the proposals, then one classifier step per roi minibatch"""
+    stats = new_stats(image.size(0))
+    base_x , cls_k , reg_k = model_rpn(image)
+    l1, l2 = rpn_losses(cls_k, reg_k, rpn_targets, args)
+    stats['rpn_regr'], stats['rpn_cls'] = l1.item(), l2.item()
+
+    optimizer_model_rpn.zero_grad()
+    (l1 + l2).backward()
+    optimizer_model_rpn.step()
+
+    with torch.no_grad():
+        base_x , cls_k , reg_k = model_rpn(image)
+    X, Y1, Y2, roi_index, pos_samples, neg_samples = classifier_targets(cls_k, reg_k, boxes, labels, all_possible_anchor_boxes, downscale, label_map)
+    stats['pos_per_image'] = torch.bincount(roi_index[pos_samples], minlength=image.size(0)).tolist()
+
+    # balanced minibatches of (up to) n_roi rois per image, all the images of the batch at once
+    for j, ind in enumerate(roi_sampler(pos_samples, neg_samples, roi_index, image.size(0))):
+        l3, l4 = classifier_losses(model_classifier, base_x, X, Y1, Y2, roi_index, ind, args)
+        optimizer_classifier.zero_grad()
+        (l3 + l4).backward()
+        optimizer_classifier.step()
+
+        stats['class_cls'] += l3.item()
+        stats['class_regr'] += l4.item()
+        stats['class_steps'] += 1
+        if on_class_step is not None:
+            on_class_step(j, stats)
+    return stats
+
+
+def joint_step(model_rpn, model_classifier, optimizer_model_rpn, optimizer_classifier, roi_sampler,
+               image, boxes, labels, rpn_targets, all_possible_anchor_boxes, downscale, label_map, args, shared_backbone_grad=False):
+    """One forward of the RPN, proposals from its detached outputs, one roi minibatch per image and a single
+    backward / step of the RPN and classifier losses together.
+    With shared_backbone_grad the classifier loss also flows into the backbone through base_x.
+    """
+    stats = new_stats(image.size(0))
+    base_x , cls_k , reg_k = model_rpn(image)
+    l1, l2 = rpn_losses(cls_k, reg_k, rpn_targets, args)
+    stats['rpn_regr'], stats['rpn_cls'] = l1.item(), l2.item()
+    loss = l1 + l2
+
+    X, Y1, Y2, roi_index, pos_samples, neg_samples = classifier_targets(cls_k.detach(), reg_k.detach(), boxes, labels,
+                                                                        all_possible_anchor_boxes, downscale, label_map)
+    stats['pos_per_image'] = torch.bincount(roi_index[pos_samples], minlength=image.size(0)).tolist()
+
+    batches = roi_sampler(pos_samples, neg_samples, roi_index, image.size(0))
+    if len(batches) > 0:
+        features = base_x if shared_backbone_grad else base_x.detach()
+        l3, l4 = classifier_losses(model_classifier, features, X, Y1, Y2, roi_index, batches[0], args)
+        loss = loss + l3 + l4
+        stats['class_cls'], stats['class_regr'], stats['class_steps'] = l3.item(), l4.item(), 1
+
+    optimizer_model_rpn.zero_grad()
+    optimizer_classifier.zero_grad()
+    loss.backward()
+    optimizer_model_rpn.step()
+    optimizer_classifier.step()
+    return stats
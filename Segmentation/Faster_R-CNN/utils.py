@@ -19,7 +19,8 @@ def check_file(dir):
             return f
     return None 
 
-def save_checkpoint(epoch, model_rpn, model_classifier, optimizer_model_rpn, optimizer_classifier , best_error , save_dir="./"):
+def save_checkpoint(epoch, model_rpn, model_classifier, optimizer_model_rpn, optimizer_classifier , best_error , save_dir="./" , extra=None):
+    # extra : more entries of the checkpoint (e.g. the int8 weights of quantize.py)
     state = {'model_rpn': model_rpn,
              'model_classifier': model_classifier,
              'optimizer_model_rpn': optimizer_model_rpn,
@@ -27,6 +28,7 @@ def save_checkpoint(epoch, model_rpn, model_classifier, optimizer_model_rpn, opt
              'epoch': epoch ,
              'best_error' : best_error, 
              }
+    state.update(extra or {})
 
     if not os.path.isdir(save_dir):
         os.makedirs(save_dir)
@@ -46,23 +48,15 @@ def load_checkpoint(save_dir="./" , device='cpu'):
 
     f = check_file(save_dir)
     if f != None :
+        # the checkpoint pickles the models and optimizers themselves, not only tensors 
         if device == 'cpu':
-            return torch.load(osp.join(save_dir, f) , map_location=torch.device('cpu')  )
+            return torch.load(osp.join(save_dir, f) , map_location=torch.device('cpu') , weights_only=False )
         else:
-            return torch.load(osp.join(save_dir, f))
+            return torch.load(osp.join(save_dir, f) , weights_only=False)
     else :
         return None 
 
 
-def tile(a, dim, n_tile,device='cpu'):
-    init_dim = a.size(dim)
-    repeat_idx = [1] * a.dim()
-    repeat_idx[dim] = n_tile
-    a = a.repeat(*(repeat_idx))
-    order_index = torch.LongTensor(np.concatenate([init_dim * np.arange(n_tile) + i for i in range(init_dim)])).to(device=device)
-    return torch.index_select(a, dim, order_index)
-
-
 def iou(a, b):
     # (xmin,ymin,xmax,ymax)
     # invlaid boxes
@@ -91,6 +85,32 @@ def iou(a, b):
 
 
 
+def iou_matrix(a, b):
+    # vectorized version of iou() : a (N, 4) , b (M, 4) ==> (N, M)
+    # same conventions, invalid boxes and empty unions score 0
+    a = np.asarray(a, dtype=np.float64).reshape(-1, 4)
+    b = np.asarray(b, dtype=np.float64).reshape(-1, 4)
+
+    x1 = np.maximum(a[:, None, 0], b[None, :, 0])
+    y1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x2 = np.minimum(a[:, None, 2], b[None, :, 2])
+    y2 = np.minimum(a[:, None, 3], b[None, :, 3])
+
+    overlap = (x2 - x1 > 0) & (y2 - y1 > 0)
+    intersection = np.where(overlap, (x2 - x1) * (y2 - y1), 0.0)
+
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    union = area_a[:, None] + area_b[None, :] - intersection
+
+    valid_a = (a[:, 0] < a[:, 2]) & (a[:, 1] < a[:, 3])
+    valid_b = (b[:, 0] < b[:, 2]) & (b[:, 1] < b[:, 3])
+    valid = valid_a[:, None] & valid_b[None, :] & (union > 0)
+
+    return np.where(valid, intersection / np.where(valid, union + 1e-6, 1.0), 0.0)
+
+
+
 
 def iou_tensor(x1, y1, x2, y2, boxes):
         